@@ -0,0 +1,431 @@
+"""Bulk ingestion: Run the OCR pipeline over an S3 prefix or manifest of documents, in-process
+
+The deployed pipeline starts one Step Functions execution per uploaded object (via CloudTrail and EventBridge),
+which is fine for interactive use but slow and costly for backfills of thousands of documents. This script
+instead imports the pre-processing, Textract and post-processing Lambda handlers directly and runs each document
+through them in a thread pool:
+
+- **Shared clients**: The handlers' module-level boto3 clients are replaced with shared (thread-safe) clients, with
+  connection pools sized for the number of worker threads.
+- **Batched post-processing**: Documents are pre-processed and sent to Textract individually, but post-processed in
+  chunks through the function's batch mode - to share Comprehend calls between them.
+- **Same behaviour**: Stages are chained (and `ModelStarting`/`WaitingForJob` retried) as in StateMachine.asl.json,
+  and functions are configured through the same environment variables as their Lambda deployments (see
+  template.sam.yml) - for example `TEXTRACT_OUTPUT_FORMAT` or `RESULT_CACHE_TABLE_NAME`. Human review is not
+  started: Results flag which documents `NeedsReview` instead.
+- **Resumable**: Each finished document is appended to a progress log (JSON Lines) as soon as it's done. Re-running
+  the same command skips documents already succeeded (or rejected as poor quality), and retries failures.
+
+When all documents are done, a single results file is written with a summary and each document's outcome.
+
+Usage (see README.md for details):
+
+    python batch_ingest.py --prefix s3://my-bucket/receipts/ --textract-bucket my-raw-output-bucket \\
+        --output results.json
+"""
+
+# Python Built-Ins:
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import importlib.util
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# External Dependencies:
+import boto3
+from botocore.config import Config as BotoConfig
+
+logger = logging.getLogger("batch_ingest")
+
+OCR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMON_DIR = os.path.join(OCR_DIR, "common")
+PREPROCESS_DIR = os.path.join(OCR_DIR, "preprocessing", "fn-preprocess")
+TEXTRACT_DIR = os.path.join(OCR_DIR, "textract-integration", "fn-call-textract")
+POSTPROCESS_DIR = os.path.join(OCR_DIR, "postprocessing", "fn-postprocess")
+
+# Retry policies for "please try again later" errors, as in the state machine: (interval secs, attempts, backoff)
+MODEL_STARTING_RETRY = (60, 30, 1)
+WAITING_FOR_JOB_RETRY = (3, 12, 1.5)
+
+# Textract job idempotency token component: Re-running a document re-joins its existing job where possible
+TEXTRACT_REQUEST_TOKEN = "batch-ingest"
+
+SUCCEEDED = "Succeeded"
+REJECTED = "Rejected"
+FAILED = "Failed"
+EXTRACTED = "Extracted"  # (Internal: Awaiting post-processing, never logged)
+DONE_STATUSES = (SUCCEEDED, REJECTED)  # Documents not re-processed when resuming
+
+
+def load_function(name: str, function_dir: str):
+    """Import a Lambda function's `main.py` as module `name` (making its local dependencies importable too)"""
+    if function_dir not in sys.path:
+        sys.path.insert(0, function_dir)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(function_dir, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def parse_s3_uri(uri: str) -> tuple:
+    """Split an s3://bucket/key URI into (bucket, key)"""
+    if not uri.startswith("s3://"):
+        raise ValueError(f"Not an S3 URI: '{uri}'")
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+
+def list_prefix(s3_client, prefix_uri: str) -> list:
+    """List all objects under an S3 prefix as (bucket, key) tuples (skipping 'folder' placeholders)"""
+    bucket, prefix = parse_s3_uri(prefix_uri)
+    documents = []
+    for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        documents.extend(
+            (bucket, obj["Key"]) for obj in page.get("Contents", []) if not obj["Key"].endswith("/")
+        )
+    return documents
+
+
+def read_manifest(s3_client, manifest_path: str) -> list:
+    """Read a manifest (local path or S3 URI) as a list of (bucket, key) tuples
+
+    Each non-blank line may be an S3 URI, or a JSON object with either `Bucket` and `Key` or (as in SageMaker
+    Ground Truth manifests) `source-ref`.
+    """
+    if manifest_path.startswith("s3://"):
+        bucket, key = parse_s3_uri(manifest_path)
+        lines = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8").splitlines()
+    else:
+        with open(manifest_path, "r") as f:
+            lines = f.read().splitlines()
+
+    documents = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            entry = json.loads(line)
+            if "source-ref" in entry:
+                documents.append(parse_s3_uri(entry["source-ref"]))
+            else:
+                documents.append((entry["Bucket"], entry["Key"]))
+        else:
+            documents.append(parse_s3_uri(line))
+    return documents
+
+
+def call_with_retry(fn, event: dict, retry_errors: tuple, policy: tuple):
+    """Call a Lambda `fn(event, context)`, retrying on `retry_errors` per (interval, max_attempts, backoff)"""
+    interval, max_attempts, backoff = policy
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return fn(event, None)
+        except retry_errors:
+            if attempt == max_attempts:
+                raise
+            time.sleep(interval)
+            interval *= backoff
+
+
+class Pipeline:
+    """The OCR pipeline stages as in-process function calls, with shared AWS clients
+
+    Parameters
+    ----------
+    textract_bucket :
+        Bucket to save raw Textract results to (e.g. the stack's RawOutputBucket)
+    max_workers :
+        Number of documents that will be processed concurrently (to size client connection pools)
+    skip_preprocess :
+        Set True to send documents straight to Textract, without the image quality check
+    rekognition_model_arn :
+        Optional Rekognition model for pre-processing (otherwise looked up per REKOGNITION_MODEL_ARN_PARAM)
+    """
+    def __init__(
+        self,
+        textract_bucket: str,
+        max_workers: int=8,
+        skip_preprocess: bool=False,
+        rekognition_model_arn: str=None,
+    ):
+        self.textract_bucket = textract_bucket
+        self.skip_preprocess = skip_preprocess
+        self.rekognition_model_arn = rekognition_model_arn
+
+        if COMMON_DIR not in sys.path:
+            sys.path.insert(0, COMMON_DIR)
+        self.preprocess = None if skip_preprocess else load_function("fn_preprocess", PREPROCESS_DIR)
+        self.textract = load_function("fn_call_textract", TEXTRACT_DIR)
+        self.postprocess = load_function("fn_postprocess", POSTPROCESS_DIR)
+
+        config = BotoConfig(max_pool_connections=max(10, max_workers), retries={ "mode": "standard" })
+        s3 = boto3.client("s3", config=config)
+        if self.preprocess is not None:
+            self.preprocess.s3 = s3
+            self.preprocess.rekognition = boto3.client("rekognition", config=config)
+        self.textract.s3 = s3
+        self.textract.textract = boto3.client("textract", config=config)
+        self.postprocess.s3 = s3
+        self.postprocess.comprehend = boto3.client("comprehend", config=config)
+
+    @property
+    def postprocess_batch_size(self) -> int:
+        return self.postprocess.COMPREHEND_BATCH_SIZE
+
+    def extract(self, bucket: str, key: str) -> dict:
+        """Pre-process and Textract one document: Returns its (`EXTRACTED` or failed) record, never raising"""
+        record = { "S3Uri": f"s3://{bucket}/{key}" }
+        start_time = time.time()
+        try:
+            if self.preprocess is None:
+                document = { "Bucket": bucket, "Key": key }
+            else:
+                event = { "Bucket": bucket, "Key": key }
+                if self.rekognition_model_arn:
+                    event["RekognitionModelArn"] = self.rekognition_model_arn
+                document = call_with_retry(
+                    self.preprocess.handler,
+                    event,
+                    (self.preprocess.ModelStarting,),
+                    MODEL_STARTING_RETRY,
+                )
+                record["Processed"] = document["S3Uri"]
+
+            textract_event = {
+                "Input": {
+                    "Bucket": document["Bucket"],
+                    "Key": document["Key"],
+                    "RequestToken": TEXTRACT_REQUEST_TOKEN,
+                },
+                "Output": { "Bucket": self.textract_bucket, "Prefix": document["Bucket"] },
+            }
+            textract_result = self.textract.handler(textract_event, None)
+            if "JobId" in textract_result:
+                # Async job started: Poll for its results
+                textract_result = call_with_retry(
+                    self.textract.handler,
+                    { **textract_event, "JobId": textract_result["JobId"] },
+                    (self.textract.WaitingForJob,),
+                    WAITING_FOR_JOB_RETRY,
+                )
+            record["Textract"] = textract_result["S3Uri"]
+            record["Status"] = EXTRACTED
+        except Exception as e:
+            is_rejected = self.preprocess is not None and isinstance(e, self.preprocess.PoorQualityImage)
+            record["Status"] = REJECTED if is_rejected else FAILED
+            record["Error"] = type(e).__name__
+            record["Cause"] = str(e)
+        record["Seconds"] = round(time.time() - start_time, 3)
+        return record
+
+    def postprocess_batch(self, records: list) -> list:
+        """Post-process a chunk of `EXTRACTED` records together, completing them: Returns the same records"""
+        start_time = time.time()
+        try:
+            model_results = self.postprocess.handle_batch(
+                [dict(zip(("Bucket", "Key"), parse_s3_uri(record["Textract"]))) for record in records],
+            )
+        except Exception as e:
+            model_results = [{ "Error": type(e).__name__, "Cause": str(e) }] * len(records)
+        seconds = time.time() - start_time
+        for record, model_result in zip(records, model_results):
+            if "Error" in model_result:
+                record["Status"] = FAILED
+                record["Error"] = model_result["Error"]
+                record["Cause"] = model_result["Cause"]
+            else:
+                record["ModelResult"] = model_result
+                record["NeedsReview"] = bool(model_result.get("ReviewFields"))
+                record["Status"] = SUCCEEDED
+            record["Seconds"] = round(record["Seconds"] + seconds, 3)
+        return records
+
+
+class ProgressLog:
+    """Append-only JSON Lines log of finished document records, to resume interrupted runs from"""
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self) -> dict:
+        """Load the latest record logged for each document: Returns a dict by S3Uri"""
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # (e.g. a partial line, if the previous run was killed mid-write)
+                records[record["S3Uri"]] = record
+        return records
+
+    def append(self, record: dict):
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def summarize(records: list, elapsed_seconds: float) -> dict:
+    summary = { "Documents": len(records), SUCCEEDED: 0, REJECTED: 0, FAILED: 0, "NeedsReview": 0 }
+    for record in records:
+        summary[record["Status"]] += 1
+        if record.get("NeedsReview"):
+            summary["NeedsReview"] += 1
+    summary["Seconds"] = round(elapsed_seconds, 1)
+    return summary
+
+
+def write_results(path: str, summary: dict, records: list):
+    """Write the results file (via a temporary file, so an existing one is only replaced when complete)"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({ "Summary": summary, "Documents": records }, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def run(args) -> dict:
+    s3 = boto3.client("s3")
+    if args.prefix:
+        documents = list_prefix(s3, args.prefix)
+    else:
+        documents = read_manifest(s3, args.manifest)
+    documents = list(dict.fromkeys(documents))  # (De-duplicated, keeping order)
+    logger.info("Found %s documents", len(documents))
+
+    progress = ProgressLog(args.progress or args.output + ".progress.jsonl")
+    if args.restart and os.path.exists(progress.path):
+        os.remove(progress.path)
+    finished = progress.load()
+    pending = [
+        (bucket, key) for bucket, key in documents
+        if finished.get(f"s3://{bucket}/{key}", {}).get("Status") not in DONE_STATUSES
+    ]
+    if len(pending) < len(documents):
+        logger.info("Resuming from %s: %s documents already done", progress.path, len(documents) - len(pending))
+
+    pipeline = Pipeline(
+        args.textract_bucket,
+        max_workers=args.concurrency,
+        skip_preprocess=args.skip_preprocess,
+        rekognition_model_arn=args.rekognition_model_arn,
+    )
+    start_time = time.time()
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    extract_futures = { executor.submit(pipeline.extract, bucket, key) for bucket, key in pending }
+    postprocess_futures = set()
+    extracted = []  # Records waiting for a post-processing batch
+    n_done = 0
+    try:
+        while extract_futures or postprocess_futures:
+            done, _ = wait(extract_futures | postprocess_futures, return_when=FIRST_COMPLETED)
+            finished_records = []
+            for future in done:
+                if future in extract_futures:
+                    extract_futures.remove(future)
+                    record = future.result()
+                    if record["Status"] == EXTRACTED:
+                        extracted.append(record)
+                    else:
+                        finished_records.append(record)
+                else:
+                    postprocess_futures.remove(future)
+                    finished_records.extend(future.result())
+
+            # Start post-processing each full batch as soon as it's ready, and any remainder once extraction is done:
+            while len(extracted) >= pipeline.postprocess_batch_size or (extracted and not extract_futures):
+                batch = extracted[:pipeline.postprocess_batch_size]
+                del extracted[:pipeline.postprocess_batch_size]
+                postprocess_futures.add(executor.submit(pipeline.postprocess_batch, batch))
+
+            for record in finished_records:
+                n_done += 1
+                progress.append(record)
+                finished[record["S3Uri"]] = record
+                if record["Status"] != SUCCEEDED:
+                    logger.warning("%s %s: %s", record["Status"], record["S3Uri"], record.get("Cause"))
+                if n_done % args.log_every == 0 or n_done == len(pending):
+                    elapsed = time.time() - start_time
+                    logger.info(
+                        "Processed %s/%s documents (%.2f docs/sec)", n_done, len(pending), n_done / max(elapsed, 1e-6)
+                    )
+    except KeyboardInterrupt:
+        logger.warning("Interrupted: Re-run the same command to resume from %s", progress.path)
+        for future in extract_futures | postprocess_futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+    executor.shutdown()
+
+    # Results in manifest/listing order:
+    records = [finished[f"s3://{bucket}/{key}"] for bucket, key in documents]
+    summary = summarize(records, time.time() - start_time)
+    write_results(args.output, summary, records)
+    logger.info("Wrote results to %s: %s", args.output, summary)
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the OCR pipeline over an S3 prefix or manifest of documents, with resumable progress",
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--prefix", help="S3 URI prefix of documents to process, e.g. s3://bucket/receipts/")
+    source.add_argument(
+        "--manifest",
+        help="Manifest file (local path or S3 URI) listing documents as S3 URIs or JSON lines",
+    )
+    parser.add_argument(
+        "--textract-bucket",
+        required=True,
+        help="Bucket to save raw Textract results to (e.g. the stack's raw output bucket)",
+    )
+    parser.add_argument("--output", default="batch-results.json", help="Local path for the results file")
+    parser.add_argument(
+        "--progress",
+        help="Local path for the progress log to resume from (default {output}.progress.jsonl)",
+    )
+    parser.add_argument("--restart", action="store_true", help="Ignore any existing progress and start over")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of documents to process at once")
+    parser.add_argument(
+        "--skip-preprocess",
+        action="store_true",
+        help="Send documents straight to Textract, without the pre-processing image quality check",
+    )
+    parser.add_argument(
+        "--rekognition-model-arn",
+        help="Rekognition model for pre-processing (default: per the REKOGNITION_MODEL_ARN_PARAM env var)",
+    )
+    parser.add_argument(
+        "--textract-mode",
+        choices=("SYNC", "ASYNC"),
+        default=os.environ.get("TEXTRACT_INTEGRATION_TYPE", "SYNC"),
+        help="SYNC for single-page images, or ASYNC to support multi-page documents",
+    )
+    parser.add_argument(
+        "--function-log",
+        help="File to redirect the pipeline functions' own (print) logs to, instead of stdout",
+    )
+    parser.add_argument("--log-every", type=int, default=100, help="Log progress every N documents")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", stream=sys.stderr)
+    # Functions read their configuration from the environment when imported:
+    os.environ["TEXTRACT_INTEGRATION_TYPE"] = args.textract_mode
+    if args.function_log:
+        sys.stdout = open(args.function_log, "a")
+    summary = run(args)
+    return 0 if not summary[FAILED] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
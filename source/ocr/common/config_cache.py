@@ -0,0 +1,109 @@
+"""Warm-container cache of SSM Parameter Store configuration values (e.g. model and flow ARNs)
+
+Configuration like which Rekognition model or A2I flow definition to use changes very rarely, but looking it up
+from SSM on every invocation adds a round trip per document and can hit SSM throughput limits under bursts of
+uploads. Values are instead cached at module level (so shared across invocations of a warm Lambda container) for
+`CONFIG_CACHE_TTL_SECONDS` (default 5 minutes):
+
+- Lookups within the last `refresh_ahead_seconds` of a value's lifetime return the cached value immediately, but
+  also kick off a background refresh - so busy functions rarely wait on SSM at all.
+- Callers can `refresh_parameter()` to force a reload, e.g. when the cached ARN turns out not to exist (because
+  the parameter was updated since it was cached).
+"""
+
+# Python Built-Ins:
+import os
+import threading
+import time
+
+# External Dependencies:
+import boto3
+
+DEFAULT_TTL_SECONDS = int(os.environ.get("CONFIG_CACHE_TTL_SECONDS", 300))
+
+
+class ParameterCache:
+    """TTL cache of SSM parameter values with background refresh-ahead and hit-rate logging"""
+    def __init__(self, ttl_seconds: int=DEFAULT_TTL_SECONDS, refresh_ahead_seconds: int=None, ssm_client=None):
+        self.ttl_seconds = ttl_seconds
+        self.refresh_ahead_seconds = (
+            ttl_seconds // 5 if refresh_ahead_seconds is None else refresh_ahead_seconds
+        )
+        self._ssm = ssm_client
+        self._entries = {}  # name -> (expires_at, value)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def ssm(self):
+        if self._ssm is None:
+            self._ssm = boto3.client("ssm")
+        return self._ssm
+
+    def get(self, name: str) -> str:
+        """Get a parameter value, from cache if fresh enough"""
+        now = time.time()
+        entry = self._entries.get(name)
+        is_hit = entry is not None and entry[0] > now
+        if is_hit:
+            self.hits += 1
+            if entry[0] - now < self.refresh_ahead_seconds:
+                self._refresh_in_background(name)
+            value = entry[1]
+        else:
+            self.misses += 1
+            value = self.refresh(name)
+        print("Config cache {} for {} (hit rate {:.1%} over {} lookups)".format(
+            "hit" if is_hit else "miss",
+            name,
+            self.hit_rate,
+            self.hits + self.misses,
+        ))
+        return value
+
+    def refresh(self, name: str) -> str:
+        """Force (re)loading a parameter value from SSM, and return it"""
+        value = self.ssm.get_parameter(Name=name)["Parameter"]["Value"]
+        with self._lock:
+            self._entries[name] = (time.time() + self.ttl_seconds, value)
+        return value
+
+    def _refresh_in_background(self, name: str):
+        with self._lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+
+        def refresh_task():
+            try:
+                self.refresh(name)
+            except Exception as e:
+                # Cached value is still valid until it expires, at which point we'll retry synchronously:
+                print(f"Background refresh of config {name} failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(name)
+
+        # Note Lambda freezes the container between invocations, so the refresh may complete during the next one:
+        threading.Thread(target=refresh_task, daemon=True).start()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+
+# Shared default cache for the container:
+parameter_cache = ParameterCache()
+
+
+def get_parameter(name: str) -> str:
+    """Get an SSM parameter value via the shared container-level cache"""
+    return parameter_cache.get(name)
+
+
+def refresh_parameter(name: str) -> str:
+    """Force reloading an SSM parameter value into the shared container-level cache, and return it"""
+    return parameter_cache.refresh(name)
@@ -0,0 +1,43 @@
+"""Minimal custom metrics publishing via CloudWatch Embedded Metric Format (EMF)
+
+Lambda functions can publish custom CloudWatch metrics without any extra API calls (or latency) by printing
+specially-structured JSON log lines, which CloudWatch Logs extracts into metrics automatically. See:
+https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+"""
+
+# Python Built-Ins:
+import json
+import os
+import time
+
+DEFAULT_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "SmartOCR")
+
+
+def emit_metrics(metrics: dict, dimensions: dict=None, namespace: str=None, unit: str="Count"):
+    """Publish one or more metric values (dict of name -> number) as a single EMF log line
+
+    Parameters
+    ----------
+    metrics :
+        Metric names and values to publish
+    dimensions :
+        Optional dict of dimension name -> value to attach to all the metrics (e.g. { "Function": "PostProcess" })
+    namespace :
+        CloudWatch namespace (defaults to METRICS_NAMESPACE env var, or "SmartOCR")
+    unit :
+        CloudWatch unit for all the metrics e.g. "Count", "Milliseconds"
+    """
+    dimensions = dimensions or {}
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": namespace or DEFAULT_NAMESPACE,
+                "Dimensions": [list(dimensions.keys())],
+                "Metrics": [{ "Name": name, "Unit": unit } for name in metrics],
+            }],
+        },
+    }
+    record.update(dimensions)
+    record.update(metrics)
+    print(json.dumps(record))
@@ -0,0 +1,171 @@
+"""Cache of pipeline stage results keyed by source object content, to skip re-processing duplicate uploads
+
+Users often upload the same document more than once: Without a cache, each upload pays for (and waits on) the
+same Rekognition and Textract calls again. Here results are keyed by the S3 object's ETag and size - which for a
+given upload method are determined by the object's content, not its key - so duplicates can return the previous
+result straight away.
+
+Backends are pluggable:
+
+- `DynamoDBCacheBackend` for deployment: Entries expire via the table's DynamoDB TTL attribute
+- `MemoryCacheBackend` for local testing (or a per-container cache): LRU eviction with a maximum size
+
+Cached values should be small, JSON-serializable dicts (e.g. S3 locations of results, rather than the results).
+"""
+
+# Python Built-Ins:
+from collections import OrderedDict
+import json
+import os
+import time
+
+# External Dependencies:
+import boto3
+
+# Local Dependencies:
+from metrics import emit_metrics
+
+# Results we point to are in buckets with 7-day expiry lifecycle rules, so cache entries must expire sooner:
+DEFAULT_TTL_SECONDS = int(os.environ.get("RESULT_CACHE_TTL_SECONDS", 6 * 24 * 60 * 60))
+
+
+class MemoryCacheBackend:
+    """In-memory cache backend with TTL and least-recently-used eviction beyond `max_entries`"""
+    def __init__(self, max_entries: int=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self.evictions = 0
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: dict, expires_at: float):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: str):
+        self._entries.pop(key, None)
+
+
+class DynamoDBCacheBackend:
+    """DynamoDB cache backend: Table should have string hash key `CacheKey`, and TTL enabled on `ExpiresAt`
+
+    DynamoDB TTL deletes expired items lazily (typically within a couple of days), so expiry is also checked on
+    read.
+    """
+    def __init__(self, table_name: str, dynamodb_client=None):
+        self.table_name = table_name
+        self.dynamodb = dynamodb_client or boto3.client("dynamodb")
+
+    def get(self, key: str):
+        item = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={ "CacheKey": { "S": key } },
+        ).get("Item")
+        if item is None or float(item["ExpiresAt"]["N"]) <= time.time():
+            return None
+        return json.loads(item["Value"]["S"])
+
+    def put(self, key: str, value: dict, expires_at: float):
+        self.dynamodb.put_item(
+            TableName=self.table_name,
+            Item={
+                "CacheKey": { "S": key },
+                "Value": { "S": json.dumps(value) },
+                "ExpiresAt": { "N": str(int(expires_at)) },
+            },
+        )
+
+    def delete(self, key: str):
+        self.dynamodb.delete_item(TableName=self.table_name, Key={ "CacheKey": { "S": key } })
+
+
+class ResultCache:
+    """Content-keyed result cache for one pipeline stage (`namespace`), counting hits and misses
+
+    Cache failures are logged and treated as misses, so that a cache problem can slow the pipeline down but never
+    break it.
+    """
+    def __init__(self, backend, namespace: str, ttl_seconds: int=DEFAULT_TTL_SECONDS):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+    def cache_key(self, fingerprint: str, variant: str=None) -> str:
+        """Full cache key for a content `fingerprint` and optional `variant` (e.g. processing options)"""
+        return "#".join(filter(None, (self.namespace, variant, fingerprint)))
+
+    def get(self, fingerprint: str, variant: str=None):
+        """Return the cached value for `fingerprint` (and `variant`), or None on a miss"""
+        try:
+            value = self.backend.get(self.cache_key(fingerprint, variant))
+        except Exception as e:
+            print(f"Ignoring result cache read error: {e}")
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        emit_metrics(
+            { "ResultCacheHit": int(value is not None), "ResultCacheMiss": int(value is None) },
+            dimensions={ "Cache": self.namespace },
+        )
+        return value
+
+    def put(self, fingerprint: str, value: dict, variant: str=None):
+        try:
+            self.backend.put(self.cache_key(fingerprint, variant), value, time.time() + self.ttl_seconds)
+        except Exception as e:
+            print(f"Ignoring result cache write error: {e}")
+
+    def invalidate(self, fingerprint: str, variant: str=None):
+        """Remove an entry, e.g. if the result it points to turns out to have been deleted"""
+        try:
+            self.backend.delete(self.cache_key(fingerprint, variant))
+        except Exception as e:
+            print(f"Ignoring result cache delete error: {e}")
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+
+def s3_content_fingerprint(bucket: str, key: str, s3_client=None) -> str:
+    """Identify an S3 object's content (without downloading it) from its ETag and size
+
+    Objects uploaded with a single PUT have the MD5 of their content as ETag. Multipart uploads get a different
+    ETag derived from the part MD5s: Still content-determined, but dependent on the part size - so identical
+    files uploaded by different methods may miss the cache (which is safe, just less effective).
+
+    Returns None (so callers skip the cache) if the object can't be inspected: A fingerprinting problem shouldn't
+    fail the document, since the actual processing step will surface any real problem with the object.
+    """
+    s3_client = s3_client or boto3.client("s3")
+    try:
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        print(f"Skipping result cache: Couldn't fingerprint s3://{bucket}/{key}: {e}")
+        return None
+    return "{}-{}".format(head["ETag"].strip('"'), head["ContentLength"])
+
+
+def cache_from_env(namespace: str):
+    """Create the deployment ResultCache for `namespace` from RESULT_CACHE_TABLE_NAME, or None if not set"""
+    table_name = os.environ.get("RESULT_CACHE_TABLE_NAME")
+    if not table_name:
+        return None
+    return ResultCache(DynamoDBCacheBackend(table_name), namespace)
@@ -0,0 +1,206 @@
+"""Compact, column-oriented storage format for raw Amazon Textract results
+
+Standard Textract JSON repeats every field name for every block and nests each block's Geometry in several
+layers of objects - so result files are large, and consumers have to parse *everything* even if they only need
+(say) the text and relationships. This format instead stores gzip-compressed JSON lines:
+
+    {"Format": "textract-compact", "Version": 1, "DocumentMetadata": {...}, ...}
+    ["#rows", 1000]
+    ["Id", ["3b0a...", "9f21...", ...]]
+    ["BlockType", ["PAGE", "LINE", ...]]
+    ["BoundingBox", [[0.98, 0.97, 0.01, 0.02], ...]]
+    ...
+    ["#warnings", [...]]
+
+- The first line is a header object with the document-level (non-`Blocks`) fields of the result.
+- Blocks are stored in row groups (typically one per Textract results page), each introduced by a `#rows` line
+  and followed by one line per block field ("column") present in the group. Missing values are `null`.
+- `Geometry` is flattened to a `BoundingBox` column of [Width, Height, Left, Top] and a `Polygon` column of
+  [X1, Y1, X2, Y2, ...] coordinates.
+- The final line lists any `Warnings` from the Textract job.
+
+Because each column is a separate line, readers can skip decoding the columns they don't need (e.g. Geometry,
+which is typically the biggest) without parsing them at all.
+"""
+
+# Python Built-Ins:
+import gzip
+import json
+
+FORMAT_NAME = "textract-compact"
+FORMAT_VERSION = 1
+FILE_SUFFIX = ".textract.jsonl.gz"
+
+BOUNDING_BOX_FIELDS = ("Width", "Height", "Left", "Top")
+GEOMETRY_COLUMNS = ("BoundingBox", "Polygon")
+ROWS_MARKER = "#rows"
+WARNINGS_MARKER = "#warnings"
+
+
+class MalformedCompactResult(ValueError):
+    pass
+
+
+class CompactResultWriter:
+    """Incrementally write a Textract result in compact format to a binary file-like object
+
+    Usage: Call `write_header()` once with the document-level fields, `write_blocks()` once per row group (e.g.
+    per page of Textract results), optionally `add_warnings()`, then `close()` (or use as a context manager).
+    Closing the writer does not close the underlying `fileobj`.
+    """
+    def __init__(self, fileobj, compresslevel: int=6):
+        self._gz = gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=compresslevel)
+        self._header_written = False
+        self._warnings = []
+        self.n_blocks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_header(self, fields: dict):
+        if self._header_written:
+            raise ValueError("Compact result header already written")
+        header = { "Format": FORMAT_NAME, "Version": FORMAT_VERSION }
+        header.update({ k: v for k, v in fields.items() if k not in ("Blocks", "Warnings") })
+        self._write_line(header)
+        self._header_written = True
+
+    def write_blocks(self, blocks: list):
+        if not self._header_written:
+            self.write_header({})
+        if not len(blocks):
+            return
+        self._write_line([ROWS_MARKER, len(blocks)])
+        for name, values in blocks_to_columns(blocks).items():
+            self._write_line([name, values])
+        self.n_blocks += len(blocks)
+
+    def add_warnings(self, warnings: list):
+        self._warnings.extend(warnings)
+
+    def close(self):
+        if self._gz.closed:
+            return
+        if not self._header_written:
+            self.write_header({})
+        self._write_line([WARNINGS_MARKER, self._warnings])
+        self._gz.close()
+
+    def _write_line(self, obj):
+        self._gz.write(json.dumps(obj).encode("utf-8"))
+        self._gz.write(b"\n")
+
+
+class CompactResultReader:
+    """Read a compact-format Textract result from a binary file-like object, decoding only selected columns
+
+    The header is read on construction and available as `.header`. Iterate the reader to get `(n_rows, columns)`
+    tuples for each row group, where `columns` maps column name to list of values. `.warnings` is populated once
+    iteration is complete.
+
+    Pass `columns` (a collection of block field names e.g. ("Id", "BlockType", "Text")) to skip decoding other
+    fields. Requesting "Geometry" selects both the BoundingBox and Polygon columns.
+    """
+    def __init__(self, fileobj, columns=None):
+        if columns is None:
+            self.columns = None
+        else:
+            self.columns = set(columns)
+            if "Geometry" in self.columns:
+                self.columns.update(GEOMETRY_COLUMNS)
+        self._lines = iter(gzip.GzipFile(fileobj=fileobj, mode="rb"))
+        try:
+            self.header = json.loads(next(self._lines))
+        except StopIteration:
+            raise MalformedCompactResult("Compact result file is empty")
+        if self.header.get("Format") != FORMAT_NAME:
+            raise MalformedCompactResult(f"Not a {FORMAT_NAME} file: Got Format={self.header.get('Format')}")
+        if self.header.get("Version", 0) > FORMAT_VERSION:
+            raise MalformedCompactResult(
+                f"Unsupported {FORMAT_NAME} version {self.header.get('Version')} (max {FORMAT_VERSION})"
+            )
+        self.warnings = []
+
+    def __iter__(self):
+        n_rows = None
+        group = None
+        for line in self._lines:
+            # Lines look like: ["ColumnName", ...] - so we can check the name without parsing the whole line:
+            name = line[2:line.index(b'"', 2)].decode("utf-8")
+            if name == ROWS_MARKER:
+                if group is not None:
+                    yield n_rows, group
+                n_rows = json.loads(line)[1]
+                group = {}
+            elif name == WARNINGS_MARKER:
+                self.warnings = json.loads(line)[1]
+            elif group is None:
+                raise MalformedCompactResult(f"Got column '{name}' before any {ROWS_MARKER} marker")
+            elif self.columns is None or name in self.columns:
+                group[name] = json.loads(line)[1]
+        if group is not None:
+            yield n_rows, group
+
+
+def blocks_to_columns(blocks: list) -> dict:
+    """Convert a list of Textract Block dicts to a dict of equal-length column lists"""
+    n_blocks = len(blocks)
+    columns = {}
+    for ix, block in enumerate(blocks):
+        for key, value in block.items():
+            if key == "Geometry":
+                bbox = value.get("BoundingBox")
+                polygon = value.get("Polygon")
+                if bbox is not None:
+                    _column(columns, "BoundingBox", n_blocks)[ix] = [bbox[f] for f in BOUNDING_BOX_FIELDS]
+                if polygon is not None:
+                    _column(columns, "Polygon", n_blocks)[ix] = [c for pt in polygon for c in (pt["X"], pt["Y"])]
+            else:
+                _column(columns, key, n_blocks)[ix] = value
+    return columns
+
+
+def columns_to_blocks(n_rows: int, columns: dict) -> list:
+    """Convert a dict of column lists back to a list of Textract Block dicts (omitting null fields)"""
+    blocks = [{} for _ in range(n_rows)]
+    for name, values in columns.items():
+        if name == "BoundingBox":
+            for block, bbox in zip(blocks, values):
+                if bbox is not None:
+                    block.setdefault("Geometry", {})["BoundingBox"] = dict(zip(BOUNDING_BOX_FIELDS, bbox))
+        elif name == "Polygon":
+            for block, coords in zip(blocks, values):
+                if coords is not None:
+                    block.setdefault("Geometry", {})["Polygon"] = [
+                        { "X": coords[i], "Y": coords[i + 1] } for i in range(0, len(coords), 2)
+                    ]
+        else:
+            for block, value in zip(blocks, values):
+                if value is not None:
+                    block[name] = value
+    return blocks
+
+
+def load_compact_result(fileobj, columns=None) -> dict:
+    """Load a compact-format result as a standard (AnalyzeDocument-like) Textract result dict
+
+    If `columns` is provided, blocks will only contain those fields.
+    """
+    reader = CompactResultReader(fileobj, columns=columns)
+    result = { k: v for k, v in reader.header.items() if k not in ("Format", "Version") }
+    blocks = []
+    for n_rows, group in reader:
+        blocks.extend(columns_to_blocks(n_rows, group))
+    result["Blocks"] = blocks
+    result["Warnings"] = reader.warnings
+    return result
+
+
+def _column(columns: dict, name: str, n_rows: int) -> list:
+    col = columns.get(name)
+    if col is None:
+        col = columns[name] = [None] * n_rows
+    return col
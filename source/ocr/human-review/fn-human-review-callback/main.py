@@ -2,7 +2,8 @@
 
 How to use:
 - Use a lambda:invoke.waitForTaskToken task Lambda to start your human loop
-- Add a `taskToken` field to your task input when starting the loop, containing your SFn token
+- Add a `taskToken` field to your task input when starting the loop, containing your SFn token (or for a batch of
+  documents in one loop, a `documents` list of such inputs)
 - Use an S3 subscription to trigger this Lambda when objects are created in your A2I output bucket
 
 This function hard-codes the expected structure of the task (receipt capture) to simplify results for output
@@ -10,15 +11,43 @@ back to Step Functions - so you'll need to modify it if changing task.
 """
 
 # Python Built-Ins:
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
 import sys
+import traceback
 
 # External Dependencies:
 import boto3
+from botocore.config import Config as BotoConfig
+from expiringdict import ExpiringDict
 
-s3 = boto3.resource("s3")
-sfn = boto3.client("stepfunctions")
+# Local Dependencies:
+from review_store import ReviewResultStore
+
+max_workers = int(os.environ.get("CALLBACK_MAX_WORKERS", 8))
+
+# (Clients rather than resources, because they're thread-safe - with a connection per worker thread)
+s3 = boto3.client("s3", config=BotoConfig(max_pool_connections=max(10, max_workers)))
+sfn = boto3.client("stepfunctions", config=BotoConfig(max_pool_connections=max(10, max_workers)))
+
+review_results_table_name = os.environ.get("REVIEW_RESULTS_TABLE_NAME")
+review_store = ReviewResultStore(
+    boto3.client("dynamodb", config=BotoConfig(max_pool_connections=max(10, max_workers))),
+    review_results_table_name,
+) if review_results_table_name else None
+
+executor = ThreadPoolExecutor(max_workers=max_workers)
+
+# S3 notifications are delivered at-least-once (and whole batches are retried if we report a failure), so we
+# remember recently processed objects and signalled task tokens while the Lambda is warm - to avoid signalling the
+# same task twice. Across containers, Step Functions rejects repeat signals with TaskTimedOut, which we treat as
+# "already done".
+processed_objects = ExpiringDict(max_len=10000, max_age_seconds=60 * 60)
+signalled_tokens = ExpiringDict(max_len=10000, max_age_seconds=60 * 60)
+
+# Result fields in our task template (with lowercase names in the A2I task input and answer):
+REVIEW_FIELDS = ("Date", "Total", "Vendor")
 
 
 class ReviewFailed(ValueError):
@@ -29,6 +58,10 @@ class MalformedReviewResponse(ValueError):
     """Returned to SFN when review cycle completed with bad output format (e.g. incompatible workflow?)"""
     pass
 
+class PartialBatchFailure(RuntimeError):
+    """Raised after processing a batch in which some records failed, so the (idempotent) batch is retried"""
+    pass
+
 
 def handler(event, context):
     """S3 bucket subscription Lambda to pick up and continue processing flow for A2I review results
@@ -37,65 +70,210 @@ def handler(event, context):
 
     Input events should be formatted as per S3 notifications - described here:
     https://docs.aws.amazon.com/lambda/latest/dg/with-s3.html
+
+    Records are processed concurrently, and independently: If any fail (e.g. S3 or Step Functions errors), the
+    others are still processed before raising a PartialBatchFailure listing the failed objects.
     """
     # Notifications come through in batches
+    records = []
+    batch_keys = set()
+    counts = {}
     for record in event["Records"]:
-        timestamp = record["eventTime"]
-        bucket = record["s3"]["bucket"]["name"]
-        key = record["s3"]["object"]["key"]
-        if key.endswith(".json"):
-            print(f"Processing {timestamp} | s3://{bucket}/{key}")
-        else:
-            print(f"Skipping (not .json) {timestamp} | s3://{bucket}/{key}")
+        object_id = record_object_id(record)
+        if object_id in batch_keys:
+            print(f"Skipping duplicate record in batch | {object_id}")
+            counts["Duplicate"] = counts.get("Duplicate", 0) + 1
             continue
+        batch_keys.add(object_id)
+        records.append(record)
 
-        # Need to load the result file to extract the Step Functions task token:
-        result_response = s3.Object(bucket, key).get()
-        result = json.loads(result_response["Body"].read())
-
-        task_token = result["inputContent"].get("taskToken")
-        if not task_token:
-            print(f"WARNING: Missing task token, ignoring result")
-            continue
+    futures = [executor.submit(process_record, record) for record in records]
+    failures = []
+    for record, future in zip(records, futures):
         try:
-            if not len(result.get("humanAnswers", [])):
-                raise ReviewFailed("A2I review finished with no human responses")
-
-            # We'll assume you're only using 1-fold review in this example:
-            human_answer = result["humanAnswers"][0]
-            date = human_answer["answerContent"]["date"]
-            total = human_answer["answerContent"]["total"]
-            vendor = human_answer["answerContent"]["vendor"]
-            worker_id = human_answer["workerId"]
-
-            sfn.send_task_success(
-                taskToken=task_token,
-                output=json.dumps({
-                    "Date": date,
-                    "Total": total,
-                    "Vendor": vendor,
-                    "WorkerId": worker_id,
-                }),
-            )
-            print("Notified task complete")
-        except KeyError as ke:
-            sfn.send_task_failure(
-                taskToken=task_token,
-                error="MalformedReviewResponse",
-                cause=f"Missing field: {str(ke)}",
-            )
-            print("Notified task failed")
+            statuses = future.result()
         except Exception as e:
-            # Like the default direct-to-Lambda integration, we'll return the Python exception type name
-            # and the message:
-            sfn.send_task_failure(
-                taskToken=task_token,
-                error=type(e).__name__,
-                cause=str(e),
-            )
-            print("Notified task failed")
+            traceback.print_exc()
+            failures.append({ "Object": record_object_id(record), "Error": f"{type(e).__name__}: {e}" })
+            statuses = ["Errored"]
+        for status in statuses:
+            counts[status] = counts.get(status, 0) + 1
+    print(f"Processed {len(event['Records'])} records: {counts}")
 
+    if len(failures):
+        raise PartialBatchFailure(f"Failed to process {len(failures)} of {len(records)} records: {failures}")
     return {
         "statusCode": 200,
-        "body": json.dumps("Success"),
+        "body": json.dumps({ "Message": "Success", "Counts": counts }),
     }
+
+
+def record_object_id(record: dict) -> str:
+    """Identify the S3 object *version* a notification record refers to"""
+    s3_info = record["s3"]
+    # (The sequencer distinguishes successive writes to the same key)
+    return "s3://{}/{}#{}".format(
+        s3_info["bucket"]["name"],
+        s3_info["object"]["key"],
+        s3_info["object"].get("sequencer", ""),
+    )
+
+
+def process_record(record: dict) -> list:
+    """Process one S3 notification record, signalling its Step Functions task(s): Returns a list of statuses
+
+    Results of batched reviews (with the `documents` input generated by fn-start-human-review when batching) signal
+    one task per document, with each document's answers suffixed by its index in the batch (e.g. `date-0`).
+
+    Raises errors (e.g. failing to read S3 or call Step Functions) for the batch to be retried.
+    """
+    timestamp = record["eventTime"]
+    bucket = record["s3"]["bucket"]["name"]
+    key = record["s3"]["object"]["key"]
+    if not key.endswith(".json"):
+        print(f"Skipping (not .json) {timestamp} | s3://{bucket}/{key}")
+        return ["Skipped"]
+    object_id = record_object_id(record)
+    if processed_objects.get(object_id):
+        print(f"Skipping (already processed) {timestamp} | s3://{bucket}/{key}")
+        return ["Duplicate"]
+    print(f"Processing {timestamp} | s3://{bucket}/{key}")
+
+    # Need to load the result file to extract the Step Functions task token:
+    result_response = s3.get_object(Bucket=bucket, Key=key)
+    result = json.loads(result_response["Body"].read())
+
+    input_content = result["inputContent"]
+    if "documents" in input_content:
+        tasks = [(ix, doc, f"-{ix}") for ix, doc in enumerate(input_content["documents"])]
+    else:
+        tasks = [(0, input_content, "")]
+    # (Fixed for a given result file, so re-processing it records reviews under the same keys)
+    result_modified = result_response["LastModified"].isoformat()
+    statuses = [
+        signal_document(
+            task_input,
+            result,
+            answer_suffix,
+            f"s3://{bucket}/{key}",
+            document_index,
+            result_modified=result_modified,
+        )
+        for document_index, task_input, answer_suffix in tasks
+    ]
+    processed_objects[object_id] = True
+    return statuses
+
+
+def signal_document(
+    task_input: dict,
+    result: dict,
+    answer_suffix: str,
+    result_uri: str,
+    document_index: int=0,
+    result_modified: str="",
+) -> str:
+    """Signal the Step Functions task for one reviewed document (unless already done): Returns the status string
+
+    Successful reviews are also recorded in the review result store (if configured) - even if the task was already
+    signalled, in case a previous attempt failed before recording. The warm duplicate check is only marked once both
+    steps succeed. Reviews are recorded under the reviewer's `submissionTime`, or else `result_modified` (the ISO
+    LastModified time of the result file).
+    """
+    human_answers = result.get("humanAnswers", [])
+    task_token = task_input.get("taskToken")
+    if not task_token:
+        print(f"WARNING: Missing task token, ignoring result for {task_input.get('taskObject')} in {result_uri}")
+        return "NoToken"
+    if signalled_tokens.get(task_token):
+        print(f"Skipping (task already signalled) {task_input.get('taskObject')} in {result_uri}")
+        return "Duplicate"
+
+    try:
+        status = signal_task(task_token, task_input, human_answers, answer_suffix)
+    except sfn.exceptions.TaskTimedOut:
+        # The task is no longer waiting: Most likely another invocation already signalled it
+        print(
+            f"Task for {task_input.get('taskObject')} in {result_uri} already closed (TaskTimedOut): "
+            "Treating as duplicate"
+        )
+        status = "Duplicate"
+
+    if review_store is not None and status != "Failed":
+        try:
+            output = merge_review_answer(task_input, human_answers[0]["answerContent"], answer_suffix)
+            output["WorkerId"] = human_answers[0]["workerId"]
+        except (IndexError, KeyError):
+            output = None  # (Task already failed as malformed by an earlier attempt)
+        if output is not None:
+            is_new = review_store.record(
+                task_input,
+                output,
+                REVIEW_FIELDS,
+                human_loop_name=result.get("humanLoopName", ""),
+                submitted_at=human_answers[0].get("submissionTime") or result_modified,
+                result_uri=result_uri,
+                document_index=document_index,
+            )
+            if not is_new:
+                print(f"Review of {task_input.get('taskObject')} in {result_uri} already recorded")
+    # Only remember the token once the review is also recorded: If recording fails, a retry must get this far again
+    signalled_tokens[task_token] = True
+    return status
+
+
+def merge_review_answer(task_input: dict, answer_content: dict, answer_suffix: str="") -> dict:
+    """Combine reviewer answers for the fields sent for review, with the model's values for the rest
+
+    Fields are only taken from the model if the task input explicitly marks them as not for review (`review`
+    false), so results of tasks that reviewed every field are handled as before. Returns a dict of output field
+    values plus the list of `ReviewedFields`.
+    """
+    output = {}
+    reviewed_fields = []
+    for field_name in REVIEW_FIELDS:
+        field_input = task_input.get(field_name.lower()) or {}
+        if field_input.get("review", True):
+            output[field_name] = answer_content[field_name.lower() + answer_suffix]
+            reviewed_fields.append(field_name)
+        else:
+            output[field_name] = field_input["value"]
+    output["ReviewedFields"] = reviewed_fields
+    return output
+
+
+def signal_task(task_token: str, task_input: dict, human_answers: list, answer_suffix: str="") -> str:
+    """Send a task success or failure to Step Functions for a document's A2I answers: Returns the status string"""
+    try:
+        if not len(human_answers):
+            raise ReviewFailed("A2I review finished with no human responses")
+
+        # We'll assume you're only using 1-fold review in this example:
+        human_answer = human_answers[0]
+        output = merge_review_answer(task_input, human_answer["answerContent"], answer_suffix)
+        output["WorkerId"] = human_answer["workerId"]
+    except KeyError as ke:
+        sfn.send_task_failure(
+            taskToken=task_token,
+            error="MalformedReviewResponse",
+            cause=f"Missing field: {str(ke)}",
+        )
+        print("Notified task failed")
+        return "Failed"
+    except Exception as e:
+        # Like the default direct-to-Lambda integration, we'll return the Python exception type name
+        # and the message:
+        sfn.send_task_failure(
+            taskToken=task_token,
+            error=type(e).__name__,
+            cause=str(e),
+        )
+        print("Notified task failed")
+        return "Failed"
+
+    sfn.send_task_success(
+        taskToken=task_token,
+        output=json.dumps(output),
+    )
+    print("Notified task complete")
+    return "Succeeded"
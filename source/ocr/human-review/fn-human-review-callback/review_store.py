@@ -0,0 +1,195 @@
+"""Append-only DynamoDB store of human review results, indexed for bulk queries and training data export
+
+A2I writes each completed review as a JSON file in the reviews bucket, which expires after a few days - and even
+while it exists, finding e.g. "all corrections to vendor X this month" would mean listing and reading every file.
+The callback function instead records one compact item per reviewed document:
+
+- Keyed by the document's `SourceUri`, with a `ReviewedAt` range key (the ISO submission timestamp, suffixed with
+  the human loop name and document index for uniqueness) - so repeat reviews of a document are kept side by side.
+- With the final field `Values`, and the model's `ModelValues` and `ModelConfidence` alongside, plus which fields
+  were `ReviewedFields` and which actually `CorrectedFields` (changed by the reviewer).
+- Indexed by `WorkerId` (`ByWorker`), normalized vendor name `VendorKey` (`ByVendor`) and `ReviewMonth`
+  (`ByMonth`, "YYYY-MM"): All with `ReviewedAt` as range key, so any of them can be narrowed by date.
+
+Items are written with a condition that they don't already exist, so re-processing a result (e.g. on a retried
+notification) never duplicates or overwrites it.
+
+Uses a DynamoDB *client* (rather than resource), because it's thread-safe.
+"""
+
+# Python Built-Ins:
+from decimal import Decimal
+import json
+import re
+
+# External Dependencies:
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+INDEX_BY_WORKER = "ByWorker"
+INDEX_BY_VENDOR = "ByVendor"
+INDEX_BY_MONTH = "ByMonth"
+
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+
+def vendor_key(vendor: str) -> str:
+    """Normalize a vendor name for indexing (case- and whitespace-insensitive)"""
+    return re.sub(r"\s+", " ", (vendor or "").strip().lower())
+
+
+class ReviewResultStore:
+    """Record and query human review results
+
+    Parameters
+    ----------
+    dynamodb_client :
+        boto3 DynamoDB client
+    table_name :
+        Name of the table, with hash key `SourceUri`, range key `ReviewedAt`, and the indexes described above
+    """
+    def __init__(self, dynamodb_client, table_name: str):
+        self.dynamodb = dynamodb_client
+        self.table_name = table_name
+
+    def record(
+        self,
+        task_input: dict,
+        output: dict,
+        review_fields: tuple,
+        human_loop_name: str="",
+        submitted_at: str="",
+        result_uri: str="",
+        document_index: int=0,
+    ) -> bool:
+        """Record one document's review: Returns False if it was already recorded
+
+        Parameters
+        ----------
+        task_input :
+            The document's A2I task input (with `taskObject` URI, and model `value` and `confidence` per field)
+        output :
+            The merged review output (final values per field, `ReviewedFields` and `WorkerId`)
+        review_fields :
+            Names of the result fields (lowercase in `task_input`)
+        human_loop_name :
+            Name of the A2I human loop
+        submitted_at :
+            ISO timestamp of the reviewer's submission. Required: It's part of the item key, so must be the same
+            every time a given review is (re-)recorded - e.g. the A2I output object's LastModified time, if the
+            result doesn't include a `submissionTime`
+        result_uri :
+            S3 URI of the A2I output file
+        document_index :
+            Index of the document in a batched review loop
+        """
+        if not submitted_at:
+            raise ValueError("Review submission time is required, so re-recording a review can't duplicate it")
+        reviewed_at = submitted_at
+        model_values = {}
+        model_confidence = {}
+        for field_name in review_fields:
+            field_input = task_input.get(field_name.lower()) or {}
+            model_values[field_name] = field_input.get("value", "")
+            model_confidence[field_name] = Decimal(str(round(field_input.get("confidence", 0), 3)))
+        item = {
+            "SourceUri": task_input["taskObject"],
+            "ReviewedAt": f"{reviewed_at}#{human_loop_name}#{document_index}",
+            "ReviewMonth": reviewed_at[:7],
+            "Values": { f: output[f] for f in review_fields },
+            "ModelValues": model_values,
+            "ModelConfidence": model_confidence,
+            "ReviewedFields": output.get("ReviewedFields", list(review_fields)),
+            "CorrectedFields": [f for f in review_fields if output[f] != model_values[f]],
+            "HumanLoopName": human_loop_name,
+            "ResultUri": result_uri,
+        }
+        # (Index key attributes can't be empty strings, so are omitted when blank)
+        if output.get("WorkerId"):
+            item["WorkerId"] = output["WorkerId"]
+        if vendor_key(output.get("Vendor")):
+            item["VendorKey"] = vendor_key(output.get("Vendor"))
+
+        try:
+            self.dynamodb.put_item(
+                TableName=self.table_name,
+                Item={ k: serializer.serialize(v) for k, v in item.items() },
+                ConditionExpression="attribute_not_exists(SourceUri)",
+            )
+            return True
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def query(
+        self,
+        key_name: str,
+        key_value: str,
+        index_name: str=None,
+        reviewed_prefix: str=None,
+        reviewed_from: str=None,
+        reviewed_to: str=None,
+        corrected_only: bool=False,
+    ):
+        """Iterate over review results matching `key_name` = `key_value` (in the table, or `index_name`)
+
+        Parameters
+        ----------
+        reviewed_prefix :
+            Optional prefix of the `ReviewedAt` timestamp to match, e.g. "2021-06" for June 2021
+        reviewed_from :
+            Optional earliest `ReviewedAt` timestamp (inclusive, used with `reviewed_to`)
+        reviewed_to :
+            Optional latest `ReviewedAt` timestamp (inclusive, used with `reviewed_from`)
+        corrected_only :
+            Set True to only return results where the reviewer changed some field
+        """
+        key_condition = "#key = :key"
+        values = { ":key": key_value }
+        if reviewed_prefix:
+            key_condition += " AND begins_with(ReviewedAt, :prefix)"
+            values[":prefix"] = reviewed_prefix
+        elif reviewed_from or reviewed_to:
+            key_condition += " AND ReviewedAt BETWEEN :from AND :to"
+            values[":from"] = reviewed_from or ""
+            values[":to"] = reviewed_to or "~"  # (Sorts after any timestamp)
+        request = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": key_condition,
+            "ExpressionAttributeNames": { "#key": key_name },
+            "ExpressionAttributeValues": { k: serializer.serialize(v) for k, v in values.items() },
+        }
+        if index_name:
+            request["IndexName"] = index_name
+        if corrected_only:
+            request["FilterExpression"] = "size(CorrectedFields) > :zero"
+            request["ExpressionAttributeValues"][":zero"] = serializer.serialize(0)
+
+        for page in self.dynamodb.get_paginator("query").paginate(**request):
+            for raw_item in page["Items"]:
+                yield { k: deserializer.deserialize(v) for k, v in raw_item.items() }
+
+    def by_source(self, source_uri: str, **kwargs):
+        return self.query("SourceUri", source_uri, **kwargs)
+
+    def by_worker(self, worker_id: str, **kwargs):
+        return self.query("WorkerId", worker_id, index_name=INDEX_BY_WORKER, **kwargs)
+
+    def by_vendor(self, vendor: str, **kwargs):
+        return self.query("VendorKey", vendor_key(vendor), index_name=INDEX_BY_VENDOR, **kwargs)
+
+    def by_month(self, month: str, **kwargs):
+        """Iterate over results reviewed in `month` ("YYYY-MM")"""
+        return self.query("ReviewMonth", month, index_name=INDEX_BY_MONTH, **kwargs)
+
+
+def export_jsonl(items, fileobj) -> int:
+    """Write review results (e.g. from a `ReviewResultStore` query) to `fileobj` as JSON Lines: Returns the count
+
+    Each line is one review result item: For training, the document `SourceUri` and its final field `Values`.
+    """
+    count = 0
+    for item in items:
+        fileobj.write(json.dumps(item, default=lambda o: float(o) if isinstance(o, Decimal) else str(o)))
+        fileobj.write("\n")
+        count += 1
+    return count
@@ -5,6 +5,11 @@ Should be called as an *asynchronous* task from Step Functions (using lambda:inv
 By passing the Step Functions task token to the A2I task as input, we ensure it gets included in the output
 JSON generated by the task and therefore enable our S3-triggered callback function to retrieve the task token
 and signal to Step Functions that the review is complete.
+
+When batching is enabled (by configuring a batch review flow, see README), documents are instead queued and
+reviewed several to a loop: With the task inputs (and therefore tokens) of all the documents in the batch nested
+under the loop's `documents` input. The function is also invoked on a schedule (with `{ "Action":
+"FlushReviewBatches" }`) to start loops for partial batches that have waited long enough.
 """
 
 # Python Built-Ins:
@@ -12,16 +17,37 @@ from datetime import datetime
 import json
 import os
 import re
+import time
+import traceback
 import uuid
 
 # External Dependencies:
 import boto3
 
+# Local Dependencies:
+from config_cache import get_parameter, refresh_parameter  # (From common layer)
+from review_queue import enqueued_time, ReviewQueue, task_input as queued_task_input
+
 
 a2i = boto3.client("sagemaker-a2i-runtime")
-ssm = boto3.client("ssm")
 
 default_flow_definition_arn_param = os.environ.get("DEFAULT_FLOW_DEFINITION_ARN_PARAM")
+batch_flow_definition_arn_param = os.environ.get("BATCH_FLOW_DEFINITION_ARN_PARAM")
+review_batch_size = int(os.environ.get("REVIEW_BATCH_SIZE", 10))
+review_batch_window_seconds = float(os.environ.get("REVIEW_BATCH_WINDOW_SECONDS", 120))
+
+review_queue_table_name = os.environ.get("REVIEW_QUEUE_TABLE_NAME")
+review_queue = (
+    ReviewQueue(boto3.resource("dynamodb").Table(review_queue_table_name)) if review_queue_table_name else None
+)
+
+# Model result fields our task template can review:
+REVIEW_FIELDS = ("Date", "Total", "Vendor")
+
+# Human loop name clean-up patterns, compiled once per container:
+HYPHENATED_CHARS = re.compile(r"[ _.,!?]")
+DISALLOWED_CHARS = re.compile(r"[^a-zA-Z0-9\-]")
+DOUBLE_HYPHENS = re.compile(r"--")
 
 
 class MalformedRequest(ValueError):
@@ -34,17 +60,14 @@ def generate_human_loop_name(s3_object_key: str, max_len: int=63) -> str:
     Generated names combine timestamp, object filename, and a random element.
     """
     filename = s3_object_key.rpartition("/")[2]
-    filename_component = re.sub(
+    filename_component = DOUBLE_HYPHENS.sub(
         # Condense double-hyphens:
-        r"--",
         "-",
-        re.sub(
+        DISALLOWED_CHARS.sub(
             # Cut out any remaining disallowed characters:
-            r"[^a-zA-Z0-9\-]",
             "",
-            re.sub(
+            HYPHENATED_CHARS.sub(
                 # Turn significant punctuation to hyphens:
-                r"[ _.,!?]",
                 "-",
                 filename
             )
@@ -59,7 +82,24 @@ def generate_human_loop_name(s3_object_key: str, max_len: int=63) -> str:
     return f"{datetime_component}-{clipped_filename_component}-{random_component}"[:max_len]
 
 
+def is_configured(param_value: str) -> bool:
+    return bool(param_value) and param_value.lower() not in ("undefined", "null")
+
+
+def is_batching_enabled() -> bool:
+    """Batching is enabled when the queue table is set up and a batch review flow is configured in SSM"""
+    return (
+        review_queue is not None
+        and review_batch_size > 1
+        and bool(batch_flow_definition_arn_param)
+        and is_configured(get_parameter(batch_flow_definition_arn_param))
+    )
+
+
 def handler(event, context):
+    if event.get("Action") == "FlushReviewBatches":
+        return flush_review_batches()
+
     try:
         execution_context = event["ExecutionContext"]
         task_token = execution_context["Task"]["Token"]
@@ -70,59 +110,162 @@ def handler(event, context):
             srckey = event["Key"]
             srcuri = f"s3://{srcbucket}/{srckey}"
 
-        model_result = event["ModelResult"]
-        task_input = {
-            "taskObject": srcuri,
-            # Not used in A2I, purely for feed-through to our callback function:
-            "taskToken": task_token,
-            # By including our confidence scores in the task input, we open the door for custom task UIs that
-            # try to optimize reviewer time by emphasising or de-emphasising particular fields for review:
-            "date": {
-                "confidence": model_result["Date"]["Confidence"],
-                "value": model_result["Date"]["Value"],
-            },
-            "total": {
-                "confidence": model_result["Total"]["Confidence"],
-                "value": model_result["Total"]["Value"],
-            },
-            "vendor": {
-                "confidence": model_result["Vendor"]["Confidence"],
-                "value": model_result["Vendor"]["Value"],
-            },
+        task_input = build_task_input(srcuri, task_token, event["ModelResult"])
+    except KeyError as ke:
+        raise MalformedRequest(f"Missing field {ke}, please check your input payload")
+
+    if "FlowDefinitionArn" in event:
+        return start_review_loop(task_input, srcuri, flow_definition_arn=event["FlowDefinitionArn"])
+    elif is_batching_enabled():
+        review_queue.enqueue(task_input)
+        print(f"Queued {srcuri} for batched review")
+        # Don't wait for the schedule if there's a full batch ready:
+        try:
+            flush_review_batches(full_only=True)
+        except Exception:
+            # This document is safely queued, so leave any failed batches for the scheduled flush to retry
+            traceback.print_exc()
+        # Doesn't really matter what we return because Step Functions will wait for the callback with the token!
+        return "Queued"
+    else:
+        return start_review_loop(task_input, srcuri, flow_param=default_flow_definition_arn_param)
+
+
+def build_task_input(srcuri: str, task_token: str, model_result: dict) -> dict:
+    # Only the fields flagged by post-processing go to the reviewer (or all of them, for older results):
+    review_fields = model_result.get("ReviewFields", REVIEW_FIELDS)
+    task_input = {
+        "taskObject": srcuri,
+        # Not used in A2I, purely for feed-through to our callback function:
+        "taskToken": task_token,
+        "reviewFields": [f.lower() for f in review_fields],
+    }
+    # By including our confidence scores in the task input, we open the door for custom task UIs that
+    # try to optimize reviewer time by emphasising or de-emphasising particular fields for review. The
+    # values of fields *not* for review are also fed through, for the callback to merge into the result:
+    for field_name in REVIEW_FIELDS:
+        task_input[field_name.lower()] = {
+            "confidence": model_result[field_name]["Confidence"],
+            "value": model_result[field_name]["Value"],
+            "review": field_name in review_fields,
         }
+    return task_input
 
 
-        if "FlowDefinitionArn" in event:
-            flow_definition_arn = event["FlowDefinitionArn"]
-        elif default_flow_definition_arn_param:
-            flow_definition_arn = ssm.get_parameter(
-                Name=default_flow_definition_arn_param,
-            )["Parameter"]["Value"]
-            if (not flow_definition_arn) or flow_definition_arn.lower() in ("undefined", "null"):
-                raise MalformedRequest(
-                    "Neither request FlowDefinitionArn nor expected SSM parameter are set. Got: "
-                    f"{default_flow_definition_arn_param} = '{flow_definition_arn}'"
-                )
-        else:
-            raise MalformedRequest(
-                "FlowDefinitionArn not specified in request and DEFAULT_FLOW_DEFINITION_ARN_PARAM "
-                "env var not set"
-            )
-    except KeyError as ke:
-        raise MalformedRequest(f"Missing field {ke}, please check your input payload")
+def get_flow_definition_arn(flow_param: str) -> str:
+    """Look up a flow definition ARN from (cached) SSM parameter `flow_param`"""
+    if not flow_param:
+        raise MalformedRequest(
+            "FlowDefinitionArn not specified in request and DEFAULT_FLOW_DEFINITION_ARN_PARAM "
+            "env var not set"
+        )
+    flow_definition_arn = get_parameter(flow_param)
+    if not is_configured(flow_definition_arn):
+        # Maybe the parameter has been set up since we cached it:
+        flow_definition_arn = refresh_parameter(flow_param)
+    if not is_configured(flow_definition_arn):
+        raise MalformedRequest(
+            "Neither request FlowDefinitionArn nor expected SSM parameter are set. Got: "
+            f"{flow_param} = '{flow_definition_arn}'"
+        )
+    return flow_definition_arn
+
+
+def start_review_loop(
+    task_input: dict,
+    name_source: str,
+    flow_definition_arn: str=None,
+    flow_param: str=None,
+) -> str:
+    """Start an A2I human loop with `task_input`: Returns the human loop ARN
+
+    Parameters
+    ----------
+    task_input :
+        The loop's input content
+    name_source :
+        S3 URI/key to derive the (otherwise random) human loop name from
+    flow_definition_arn :
+        Explicit flow definition to use
+    flow_param :
+        Otherwise, SSM parameter to look up the flow definition from (and refresh, if the cached one is not found)
+    """
+    if not flow_definition_arn:
+        flow_definition_arn = get_flow_definition_arn(flow_param)
 
     print(f"Starting A2I human loop with input {task_input}")
-    a2i_response = a2i.start_human_loop(
-        HumanLoopName=generate_human_loop_name(srcuri),
-        FlowDefinitionArn=flow_definition_arn,
-        HumanLoopInput={
-            "InputContent": json.dumps(task_input)
-        },
-        DataAttributes={
-            "ContentClassifiers": ["FreeOfPersonallyIdentifiableInformation"]
-        }
-    )
+    try:
+        a2i_response = a2i.start_human_loop(
+            HumanLoopName=generate_human_loop_name(name_source),
+            FlowDefinitionArn=flow_definition_arn,
+            HumanLoopInput={
+                "InputContent": json.dumps(task_input)
+            },
+            DataAttributes={
+                "ContentClassifiers": ["FreeOfPersonallyIdentifiableInformation"]
+            }
+        )
+    except a2i.exceptions.ResourceNotFoundException:
+        if flow_param:
+            # The parameter may have been updated to a new flow definition since we cached it:
+            refreshed_flow_arn = refresh_parameter(flow_param)
+            if refreshed_flow_arn != flow_definition_arn and is_configured(refreshed_flow_arn):
+                print(f"Flow {flow_definition_arn} not found: Retrying with updated flow {refreshed_flow_arn}")
+                return start_review_loop(task_input, name_source, flow_definition_arn=refreshed_flow_arn)
+        raise
     print(f"Human loop started: {a2i_response}")
-
-    # Doesn't really matter what we return because Step Functions will wait for the callback with the token!
     return a2i_response["HumanLoopArn"]
+
+
+def flush_review_batches(full_only: bool=False) -> dict:
+    """Start review loops for queued documents: Returns counts of `Loops` started and `Documents` sent
+
+    Every full batch is started, plus (unless `full_only`) a final partial batch if its oldest document has waited
+    longer than the batch window.
+    """
+    counts = { "Loops": 0, "Documents": 0 }
+    if review_queue is None:
+        return counts
+    while True:
+        items = review_queue.pending(review_batch_size)
+        if not len(items):
+            break
+        is_full = len(items) >= review_batch_size
+        if not is_full and (
+            full_only or time.time() - enqueued_time(items[0]) < review_batch_window_seconds
+        ):
+            break
+        claimed = review_queue.claim(items)
+        if len(claimed):
+            counts["Loops"] += start_review_batch(claimed)
+            counts["Documents"] += len(claimed)
+        if not is_full:
+            break
+    if counts["Loops"]:
+        print(f"Flushed review batches: {counts}")
+    return counts
+
+
+def start_review_batch(items: list) -> int:
+    """Start review for claimed queue `items`, putting them back if that fails: Returns number of loops started"""
+    task_inputs = [queued_task_input(item) for item in items]
+    if is_batching_enabled():
+        try:
+            start_review_loop(
+                { "documents": task_inputs },
+                task_inputs[0]["taskObject"],
+                flow_param=batch_flow_definition_arn_param,
+            )
+        except Exception:
+            review_queue.requeue(items)
+            raise
+        return 1
+    else:
+        # Batching has been switched off since these were queued: Review them individually instead
+        for ix, task_input in enumerate(task_inputs):
+            try:
+                start_review_loop(task_input, task_input["taskObject"], flow_param=default_flow_definition_arn_param)
+            except Exception:
+                review_queue.requeue(items[ix:])
+                raise
+        return len(task_inputs)
@@ -0,0 +1,85 @@
+"""DynamoDB queue of documents awaiting a batched human review
+
+Starting an A2I human loop per document adds per-task overhead for reviewers, and bursts of low-confidence
+documents can exceed the human loop start rate. When batching is enabled, documents (with their Step Functions task
+tokens) are instead enqueued here, and flushed into one loop per batch once enough have collected or the oldest has
+waited long enough.
+
+All pending items share one partition (`QueueId` = `PENDING_QUEUE_ID`), sorted by enqueue time (`EnqueuedAt`),
+so the oldest documents can be fetched with a single query. Flushers **claim** items by conditionally deleting them
+before starting a loop - so concurrent flushes never review the same document twice - and put them back if the loop
+can't be started. Items expire (`ExpiresAt`) after the review task would have timed out anyway.
+"""
+
+# Python Built-Ins:
+import json
+import time
+import uuid
+
+PENDING_QUEUE_ID = "Pending"
+DEFAULT_EXPIRY_SECONDS = 2 * 60 * 60  # Comfortably longer than the Step Functions review task timeout
+
+
+class ReviewQueue:
+    """Enqueue, list and claim pending review task inputs
+
+    Parameters
+    ----------
+    table :
+        boto3 DynamoDB Table resource with hash key `QueueId` and range key `EnqueuedAt` (and TTL on `ExpiresAt`)
+    expiry_seconds :
+        How long pending items are kept before expiring
+    """
+    def __init__(self, table, expiry_seconds: int=DEFAULT_EXPIRY_SECONDS):
+        self.table = table
+        self.expiry_seconds = expiry_seconds
+        self.exceptions = table.meta.client.exceptions
+
+    def enqueue(self, task_input: dict):
+        now = time.time()
+        self.table.put_item(Item={
+            "QueueId": PENDING_QUEUE_ID,
+            # (Zero-padded so string order is time order, with a random suffix for uniqueness)
+            "EnqueuedAt": "{:017.6f}#{}".format(now, uuid.uuid4().hex),
+            # (Stored as a JSON string, because DynamoDB doesn't accept the float confidence scores)
+            "TaskInput": json.dumps(task_input),
+            "ExpiresAt": int(now) + self.expiry_seconds,
+        })
+
+    def pending(self, limit: int) -> list:
+        """Fetch up to `limit` of the oldest pending items (not yet claimed)"""
+        response = self.table.query(
+            KeyConditionExpression="QueueId = :queue_id",
+            ExpressionAttributeValues={ ":queue_id": PENDING_QUEUE_ID },
+            ConsistentRead=True,
+            Limit=limit,
+        )
+        return response["Items"]
+
+    def claim(self, items: list) -> list:
+        """Claim `items` for review: Returns the list of those claimed (i.e. not already claimed by others)"""
+        claimed = []
+        for item in items:
+            try:
+                self.table.delete_item(
+                    Key={ "QueueId": item["QueueId"], "EnqueuedAt": item["EnqueuedAt"] },
+                    ConditionExpression="attribute_exists(QueueId)",
+                )
+                claimed.append(item)
+            except self.exceptions.ConditionalCheckFailedException:
+                pass
+        return claimed
+
+    def requeue(self, items: list):
+        """Return claimed items to the queue (in their original positions), e.g. after failing to start a loop"""
+        with self.table.batch_writer() as batch:
+            for item in items:
+                batch.put_item(Item=item)
+
+
+def enqueued_time(item: dict) -> float:
+    return float(item["EnqueuedAt"].partition("#")[0])
+
+
+def task_input(item: dict) -> dict:
+    return json.loads(item["TaskInput"])
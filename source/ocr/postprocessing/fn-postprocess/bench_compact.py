@@ -0,0 +1,82 @@
+"""Compare the compact and standard JSON formats for raw Textract results: Size, and time to load for post-processing
+
+Uses the same synthetic multi-page FORMS results as `bench_pages.py`, and for each page count reports:
+
+- The size of the standard JSON result (as saved by the Textract integration), gzipped JSON for reference, and
+  the `textract_compact` format
+- Time to load the JSON result (`json.loads`), and the compact result - both in full, and with only the
+  `INDEX_COLUMNS` this function actually reads (which skips decoding the geometry)
+
+Run as a script, e.g.:
+
+    python bench_compact.py --pages 1 10 50 200
+"""
+
+# Python Built-Ins:
+import argparse
+import gzip
+import io
+import json
+
+# Local Dependencies:
+from bench_pages import best_of, load_modules, make_result
+
+
+def to_compact(result: dict, blocks_per_group: int=1000) -> bytes:
+    """Write `result` in compact format, in row groups of Textract's maximum results page size"""
+    from textract_compact import CompactResultWriter
+
+    buffer = io.BytesIO()
+    with CompactResultWriter(buffer) as writer:
+        writer.write_header({ k: v for k, v in result.items() if k != "Blocks" })
+        for ix in range(0, len(result["Blocks"]), blocks_per_group):
+            writer.write_blocks(result["Blocks"][ix:ix + blocks_per_group])
+    return buffer.getvalue()
+
+
+def run(args) -> list:
+    load_modules()  # (Just to make the function & common layer importable)
+    from block_index import INDEX_COLUMNS
+    from textract_compact import load_compact_result
+
+    rows = []
+    print("Pages  JSON MB  JSON.gz MB  Compact MB  Ratio  JSON load s  Compact load s  Compact index cols s")
+    for n_pages in args.pages:
+        result = make_result(n_pages)
+        raw_json = json.dumps(result).encode("utf-8")
+        raw_compact = to_compact(result)
+        json_gz_bytes = len(gzip.compress(raw_json, compresslevel=6))
+        json_s, loaded = best_of(args.repeats, lambda: json.loads(raw_json))
+        compact_s, loaded_compact = best_of(args.repeats, lambda: load_compact_result(io.BytesIO(raw_compact)))
+        assert loaded_compact["Blocks"] == loaded["Blocks"], "Compact result didn't round-trip"
+        columns_s, _ = best_of(
+            args.repeats,
+            lambda: load_compact_result(io.BytesIO(raw_compact), columns=INDEX_COLUMNS),
+        )
+        row = {
+            "Pages": n_pages,
+            "JsonBytes": len(raw_json),
+            "JsonGzipBytes": json_gz_bytes,
+            "CompactBytes": len(raw_compact),
+            "JsonLoadSeconds": json_s,
+            "CompactLoadSeconds": compact_s,
+            "CompactIndexColumnsLoadSeconds": columns_s,
+        }
+        rows.append(row)
+        print(
+            f"{n_pages:5}  {len(raw_json) / 1024 / 1024:7.2f}  {json_gz_bytes / 1024 / 1024:10.2f}  "
+            f"{len(raw_compact) / 1024 / 1024:10.2f}  {len(raw_json) / len(raw_compact):5.1f}  "
+            f"{json_s:11.3f}  {compact_s:14.3f}  {columns_s:20.3f}"
+        )
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare size and load time of compact vs JSON Textract results")
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 10, 50, 200], help="Page counts to measure")
+    parser.add_argument("--repeats", type=int, default=3, help="Report the best of this many runs per measurement")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,220 @@
+"""Measure the accuracy (and speed) of the local date and amount recognizers, optionally against Comprehend
+
+Runs `local_entities.detect_dates()` over labelled receipt texts and `local_entities.parse_amount()` over labelled
+total amount values, and reports how often the top date candidate (as selected by the pipeline) and the parsed
+amount match the labels - including for documents with *no* date, where any candidate is a false positive.
+
+Labelled documents are read from a JSON-lines file (`--corpus`), one document per line:
+
+    {"Lines": ["ACME STORE", "21/06/2018 18:54", ...], "Date": "21/06/2018 18:54", "Total": "$4.60", "TotalValue": 4.6}
+
+...with `Date` null if the document has no date, and `TotalValue` null if `Total` isn't a valid amount. Lines
+may also be { "Text", "Confidence" } objects, as in Textract LINE blocks. Without `--corpus`, a synthetic corpus
+is generated from the date and amount formats below (including some the local patterns deliberately don't cover,
+and date-like decoys such as phone numbers).
+
+With `--comprehend`, each document's text is also sent to Amazon Comprehend DetectEntities (needs AWS
+credentials, and costs a call per document), to compare with the fallback this function used to rely on.
+
+    python bench_entities.py
+    python bench_entities.py --corpus labelled.jsonl --comprehend
+"""
+
+# Python Built-Ins:
+import argparse
+from collections import Counter
+import json
+import os
+import random
+import time
+
+# Local Dependencies:
+from bench_pages import load_modules
+
+MONTHS = ("January", "February", "March", "April", "May", "June", "July", "August", "September", "October",
+    "November", "December")
+
+# Date formats as (name, function of (rand, year, month, day) -> text). Those marked "unsupported" aren't covered
+# by the local patterns, so documents using them should fall through to Comprehend:
+DATE_FORMATS = (
+    ("d/m/Y", lambda r, y, m, d: f"{d:02}/{m:02}/{y}"),
+    ("m/d/y", lambda r, y, m, d: f"{m:02}/{d:02}/{y % 100:02}"),
+    ("Y-m-d H:M", lambda r, y, m, d: f"{y}-{m:02}-{d:02} {r.randrange(24):02}:{r.randrange(60):02}"),
+    ("d.m.Y", lambda r, y, m, d: f"{d}.{m}.{y}"),
+    ("d Mon Y", lambda r, y, m, d: f"{d} {MONTHS[m - 1][:3]} {y}"),
+    ("Month d, Y", lambda r, y, m, d: f"{MONTHS[m - 1]} {d}, {y}"),
+    ("d/m/Y I:M pm", lambda r, y, m, d: f"{d}/{m}/{y} {r.randint(1, 12)}:{r.randrange(60):02} PM"),
+    ("unsupported: d Month (no year)", lambda r, y, m, d: f"{d} {MONTHS[m - 1]}"),
+    ("unsupported: YYYYMMDD", lambda r, y, m, d: f"{y}{m:02}{d:02}"),
+)
+
+# Total amount formats as (name, function of (rand, value) -> text, whether parse_amount should accept it):
+AMOUNT_FORMATS = (
+    ("$0.00", lambda r, v: f"${v:.2f}", True),
+    ("$ 0.00", lambda r, v: f"$ {v:.2f}", True),
+    ("0.00", lambda r, v: f"{v:.2f}", True),
+    ("SGD 1,000.00", lambda r, v: f"SGD {v:,.2f}", True),
+    ("1000.00 EUR", lambda r, v: f"{v:.2f} EUR", True),
+    ("£0.00", lambda r, v: f"£{v:.2f}", True),
+    ("-$0.00", lambda r, v: f"-${v:.2f}", True),
+    ("unsupported: 0,00 €", lambda r, v: f"{v:.2f} €".replace(".", ","), True),
+    ("not an amount: 2 items", lambda r, v: f"{r.randint(2, 9)} items", False),
+)
+
+# Receipt lines which contain digits but no date, to check for false positives:
+DECOY_LINES = (
+    lambda r: f"Tel: {r.randint(200, 999)}-{r.randint(200, 999)}-{r.randint(1000, 9999)}",
+    lambda r: f"Ref {r.randint(10, 99)}/{r.randint(100, 999)}/{r.randint(100, 999)}",
+    lambda r: f"Table {r.randint(1, 40)}  Covers {r.randint(1, 8)}",
+    lambda r: f"{r.randint(1, 5)} x Coffee {r.randint(2, 6)}.{r.randrange(100):02}",
+    lambda r: f"Card ****{r.randint(1000, 9999)}  Auth {r.randint(100000, 999999)}",
+)
+
+
+def synthetic_corpus(n_docs: int, seed: int=0):
+    """Yield labelled synthetic receipt documents, as parsed `--corpus` lines"""
+    rand = random.Random(seed)
+    for ix in range(n_docs):
+        year, month, day = rand.randint(2015, 2023), rand.randint(1, 12), rand.randint(1, 28)
+        has_date = ix % 8 != 0  # Some receipts have no date at all
+        date_format, date_fn = DATE_FORMATS[ix % len(DATE_FORMATS)]
+        amount_format, amount_fn, amount_valid = AMOUNT_FORMATS[ix % len(AMOUNT_FORMATS)]
+        value = round(rand.uniform(1, 3000), 2)
+        date_text = date_fn(rand, year, month, day) if has_date else None
+        lines = ["ACME Convenience Store", f"{rand.randint(1, 999)} High Street"]
+        lines += [decoy(rand) for decoy in rand.sample(DECOY_LINES, 3)]
+        if date_text:
+            lines.insert(rand.randint(1, len(lines)), f"Date: {date_text}" if rand.random() < 0.5 else date_text)
+        total_text = amount_fn(rand, value)
+        lines.append(f"TOTAL {total_text}")
+        yield {
+            "Lines": [{ "Text": text, "Confidence": rand.uniform(85, 99.9) } for text in lines],
+            "Date": date_text,
+            "DateFormat": date_format if has_date else "(no date)",
+            "Total": total_text,
+            "TotalValue": (-value if total_text.startswith("-") else value) if amount_valid else None,
+            "TotalFormat": amount_format,
+        }
+
+
+def read_corpus(path: str):
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                doc = json.loads(line)
+                doc["Lines"] = [
+                    { "Text": l, "Confidence": 99. } if isinstance(l, str) else l for l in doc["Lines"]
+                ]
+                yield doc
+
+
+def top_value(candidates: list):
+    """The value the pipeline would pick from a field's candidates (highest confidence, first if tied)"""
+    return max(candidates, key=lambda c: c["Confidence"])["Value"] if candidates else None
+
+
+def run(args) -> dict:
+    load_modules()  # (Just to make the function & common layer importable)
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")  # (Clients are created on import)
+    from block_index import Block
+    from local_entities import detect_dates, parse_amount
+    import main
+
+    comprehend = None
+    if args.comprehend:
+        import boto3
+        comprehend = boto3.client("comprehend")
+
+    docs = read_corpus(args.corpus) if args.corpus else synthetic_corpus(args.synthetic_docs, args.seed)
+    date_results = Counter()  # (method, "correct"/"wrong"/"missed"/"false positive"/"true negative") -> count
+    date_by_format = {}  # Date format -> Counter of local outcomes
+    amount_by_format = {}  # Amount format -> Counter of local outcomes
+    seconds = Counter()
+    n_docs = 0
+    for doc in docs:
+        n_docs += 1
+        lines = [
+            Block({ "Id": str(ix), "BlockType": "LINE", "Text": l["Text"], "Confidence": l["Confidence"] })
+            for ix, l in enumerate(doc["Lines"])
+        ]
+        # As in the pipeline, the first line is taken as the vendor name and not searched:
+        t_start = time.perf_counter()
+        local_date = top_value(detect_dates(lines[1:]))
+        seconds["Local"] += time.perf_counter() - t_start
+        outcome = date_outcome(local_date, doc["Date"])
+        date_results[("Local", outcome)] += 1
+        date_by_format.setdefault(doc.get("DateFormat", "-"), Counter())[outcome] += 1
+
+        if comprehend:
+            t_start = time.perf_counter()
+            entities = comprehend.detect_entities(
+                Text="".join(line.text + " " for line in lines[1:]),
+                LanguageCode="en",
+            )["Entities"]
+            seconds["Comprehend"] += time.perf_counter() - t_start
+            candidates = { "Date": [] }
+            main.add_comprehend_date_candidates(candidates, entities)
+            date_results[("Comprehend", date_outcome(top_value(candidates["Date"]), doc["Date"]))] += 1
+
+        try:
+            amount = parse_amount(doc["Total"])[0]
+        except ValueError:
+            amount = None
+        amount_by_format.setdefault(doc.get("TotalFormat", "-"), Counter())[
+            "correct" if amount == doc["TotalValue"] else "wrong"
+        ] += 1
+
+    methods = ("Local", "Comprehend") if comprehend else ("Local",)
+    stats = {
+        "Documents": n_docs,
+        "DateAccuracy": {
+            method: round(
+                (date_results[(method, "correct")] + date_results[(method, "true negative")]) / max(1, n_docs),
+                3,
+            )
+            for method in methods
+        },
+        "DateOutcomes": { f"{m}: {o}": n for (m, o), n in sorted(date_results.items()) },
+        "MsPerDocument": { method: round(1000 * seconds[method] / max(1, n_docs), 3) for method in methods },
+        "AmountAccuracy": round(
+            sum(c["correct"] for c in amount_by_format.values()) / max(1, n_docs),
+            3,
+        ),
+    }
+    if args.verbose or not args.corpus:
+        stats["LocalDateByFormat"] = { f: dict(c) for f, c in date_by_format.items() }
+        stats["AmountByFormat"] = { f: dict(c) for f, c in amount_by_format.items() }
+    print(json.dumps(stats, indent=2))
+    return stats
+
+
+def date_outcome(found, expected) -> str:
+    if expected is None:
+        return "true negative" if found is None else "false positive"
+    elif found is None:
+        return "missed"
+    # Detected values may legitimately include/exclude a trailing time, so compare on the labelled text:
+    return "correct" if found == expected or found.startswith(expected) or expected.startswith(found) else "wrong"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure local date & amount recognizer accuracy on labelled data")
+    parser.add_argument("--corpus", help="JSON-lines file of labelled documents (default: synthetic corpus)")
+    parser.add_argument(
+        "--synthetic-docs",
+        type=int,
+        default=720,
+        help="Number of documents to generate, if not using --corpus",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic corpus")
+    parser.add_argument(
+        "--comprehend",
+        action="store_true",
+        help="Also detect dates with Amazon Comprehend for comparison (needs AWS credentials)",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Break down outcomes by format for --corpus too")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(parse_args())
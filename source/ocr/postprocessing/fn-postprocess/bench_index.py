@@ -0,0 +1,79 @@
+"""Compare `block_index.BlockIndex` with the generic `trp.Document` model it replaced: Build and key lookup times
+
+Uses the same synthetic multi-page FORMS results as `bench_pages.py`, and for each page count times:
+
+- Building each document model from the (already parsed) result
+- Looking up the key-value pairs for the search terms the original post-processing used ("total", "amount" and
+  "date") - page by page with `searchFieldsByKey()` as before for trp, or `find_key_values()` for the index
+
+trp is no longer a dependency of this function, so install it just to run this comparison:
+
+    pip install textract-trp
+    python bench_index.py --pages 1 10 50 200
+"""
+
+# Python Built-Ins:
+import argparse
+
+# Local Dependencies:
+from bench_pages import best_of, load_modules, make_result
+
+SEARCH_TERMS = ("total", "amount", "date")
+
+
+def trp_lookup(doc) -> int:
+    """Search every page's form fields for each term, as the original post-processing did: Returns # matches"""
+    return sum(
+        len(page.form.searchFieldsByKey(term))
+        for page in doc.pages
+        for term in SEARCH_TERMS
+    )
+
+
+def index_lookup(index) -> int:
+    """Search the index for each term: Returns # matches"""
+    index._search_cache.clear()  # (So the index's memoized searches don't flatter it on repeats)
+    return sum(len(index.find_key_values(term)) for term in SEARCH_TERMS)
+
+
+def run(args) -> list:
+    BlockIndex, _ = load_modules()
+    try:
+        from trp import Document
+    except ImportError:
+        raise SystemExit("This comparison needs the textract-trp package: pip install textract-trp")
+
+    rows = []
+    print("Pages  trp build s  Index build s  Speed-up  trp lookup ms  Index lookup ms  Speed-up")
+    for n_pages in args.pages:
+        result = make_result(n_pages)
+        trp_build_s, doc = best_of(args.repeats, lambda: Document(result))
+        index_build_s, index = best_of(args.repeats, lambda: BlockIndex(result["Blocks"]))
+        trp_lookup_s, trp_matches = best_of(args.repeats, lambda: trp_lookup(doc))
+        index_lookup_s, index_matches = best_of(args.repeats, lambda: index_lookup(index))
+        assert trp_matches == index_matches, f"trp found {trp_matches} pairs but the index {index_matches}"
+        row = {
+            "Pages": n_pages,
+            "TrpBuildSeconds": trp_build_s,
+            "IndexBuildSeconds": index_build_s,
+            "TrpLookupSeconds": trp_lookup_s,
+            "IndexLookupSeconds": index_lookup_s,
+            "Matches": index_matches,
+        }
+        rows.append(row)
+        print(
+            f"{n_pages:5}  {trp_build_s:11.3f}  {index_build_s:13.3f}  {trp_build_s / index_build_s:7.1f}x  "
+            f"{trp_lookup_s * 1000:13.3f}  {index_lookup_s * 1000:15.3f}  {trp_lookup_s / index_lookup_s:7.0f}x"
+        )
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare BlockIndex with trp.Document build and key lookup times")
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 10, 50, 200], help="Page counts to measure")
+    parser.add_argument("--repeats", type=int, default=3, help="Report the best of this many runs per measurement")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(parse_args())
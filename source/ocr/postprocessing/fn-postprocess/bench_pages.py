@@ -0,0 +1,184 @@
+"""Measure how post-processing time scales with document page count, phase by phase
+
+Generates synthetic Textract results (with geometry, words, lines and key-value pairs on every page, like real
+FORMS analysis output) and times each phase of this function's `extract_candidates()`:
+
+- Parsing the saved JSON result
+- Building the `block_index.BlockIndex`
+- Evaluating the field rules over the index
+
+Run as a script, e.g.:
+
+    python bench_pages.py --pages 1 10 50 200 500
+"""
+
+# Python Built-Ins:
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+DEFAULT_LINES_PER_PAGE = 40
+DEFAULT_PAIRS_PER_PAGE = 12
+KEY_TEXTS = ("Date", "Invoice No", "Subtotal", "Total", "Amount Due", "Customer", "Phone", "Due Date", "Tax")
+
+
+def geometry(rand: random.Random) -> dict:
+    left, top = rand.random() * 0.9, rand.random() * 0.9
+    return {
+        "BoundingBox": { "Width": 0.1, "Height": 0.02, "Left": left, "Top": top },
+        "Polygon": [
+            { "X": left, "Y": top },
+            { "X": left + 0.1, "Y": top },
+            { "X": left + 0.1, "Y": top + 0.02 },
+            { "X": left, "Y": top + 0.02 },
+        ],
+    }
+
+
+def make_result(
+    n_pages: int,
+    lines_per_page: int=DEFAULT_LINES_PER_PAGE,
+    pairs_per_page: int=DEFAULT_PAIRS_PER_PAGE,
+    seed: int=0,
+) -> dict:
+    """Build a synthetic multi-page Textract AnalyzeDocument (FORMS) result"""
+    rand = random.Random(seed)
+    blocks = []
+    next_id = iter(range(1, 1 << 62))
+
+    def add_words(text: str, page: int) -> list:
+        words = [
+            {
+                "BlockType": "WORD",
+                "Id": f"w{next(next_id)}",
+                "Text": word,
+                "TextType": "PRINTED",
+                "Confidence": rand.uniform(60, 99.9),
+                "Geometry": geometry(rand),
+                "Page": page,
+            }
+            for word in text.split()
+        ]
+        blocks.extend(words)
+        return [w["Id"] for w in words]
+
+    for page in range(1, n_pages + 1):
+        page_block = {
+            "BlockType": "PAGE",
+            "Id": f"p{page}",
+            "Geometry": geometry(rand),
+            "Page": page,
+            "Relationships": [{ "Type": "CHILD", "Ids": [] }],
+        }
+        blocks.append(page_block)
+        for ix in range(lines_per_page):
+            text = f"Item {rand.randrange(1000)} description line {ix} {rand.randrange(100)}.{rand.randrange(100):02}"
+            line = {
+                "BlockType": "LINE",
+                "Id": f"l{next(next_id)}",
+                "Text": text,
+                "Confidence": rand.uniform(60, 99.9),
+                "Geometry": geometry(rand),
+                "Page": page,
+            }
+            blocks.append(line)
+            line["Relationships"] = [{ "Type": "CHILD", "Ids": add_words(text, page) }]
+            page_block["Relationships"][0]["Ids"].append(line["Id"])
+        for ix in range(pairs_per_page):
+            key_text = KEY_TEXTS[ix % len(KEY_TEXTS)]
+            value_text = f"${rand.randrange(1000)}.{rand.randrange(100):02}"
+            key = {
+                "BlockType": "KEY_VALUE_SET",
+                "EntityTypes": ["KEY"],
+                "Id": f"k{next(next_id)}",
+                "Confidence": rand.uniform(40, 99.9),
+                "Geometry": geometry(rand),
+                "Page": page,
+            }
+            value = {
+                "BlockType": "KEY_VALUE_SET",
+                "EntityTypes": ["VALUE"],
+                "Id": f"v{next(next_id)}",
+                "Confidence": rand.uniform(40, 99.9),
+                "Geometry": geometry(rand),
+                "Page": page,
+            }
+            blocks.extend((key, value))
+            key["Relationships"] = [
+                { "Type": "VALUE", "Ids": [value["Id"]] },
+                { "Type": "CHILD", "Ids": add_words(key_text, page) },
+            ]
+            value["Relationships"] = [{ "Type": "CHILD", "Ids": add_words(value_text, page) }]
+    return { "DocumentMetadata": { "Pages": n_pages }, "Blocks": blocks }
+
+
+def load_modules():
+    """Import this function's modules, with the common layer importable as in Lambda"""
+    function_dir = os.path.dirname(os.path.abspath(__file__))
+    common_dir = os.path.join(os.path.dirname(os.path.dirname(function_dir)), "common")
+    sys.path[:0] = [function_dir, common_dir]
+    from block_index import BlockIndex
+    from extractors import CompiledFieldRules, FIELD_RULES
+    return BlockIndex, CompiledFieldRules(FIELD_RULES.values())
+
+
+def best_of(repeats: int, fn):
+    """Return (min seconds, result) over `repeats` calls of `fn`"""
+    best = None
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        result = fn()
+        seconds = time.perf_counter() - t_start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def run(args) -> list:
+    BlockIndex, compiled_rules = load_modules()
+    rows = []
+    print("Pages  JSON MB  Parse s  Index s  Rules s  Rules %")
+    for n_pages in args.pages:
+        raw = json.dumps(make_result(n_pages, args.lines_per_page, args.pairs_per_page)).encode("utf-8")
+        parse_s, result = best_of(args.repeats, lambda: json.loads(raw))
+        index_s, doc = best_of(args.repeats, lambda: BlockIndex(result["Blocks"]))
+        rules_s, _ = best_of(args.repeats, lambda: compiled_rules.extract_candidates(doc))
+        row = {
+            "Pages": n_pages,
+            "JsonBytes": len(raw),
+            "ParseSeconds": parse_s,
+            "IndexSeconds": index_s,
+            "RulesSeconds": rules_s,
+        }
+        rows.append(row)
+        total_s = parse_s + index_s + rules_s
+        print(
+            f"{n_pages:5}  {len(raw) / 1024 / 1024:7.1f}  {parse_s:7.3f}  {index_s:7.3f}  {rules_s:7.3f}  "
+            f"{100 * rules_s / total_s:6.1f}%"
+        )
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time post-processing phases over synthetic documents by page count")
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 10, 50, 200], help="Page counts to measure")
+    parser.add_argument(
+        "--lines-per-page",
+        type=int,
+        default=DEFAULT_LINES_PER_PAGE,
+        help="Number of LINEs of text per page",
+    )
+    parser.add_argument(
+        "--pairs-per-page",
+        type=int,
+        default=DEFAULT_PAIRS_PER_PAGE,
+        help="Number of key-value pairs per page",
+    )
+    parser.add_argument("--repeats", type=int, default=3, help="Report the best of this many runs per phase")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(parse_args())
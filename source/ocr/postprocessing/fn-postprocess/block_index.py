@@ -0,0 +1,148 @@
+"""Lightweight indexed view of a Textract result, for fast rule-based field extraction
+
+A generic document model like `trp.Document` links up every block type (incl. geometry, tables, cells) whether
+or not we need it, and its `searchFieldsByKey()` scans every form field on each call. For our post-processing
+rules we just need lines of text and key-value pairs, so this module builds only those - in one pass over the
+blocks - using compact `__slots__` objects and lookup dicts:
+
+- `BlockIndex.blocks_by_id`: Block ID -> `Block`
+- `BlockIndex.blocks_by_type`: BlockType -> list of `Block`s in document order
+- `BlockIndex.key_values`: list of `KeyValuePair`s in document order
+- `BlockIndex.key_values_by_text`: lowercase key text -> list of `KeyValuePair`s
+"""
+
+# Block fields used by the index: Useful for only loading the columns we need from compact-format results
+INDEX_COLUMNS = ("Id", "BlockType", "Text", "Confidence", "Relationships", "EntityTypes", "Page", "SelectionStatus")
+
+
+class Block:
+    """Minimal representation of a Textract block"""
+    __slots__ = (
+        "id",
+        "block_type",
+        "text",
+        "confidence",
+        "page",
+        "entity_types",
+        "selection_status",
+        "child_ids",
+        "value_ids",
+    )
+
+    def __init__(self, raw: dict):
+        self.id = raw["Id"]
+        self.block_type = raw["BlockType"]
+        self.text = raw.get("Text") or ""
+        self.confidence = raw.get("Confidence", 0)
+        # Single-page (synchronous API) results don't include page numbers:
+        self.page = raw.get("Page") or 1
+        self.entity_types = raw.get("EntityTypes") or ()
+        self.selection_status = raw.get("SelectionStatus")
+        self.child_ids = ()
+        self.value_ids = ()
+        for rel in raw.get("Relationships") or ():
+            if rel["Type"] == "CHILD":
+                self.child_ids = rel["Ids"]
+            elif rel["Type"] == "VALUE":
+                self.value_ids = rel["Ids"]
+
+    def __repr__(self):
+        return f"<Block {self.block_type} '{self.text}' ({self.confidence:.1f}%)>"
+
+
+class KeyValuePair:
+    """A Textract form field: KEY block, its (optional) VALUE block, and their resolved texts"""
+    __slots__ = ("key", "value", "key_text", "value_text", "page", "position")
+
+    def __init__(self, key: Block, value: Block, key_text: str, value_text: str, position: int=0):
+        self.key = key
+        self.value = value
+        self.key_text = key_text
+        self.value_text = value_text
+        self.page = key.page
+        self.position = position  # Index of this pair in the document's list of pairs
+
+    @property
+    def confidence(self) -> float:
+        """Combined confidence of the pair: The minimum of key and value (0 if there's no value)"""
+        return min(self.key.confidence, self.value.confidence) if self.value is not None else 0
+
+    def __repr__(self):
+        return f"<KeyValuePair '{self.key_text}': '{self.value_text}'>"
+
+
+class BlockIndex:
+    """Indexed view of a Textract result's blocks (see module docstring)"""
+    def __init__(self, blocks):
+        """Build the index from an iterable of raw Textract block dicts"""
+        self.blocks_by_id = {}
+        self.blocks_by_type = {}
+        key_blocks = []
+        for raw in blocks:
+            block = Block(raw)
+            self.blocks_by_id[block.id] = block
+            type_list = self.blocks_by_type.get(block.block_type)
+            if type_list is None:
+                type_list = self.blocks_by_type[block.block_type] = []
+            type_list.append(block)
+            if block.block_type == "KEY_VALUE_SET" and "KEY" in block.entity_types:
+                key_blocks.append(block)
+
+        # Relationships may point forward, so pairs can only be linked once all blocks are registered:
+        self.key_values = []
+        self.key_values_by_text = {}
+        for key_block in key_blocks:
+            value_block = next(
+                (self.blocks_by_id[i] for i in key_block.value_ids if i in self.blocks_by_id),
+                None,
+            )
+            pair = KeyValuePair(
+                key_block,
+                value_block,
+                self.content_text(key_block),
+                self.content_text(value_block) if value_block is not None else "",
+                position=len(self.key_values),
+            )
+            self.key_values.append(pair)
+            self.key_values_by_text.setdefault(pair.key_text.lower(), []).append(pair)
+        self._search_cache = {}
+
+    @property
+    def lines(self) -> list:
+        return self.blocks_by_type.get("LINE", [])
+
+    @property
+    def pages(self) -> list:
+        """Sorted list of page numbers present in the document"""
+        return sorted({ b.page for b in self.blocks_by_id.values() })
+
+    def content_text(self, block: Block) -> str:
+        """Text content of a KEY/VALUE block: its child words and selection element statuses joined by spaces"""
+        parts = []
+        for child_id in block.child_ids:
+            child = self.blocks_by_id.get(child_id)
+            if child is None:
+                continue
+            if child.block_type == "WORD":
+                parts.append(child.text)
+            elif child.block_type == "SELECTION_ELEMENT":
+                parts.append(child.selection_status or "")
+        return " ".join(parts)
+
+    def find_key_values(self, query: str) -> list:
+        """List KeyValuePairs whose key text contains `query` (case-insensitive), in document order
+
+        Only the (few) distinct key texts are scanned, and results are memoized per query.
+        """
+        query = query.lower()
+        result = self._search_cache.get(query)
+        if result is None:
+            matches = [
+                pair
+                for text, pairs in self.key_values_by_text.items() if query in text
+                for pair in pairs
+            ]
+            # Restore document order, since multiple distinct key texts may have matched:
+            result = sorted(matches, key=lambda pair: pair.position)
+            self._search_cache[query] = result
+        return result
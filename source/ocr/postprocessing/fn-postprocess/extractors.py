@@ -0,0 +1,193 @@
+"""Declarative registry of business field extraction rules for post-processing
+
+Rather than hard-coding a separate search over the document for each field, fields are described by rules
+registered here. All key-value rules are compiled into one combined matcher, which runs in a single pass over the
+document's key-value pairs - so adding more fields costs very little extra per document.
+
+To add a field, just register another rule. For example:
+
+    register_field_rule(KeyValueFieldRule(
+        "InvoiceNumber",
+        key_synonyms=("invoice no", "invoice number", "invoice #"),
+        value_pattern=r"[A-Z0-9\\-/]+",
+    ))
+"""
+
+# Python Built-Ins:
+from functools import lru_cache
+import re
+
+# Local Dependencies:
+from local_entities import parse_amount
+
+
+class FieldRule:
+    """Base class for a rule extracting candidate values for one business-level field"""
+    def __init__(self, name: str):
+        self.name = name
+
+
+class FirstLineFieldRule(FieldRule):
+    """Field whose value is the first LINE of text in the document (e.g. a receipt's vendor name heading)"""
+    pass
+
+
+class KeyValueFieldRule(FieldRule):
+    """Field extracted from Textract key-value pairs whose key text contains any of `key_synonyms`
+
+    Parameters
+    ----------
+    name :
+        Name of the output field
+    key_synonyms :
+        Lowercase substrings to search for in (lowercased) key text
+    value_pattern :
+        Optional regular expression which the whole (whitespace-stripped) value text must match
+    value_parser :
+        Optional function to validate the value text: Raise ValueError (or TypeError) to reject the candidate
+    confidence_modifiers :
+        Optional sequence of (key substring, factor) tuples: Candidate confidence is multiplied by `factor` for
+        each lowercase substring found in the key text. E.g. ("sub", 0.5) to down-weight "Subtotal" keys
+    """
+    def __init__(
+        self,
+        name: str,
+        key_synonyms,
+        value_pattern: str=None,
+        value_parser=None,
+        confidence_modifiers=(),
+    ):
+        super().__init__(name)
+        self.key_synonyms = tuple(s.lower() for s in key_synonyms)
+        self.value_regex = re.compile(value_pattern) if value_pattern else None
+        self.value_parser = value_parser
+        self.confidence_modifiers = tuple((s.lower(), factor) for s, factor in confidence_modifiers)
+
+    def accepts_value(self, value_text: str) -> bool:
+        value_text = value_text.strip()
+        if self.value_regex and not self.value_regex.fullmatch(value_text):
+            return False
+        if self.value_parser:
+            try:
+                self.value_parser(value_text)
+            except (TypeError, ValueError):
+                print(f"Rejecting {self.name} candidate: Couldn't parse '{value_text}'")
+                return False
+        return True
+
+    def confidence_factor(self, key_lower: str) -> float:
+        factor = 1.
+        for substring, modifier in self.confidence_modifiers:
+            if substring in key_lower:
+                factor *= modifier
+        return factor
+
+
+class CompiledFieldRules:
+    """A set of field rules compiled for single-pass evaluation against a `block_index.BlockIndex`
+
+    Parameters
+    ----------
+    rules :
+        Iterable of `FieldRule`s
+    key_cache_size :
+        Max number of distinct key texts to memoize matching rules for (instances live as long as the container,
+        so this keeps memory bounded however many different documents it processes)
+    """
+    def __init__(self, rules, key_cache_size: int=4096):
+        self.rules = list(rules)
+        self.kv_rules = [r for r in self.rules if isinstance(r, KeyValueFieldRule)]
+        self.line_rules = [r for r in self.rules if isinstance(r, FirstLineFieldRule)]
+
+        # One combined regex matching any key synonym of any rule, in a single pass over the key text. Every
+        # position where some synonym starts is tested against each rule's own alternation (longest synonym
+        # first) in a zero-width lookahead, with one capture group per rule: So overlapping synonyms of different
+        # rules (e.g. "due date" and "date") all match, instead of the first consuming the text of the other.
+        synonyms = { s for rule in self.kv_rules for s in rule.key_synonyms }
+        if len(synonyms):
+            self.key_regex = re.compile(
+                "(?=" + self._alternation(synonyms) + ")"
+                + "".join(
+                    "(?:(?=(" + self._alternation(rule.key_synonyms) + "))|)" for rule in self.kv_rules
+                )
+            )
+        else:
+            self.key_regex = None
+        self.rules_for_key = lru_cache(maxsize=key_cache_size)(self._match_rules)
+
+    @staticmethod
+    def _alternation(synonyms) -> str:
+        """Regex matching any of `synonyms` (longest first), or nothing at all if there are none"""
+        if not len(synonyms):
+            return "(?!)"
+        return "|".join(map(re.escape, sorted(synonyms, key=len, reverse=True)))
+
+    def _match_rules(self, key_lower: str) -> tuple:
+        """List the key-value rules matching a lowercase key text, in registration order
+
+        Use `rules_for_key` instead, which memoizes this (up to `key_cache_size` key texts), since key texts often
+        repeat.
+        """
+        if self.key_regex is None:
+            return ()
+        matched = set()
+        for match in self.key_regex.finditer(key_lower):
+            matched.update(ix for ix, group in enumerate(match.groups()) if group is not None)
+        return tuple(rule for ix, rule in enumerate(self.kv_rules) if ix in matched)
+
+    def extract_candidates(self, doc) -> dict:
+        """Evaluate all rules against indexed document `doc`, returning {field name: [candidates]}
+
+        Candidates are {"Confidence", "Value"} dicts in document order (not yet sorted by confidence).
+        """
+        candidates = { rule.name: [] for rule in self.rules }
+
+        if len(self.line_rules):
+            lines = doc.lines
+            for rule in self.line_rules:
+                candidates[rule.name].append({
+                    "Confidence": lines[0].confidence if len(lines) else 0,
+                    "Value": lines[0].text if len(lines) else "",
+                })
+
+        for pair in doc.key_values:
+            if pair.value is None:
+                continue
+            key_lower = pair.key_text.lower()
+            for rule in self.rules_for_key(key_lower):
+                if rule.accepts_value(pair.value_text):
+                    candidates[rule.name].append({
+                        # Because we're post-processing, our output "Confidence" scores should be driven by the
+                        # Textract outputs but adjusted to reflect our business understanding:
+                        "Confidence": pair.confidence * rule.confidence_factor(key_lower),
+                        "Value": pair.value_text,
+                    })
+        return candidates
+
+
+FIELD_RULES = {}
+
+
+def register_field_rule(rule: FieldRule):
+    """Add (or replace, by name) a rule in the default FIELD_RULES registry"""
+    FIELD_RULES[rule.name] = rule
+    return rule
+
+
+# Default rules for our receipt example:
+register_field_rule(KeyValueFieldRule(
+    "Date",
+    key_synonyms=("date",),
+))
+register_field_rule(KeyValueFieldRule(
+    "Total",
+    key_synonyms=("total", "amount"),
+    # If it's the total, the value should be parseable as a number (with optional currency symbol/code)!
+    value_parser=parse_amount,
+    # Keep a candidate in the list but reduce its confidence if the key contains other text indicating it
+    # might only be a subtotal:
+    confidence_modifiers=(("sub", 0.5),),
+))
+# Receipts don't usually list out a key-value pair like "Vendor: XYZ", the business name is just the first
+# thing on the receipt! So we'll make that our assumption to extract vendor:
+register_field_rule(FirstLineFieldRule("Vendor"))
@@ -0,0 +1,103 @@
+"""Fast local recognizers for date and currency amount text in receipts
+
+Calling Amazon Comprehend for every receipt without an explicit "Date:" key-value pair adds a network round
+trip, per-character cost, and throttling exposure to most documents - even though the dates on receipts tend to
+follow a handful of very regular formats. The precompiled patterns here catch those common formats locally, so
+Comprehend only needs to be called as a last resort.
+
+Confidence scores are on the same 0-100 scale as Textract, derived from the OCR confidence of the line the
+match was found in and how unambiguous the matched format is.
+"""
+
+# Python Built-Ins:
+import re
+
+MONTH_NAMES = r"(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?"
+TIME_SUFFIX = r"(?:[ T,]+\d{1,2}:\d{2}(?::\d{2})?(?:\s?[ap]\.?m\.?)?)?"
+
+# (Pattern, confidence factor) in order of precedence. Factors reflect how confidently a match of that format
+# can be interpreted as a date (e.g. numeric d/m/y formats are also sometimes phone or reference numbers):
+DATE_PATTERNS = tuple(
+    (re.compile(pattern, re.IGNORECASE), factor) for pattern, factor in (
+        # ISO-like year first: 2018-06-21, 2018/06/21 18:54:22
+        (r"\b(?P<y>\d{4})[-/.](?P<m>\d{1,2})[-/.](?P<d>\d{1,2})\b" + TIME_SUFFIX, 1.),
+        # Day/month first with 2 or 4 digit year: 21/06/2018, 06-21-18 18:54
+        (r"\b(?P<d>\d{1,2})[-/.](?P<m>\d{1,2})[-/.](?P<y>\d{4}|\d{2})\b" + TIME_SUFFIX, 0.9),
+        # Textual month: 21 Jun 2018, 21-June-18
+        (r"\b(?P<d>\d{1,2})(?:st|nd|rd|th)?[ \-]" + MONTH_NAMES + r"[ \-,]+(?P<y>\d{4}|\d{2})\b" + TIME_SUFFIX, 0.95),
+        # Textual month first: Jun 21, 2018
+        (r"\b" + MONTH_NAMES + r" (?P<d>\d{1,2})(?:st|nd|rd|th)?,? (?P<y>\d{4})\b" + TIME_SUFFIX, 0.95),
+    )
+)
+
+CURRENCY_SYMBOLS = ("US$", "S$", "A$", "NZ$", "HK$", "RM", "Rp", "$", "€", "£", "¥", "₹", "฿", "₱", "₫", "₩")
+CURRENCY_CODES = (
+    "AUD", "CAD", "CHF", "CNY", "EUR", "GBP", "HKD", "IDR", "INR", "JPY", "KRW", "MYR", "NZD", "PHP", "SGD", "THB",
+    "USD", "VND",
+)
+AMOUNT_REGEX = re.compile(
+    r"^(?P<lead_sign>-)?\s*(?P<prefix>{codes}|{symbols})?\s*(?P<sign>-)?\s*(?P<number>\d{{1,3}}(?:,\d{{3}})+(?:\.\d+)?|\d+(?:\.\d+)?)"
+    r"\s*(?P<suffix>{codes})?$".format(
+        codes="|".join(CURRENCY_CODES),
+        symbols="|".join(map(re.escape, CURRENCY_SYMBOLS)),
+    ),
+    re.IGNORECASE,
+)
+
+
+def parse_amount(text: str) -> tuple:
+    """Parse a currency amount like '$4.60', '-$4.60', 'SGD 1,234.50' or '12.00 EUR' to a (float, currency|None) tuple
+
+    Raises ValueError if the text doesn't look like a (single) amount.
+    """
+    match = AMOUNT_REGEX.match(text.strip())
+    if not match:
+        raise ValueError(f"Not a currency amount: '{text}'")
+    if match.group("prefix") and match.group("suffix"):
+        raise ValueError(f"Ambiguous currency in amount: '{text}'")
+    if match.group("lead_sign") and match.group("sign"):
+        raise ValueError(f"Not a currency amount: '{text}'")
+    value = float(match.group("number").replace(",", ""))
+    return (
+        -value if match.group("lead_sign") or match.group("sign") else value,
+        match.group("prefix") or match.group("suffix"),
+    )
+
+
+def detect_dates(lines) -> list:
+    """Find date-like text in a sequence of LINE `block_index.Block`s, returning date field candidates
+
+    Returns a list of { "Confidence", "Value" } dicts in document order. Each line is searched with the patterns
+    in precedence order, and spans already matched by a higher-precedence pattern are not matched again.
+    """
+    candidates = []
+    for line in lines:
+        text = line.text
+        if not any(c.isdigit() for c in text):
+            continue  # Quick skip: All our formats contain digits
+        claimed = []
+        for regex, factor in DATE_PATTERNS:
+            for match in regex.finditer(text):
+                start, end = match.span()
+                if any(start < c_end and c_start < end for c_start, c_end in claimed):
+                    continue
+                if not is_plausible_date(match):
+                    continue
+                claimed.append((start, end))
+                candidates.append({
+                    "Confidence": line.confidence * factor,
+                    "Value": match.group(0).strip(),
+                })
+    return candidates
+
+
+def is_plausible_date(match) -> bool:
+    groups = match.groupdict()
+    day = int(groups["d"])
+    month = int(groups["m"]) if groups.get("m") else None
+    if month is not None and not (1 <= month <= 12):
+        # Allow for US-style month/day order:
+        day, month = month, day
+        if not (1 <= month <= 12):
+            return False
+    return 1 <= day <= 31
@@ -5,146 +5,307 @@
 
 # Python Built-Ins:
 import json
+import os
+import traceback
 
 # External Dependencies:
 import boto3
 
 # Local Dependencies:
-from trp import Document
+from block_index import BlockIndex, INDEX_COLUMNS
+from extractors import CompiledFieldRules, FIELD_RULES
+from local_entities import detect_dates
+from metrics import emit_metrics  # (From common layer)
+from textract_compact import load_compact_result, FILE_SUFFIX as COMPACT_FILE_SUFFIX  # (From common layer)
 
 comprehend = boto3.client("comprehend")
-s3 = boto3.resource("s3")
+s3 = boto3.client("s3")
+sfn = boto3.client("stepfunctions")
+
+COMPREHEND_BATCH_SIZE = 25  # Max documents per BatchDetectEntities call, per the API doc
+COMPREHEND_BATCH_MAX_BYTES = 5000  # Max UTF-8 bytes per document in BatchDetectEntities, per the API doc
+
+# Compile the field extraction rules once per container, rather than per request:
+compiled_rules = CompiledFieldRules(FIELD_RULES.values())
+
+DEFAULT_REVIEW_THRESHOLD = 50  # Fields with confidence below this are flagged for human review
+
+
+def parse_review_thresholds(value: str) -> dict:
+    """Parse per-field review confidence thresholds from a string like "Date=50,Total=70"
+
+    Fields not listed use `DEFAULT_REVIEW_THRESHOLD`.
+    """
+    thresholds = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        field_name, _, threshold = item.partition("=")
+        thresholds[field_name.strip()] = float(threshold)
+    return thresholds
+
+
+review_thresholds = parse_review_thresholds(os.environ.get("REVIEW_FIELD_THRESHOLDS"))
 
 
 class MalformedRequest(ValueError):
     pass
 
 
+def load_textract_result(bucket: str, key: str, columns=None) -> dict:
+    """Load a raw Textract result from S3, in either standard JSON or compact format (by file extension)
+
+    For compact-format results, `columns` may be used to only decode the block fields actually needed.
+    """
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+    if key.endswith(COMPACT_FILE_SUFFIX):
+        return load_compact_result(body, columns=columns)
+    else:
+        return json.load(body)
+
+
+# Step Functions errors meaning a task token can never be signalled, so there's no point retrying:
+FINAL_TASK_TOKEN_ERRORS = ("InvalidToken", "TaskDoesNotExist", "TaskTimedOut")
+
+
 def handler(event, context):
+    """Post-process a single Textract result { Bucket, Key }, or a batch of them { Items: [...] }
+
+    Batch requests (as generated e.g. by a Step Functions Map state with ItemBatcher, or by bulk tools like
+    batch-ingestion) return a list of results in the same order as the input `Items`, and share Comprehend calls
+    between documents. Items may optionally include a Step Functions `TaskToken`, in which case that item's
+    result (or error) is also sent back to the waiting execution.
+
+    The deployed state machine queues each document { Bucket, Key, TaskToken } to SQS, and Lambda delivers them
+    here in batches of SQS `Records` (see `handle_sqs_records()`).
+    """
+    if "Records" in event:
+        return handle_sqs_records(event["Records"])
+    if "Items" in event:
+        return handle_batch(event["Items"])
+
     try:
         srcbucket = event["Bucket"]
         srckey = event["Key"]
     except KeyError as ke:
         raise MalformedRequest(f"Missing field {ke}, please check your input payload")
 
-    # Load and parse Textract result from S3
-    textract_result = json.load(s3.Object(srcbucket, srckey).get()["Body"])
-    doc = Document(textract_result)
-
-    # Define post processing variables
-    amount_form_keys = ["total", "amount"]
-    date_form_keys = ["date"]
-    text = ""
-    
-    # Since we're just taking the first line as the vendor name, there'll be exactly one candidate:
-    vendor_name_result = { "Confidence": 0, "Value": "" }
-    vendor_name_candidates = [vendor_name_result]
-
-    # For the other fields, we'll search for multiple options:
-    date_candidates = []
-    total_amount_candidates = []
-
-    # Receipts don't usually list out a key-value pair like "Vendor: XYZ", the business name is just the
-    # first thing on the receipt! So we'll make that our assumption to extract vendor:
-    for item in textract_result["Blocks"]:
-        if item["BlockType"] == "LINE":
-            if vendor_name_result["Value"] == "":
-                vendor_name_result["Value"] = item["Text"]
-                # Setting the vendor name confidence = raw OCR confidence is a bit lazy and optimistic,
-                # because we're not applying any reduction to reflect the fact that taking first line of
-                # text = vendor name is an *assumption*... But it'll do for our sample:
-                vendor_name_result["Confidence"] = item["Confidence"]
+    candidates, comprehend_text = extract_candidates(srcbucket, srckey)
+    if comprehend_text is not None:
+        add_comprehend_date_candidates(
+            candidates,
+            comprehend.detect_entities(Text=comprehend_text, LanguageCode="en")["Entities"],
+        )
+    return build_result(candidates)
+
+
+def handle_sqs_records(records: list) -> dict:
+    """Post-process a batch of SQS messages, each a JSON { Bucket, Key, TaskToken } item
+
+    Results are sent back to the waiting executions as per `handle_batch()`. Returns a partial batch response
+    listing only the messages whose task token couldn't be signalled for some retryable reason (e.g. throttling),
+    so SQS re-delivers just those: Processing errors are reported to the execution, not retried here.
+    """
+    items = []
+    record_ixs = []  # Index of the SQS record each item came from
+    for ix, record in enumerate(records):
+        try:
+            items.append(json.loads(record["body"]))
+            record_ixs.append(ix)
+        except ValueError:
+            # Nobody's waiting on a message we can't read, and re-delivering it won't help:
+            print(f"Dropping malformed message {record.get('messageId')}: {record.get('body')}")
+
+    results = process_batch(items)
+    unsignalled = signal_results(items, results)
+    return {
+        "batchItemFailures": [
+            { "itemIdentifier": records[record_ixs[ix]]["messageId"] } for ix in unsignalled
+        ],
+    }
+
+
+def handle_batch(items: list, comprehend_client=None, sfn_client=None) -> list:
+    """Post-process a batch of Textract results, and signal any waiting Step Functions executions
+
+    See `process_batch()` and `signal_results()`: Returns the list of results in the same order as `items`.
+    """
+    results = process_batch(items, comprehend_client=comprehend_client)
+    signal_results(items, results, sfn_client=sfn_client)
+    return results
+
+
+def process_batch(items: list, comprehend_client=None) -> list:
+    """Post-process a batch of Textract results, using BatchDetectEntities for any Comprehend date fallbacks
+
+    Failures are contained per item: Any item that can't be processed gets an error result without affecting the
+    rest of the batch.
+    """
+    comprehend_client = comprehend_client or comprehend
+    results = [None] * len(items)
+    candidates_by_item = {}
+    pending_comprehend = []  # (item index, text) tuples for documents needing the Comprehend fallback
+    for ix, item in enumerate(items):
+        try:
+            candidates, comprehend_text = extract_candidates(item["Bucket"], item["Key"])
+            candidates_by_item[ix] = candidates
+            if comprehend_text is not None:
+                pending_comprehend.append((ix, comprehend_text))
+        except Exception as e:
+            results[ix] = error_result(e)
+
+    for ix_batch in range(0, len(pending_comprehend), COMPREHEND_BATCH_SIZE):
+        batch = pending_comprehend[ix_batch:ix_batch + COMPREHEND_BATCH_SIZE]
+        print(f"Detecting entities for batch of {len(batch)} documents")
+        try:
+            response = comprehend_client.batch_detect_entities(
+                TextList=[truncate_utf8(text, COMPREHEND_BATCH_MAX_BYTES) for _, text in batch],
+                LanguageCode="en",
+            )
+        except Exception:
+            # Don't let one bad batch call sink every document in it: Try them individually instead
+            traceback.print_exc()
+            for item_ix, text in batch:
+                try:
+                    add_comprehend_date_candidates(
+                        candidates_by_item[item_ix],
+                        comprehend_client.detect_entities(Text=text, LanguageCode="en")["Entities"],
+                    )
+                except Exception as e:
+                    del candidates_by_item[item_ix]
+                    results[item_ix] = error_result(e)
+            continue
+        for doc_result in response["ResultList"]:
+            item_ix = batch[doc_result["Index"]][0]
+            add_comprehend_date_candidates(candidates_by_item[item_ix], doc_result["Entities"])
+        for doc_error in response["ErrorList"]:
+            item_ix = batch[doc_error["Index"]][0]
+            print("Comprehend failed for item {}: {} {}".format(
+                item_ix,
+                doc_error.get("ErrorCode"),
+                doc_error.get("ErrorMessage"),
+            ))
+
+    for ix, candidates in candidates_by_item.items():
+        results[ix] = build_result(candidates)
+    return results
+
+
+def signal_results(items: list, results: list, sfn_client=None) -> list:
+    """Send `results` back to any Step Functions executions waiting on their `items` (with a TaskToken)
+
+    Returns the indexes of items whose token couldn't be signalled but might succeed on retry: Failures are
+    contained per item, so one stopped execution doesn't stop us signalling the rest.
+    """
+    sfn_client = sfn_client or sfn
+    unsignalled = []
+    for ix, (item, result) in enumerate(zip(items, results)):
+        task_token = item.get("TaskToken")
+        if not task_token:
+            continue
+        try:
+            if "Error" in result:
+                sfn_client.send_task_failure(taskToken=task_token, error=result["Error"], cause=result["Cause"])
             else:
-                # While we're looping through blocks anyway, we'll also collect all the text from the receipt
-                # into a single string to search with Comprehend later:
-                text += item["Text"] + " "
-
-    # For amount and date fields, we'll try searching the key-value pairs first:
-    # TODO: Refactor this loop for efficiency
-    for page in doc.pages:
-        for key in amount_form_keys:
-            fields = page.form.searchFieldsByKey(key)
-            for field in fields:
-                key_lower = field.key.text.lower()
-                # TODO: This should re-use amount_form_keys
-                if (
-                    ("total" in key_lower or "amount" in key_lower)
-                    and field.value is not None
-                ):
-                    try:
-                        # If it's the total, the value should be parseable as a number!
-                        # TODO: Allow for other leading currency symbols and 3-letter-acronyms
-                        a = float(field.value.text.lstrip("$"))
-                        total_amount_candidates.append({
-                            # Again because we're post-processing, our output "Confidence" scores should be
-                            # driven by the Textract outputs but adjusted to reflect our business
-                            # understanding... We'll consider both the key and value confidence scores, and
-                            # keep a candidate in the list but reduce its confidence if the key contains
-                            # other text indicating it might only be a subtotal:
-                            "Confidence": (
-                                min(field.key.confidence, field.value.confidence)
-                                * (0.5 if "sub" in key_lower else 1.)
-                            ),
-                            "Value": field.value.text,
-                        })
-                    except Exception as e:
-                        print("Cannot proceed String to Number {}".format(field.value.text))
-
-        for key in date_form_keys:
-            fields = page.form.searchFieldsByKey(key)
-            for field in fields:
-                if "date" in field.key.text.lower() and field.value is not None:
-                    date_candidates.append({
-                        "Confidence": min(field.key.confidence, field.value.confidence),
-                        "Value": field.value.text
-                    })
+                sfn_client.send_task_success(taskToken=task_token, output=json.dumps(result))
+        except Exception as e:
+            print(f"Failed to signal task token for item {item.get('Bucket')}/{item.get('Key')}")
+            traceback.print_exc()
+            error_code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if error_code not in FINAL_TASK_TOKEN_ERRORS:
+                unsignalled.append(ix)
+    return unsignalled
+
+
+def extract_candidates(bucket: str, key: str) -> tuple:
+    """Load a Textract result and extract field candidates: Returns (candidates, comprehend_text)
+
+    `comprehend_text` is None unless the document needs the Comprehend date detection fallback, in which case it
+    is the text to search.
+    """
+    # Load and parse Textract result from S3, indexing just the block fields our rules need:
+    textract_result = load_textract_result(bucket, key, columns=INDEX_COLUMNS)
+    doc = BlockIndex(textract_result["Blocks"])
+    del textract_result  # Raw dicts no longer needed
+
+    # Evaluate all our registered field rules in a single pass over the document:
+    candidates = compiled_rules.extract_candidates(doc)
 
     # If we couldn't find any date-looking fields in the key-value pairs (likely for verbose invoice-style
-    # documents, but not for shorrt receipts), then we'll use Amazon Comprehend to just detect date entities:
-    if not len(date_candidates) > 0:
-        comprehend_entities = comprehend.detect_entities(Text=text, LanguageCode="en")["Entities"]
-        for entity in comprehend_entities:
-            if entity.get("Type") == "DATE":
-                value_str = entity.get("Text").strip("\t\n\r")
-                # A little bit of validation that it looks date-like:
-                if "/" in value_str or ":" in value_str or "-" in value_str:
-                    date_candidates.append({
-                        # Comprehend scores confidence 0-1 while Textract does 0-100: Doesn't matter which we
-                        # standardize on as long as we choose one! Again, could improve this confidence score
-                        # by factoring in things like how confident the Textract OCR was on that span of text
-                        "Confidence": entity.get("Score", 0) * 100,
-                        "Value": value_str
-                    })
-
-    # Sort our candidates by descending confidence and take the highest confidence candidate for each field:
-    date_candidates = sorted(date_candidates, key=lambda c: c["Confidence"], reverse=True)
-    total_amount_candidates = sorted(total_amount_candidates, key=lambda c: c["Confidence"], reverse=True)
-    date_result = date_candidates[0] if len(date_candidates) else None
-    total_amount_result = total_amount_candidates[0] if len(total_amount_candidates) else None
-
-    result = {
-        "Date": {
-            "Confidence": date_result["Confidence"] if date_result else 0,
-            "Value": date_result["Value"] if date_result else "",
-        },
-        "Total": {
-            "Confidence": total_amount_result["Confidence"] if total_amount_result else 0,
-            "Value": total_amount_result["Value"] if total_amount_result else "",
-        },
-        "Vendor": {
-            "Confidence": vendor_name_result["Confidence"] if vendor_name_result else 0,
-            "Value": vendor_name_result["Value"] if vendor_name_result else "",
+    # documents, but not for shorrt receipts), then we'll search the receipt text for dates instead - except
+    # the first line, which we assume is the vendor. Local patterns catch most common date formats, so we only
+    # call out to Amazon Comprehend to detect date entities as a last resort:
+    used_local_dates = False
+    comprehend_text = None
+    if not len(candidates["Date"]) > 0:
+        candidates["Date"] = detect_dates(doc.lines[1:])
+        used_local_dates = len(candidates["Date"]) > 0
+    if not len(candidates["Date"]) > 0:
+        comprehend_text = "".join(line.text + " " for line in doc.lines[1:])
+        if not comprehend_text.strip():
+            # Nothing to search (e.g. a one-line document), and Comprehend rejects empty text anyway:
+            comprehend_text = None
+
+    emit_metrics(
+        {
+            "LocalDateDetection": int(used_local_dates),
+            "ComprehendDateFallback": int(comprehend_text is not None),
         },
-    }
+        dimensions={ "Function": "PostProcess" },
+    )
+    return candidates, comprehend_text
+
+
+def add_comprehend_date_candidates(candidates: dict, comprehend_entities: list):
+    """Add date-like Comprehend entities to field `candidates`"""
+    for entity in comprehend_entities:
+        if entity.get("Type") == "DATE":
+            value_str = entity.get("Text").strip("\t\n\r")
+            # A little bit of validation that it looks date-like:
+            if "/" in value_str or ":" in value_str or "-" in value_str:
+                candidates["Date"].append({
+                    # Comprehend scores confidence 0-1 while Textract does 0-100: Doesn't matter which we
+                    # standardize on as long as we choose one! Again, could improve this confidence score by
+                    # factoring in things like how confident the Textract OCR was on that span of text
+                    "Confidence": entity.get("Score", 0) * 100,
+                    "Value": value_str
+                })
+
+
+def build_result(candidates: dict) -> dict:
+    """Select the top candidate for each field and compose the overall result"""
+    result = {}
+    for field_name, field_candidates in candidates.items():
+        # Sort our candidates by descending confidence and take the highest confidence candidate for each field:
+        field_candidates = sorted(field_candidates, key=lambda c: c["Confidence"], reverse=True)
+        top_candidate = field_candidates[0] if len(field_candidates) else None
+        result[field_name] = {
+            "Confidence": top_candidate["Confidence"] if top_candidate else 0,
+            "Value": top_candidate["Value"] if top_candidate else "",
+        }
+        if len(field_candidates) > 1:
+            result[field_name]["Alternatives"] = field_candidates[1:]
 
     # How do we measure composite result "Confidence" for many fields driven by different logics? We'll just
     # take the minimum, since a human review should be triggered by the weakest field.
-    result["Confidence"] = min(map(lambda f: result[f]["Confidence"], result.keys()))
-    if len(date_candidates) > 1:
-        result["Date"]["Alternatives"] = date_candidates[1:]
-    if len(total_amount_candidates) > 1:
-        result["Total"]["Alternatives"] = total_amount_candidates[1:]
-    if len(vendor_name_candidates) > 1:
-        result["Vendor"]["Alternatives"] = vendor_name_candidates[1:]
-
+    result["Confidence"] = min(map(lambda f: result[f]["Confidence"], candidates.keys()))
+    # ...But only the fields below their own threshold need a reviewer's attention:
+    result["ReviewFields"] = [
+        f for f in candidates.keys()
+        if result[f]["Confidence"] < review_thresholds.get(f, DEFAULT_REVIEW_THRESHOLD)
+    ]
     return result
+
+
+def error_result(err: Exception) -> dict:
+    # Like the default direct-to-Lambda integration, we'll return the Python exception type name and message:
+    traceback.print_exc()
+    return { "Error": type(err).__name__, "Cause": str(err) }
+
+
+def truncate_utf8(text: str, max_bytes: int) -> str:
+    """Truncate `text` to at most `max_bytes` when UTF-8 encoded, without splitting a character"""
+    encoded = text.encode("utf-8")
+    if len(encoded) <= max_bytes:
+        return text
+    return encoded[:max_bytes].decode("utf-8", errors="ignore")
@@ -0,0 +1,202 @@
+"""Measure how many Rekognition model calls the local quality gate avoids, and how often it agrees on a labelled set
+
+Runs `quality_gate.assess_image()` over a set of labelled images, and reports:
+
+- The fraction of images decided locally (i.e. model calls avoided)
+- Agreement of the local decisions with the ground truth labels - and optionally with your deployed Rekognition
+  model, if you pass `--model-arn` (which calls the model for every image, so needs it to be running!)
+
+Labelled images are read from a folder containing `good/` and `bad/` sub-folders - the same layout as the sample
+`receipts.zip` training data (see the README). Without `--data`, a synthetic set is generated instead: clean scans,
+phone photos and long receipts (good); and blurred, under/over-exposed, glare-spotted, tiny and blank images (bad).
+
+    python bench_quality_gate.py --data ./receipts
+    python bench_quality_gate.py --synthetic-per-kind 20
+"""
+
+# Python Built-Ins:
+import argparse
+from collections import Counter
+import io
+import json
+import os
+import sys
+
+# External Dependencies:
+import numpy as np
+from PIL import Image, ImageFilter
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def render_page(rand: np.random.RandomState, width: int, height: int, paper: float, ink: float) -> np.ndarray:
+    """Draw a page of word-like blocks of vertical strokes, as a float greyscale array"""
+    page = np.full((height, width), paper, dtype=np.float32)
+    line_height = max(8, height // 60)
+    stroke_height = int(line_height * 0.6)
+    for top in range(line_height * 3, height - line_height * 3, line_height):
+        left = int(width * 0.08)
+        line_end = int(width * rand.uniform(0.5, 0.92))
+        while left < line_end:
+            word_end = min(line_end, left + rand.randint(stroke_height * 2, stroke_height * 8))
+            for x in range(left, word_end, 5):
+                page[top:top + stroke_height, x:x + 2] = ink
+            left = word_end + stroke_height
+    return page
+
+
+def lighting(rand: np.random.RandomState, page: np.ndarray, strength: float) -> np.ndarray:
+    """Apply a smooth brightness gradient across the page (like uneven phone-camera lighting)"""
+    height, width = page.shape
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    angle = rand.uniform(0, 2 * np.pi)
+    ramp = (np.cos(angle) * xs / width + np.sin(angle) * ys / height)
+    return page * (1 - strength * (ramp - ramp.min()) / max(1e-6, np.ptp(ramp)))
+
+
+def photo(rand: np.random.RandomState, width: int=1500, height: int=2000) -> np.ndarray:
+    """A phone photo of a receipt: off-white paper with uneven lighting, on a darker background, with sensor noise"""
+    page = np.full((height, width), rand.uniform(30, 60), dtype=np.float32)
+    margin_x, margin_y = int(width * rand.uniform(0.05, 0.15)), int(height * rand.uniform(0.03, 0.1))
+    page[margin_y:-margin_y, margin_x:-margin_x] = render_page(
+        rand,
+        width - 2 * margin_x,
+        height - 2 * margin_y,
+        paper=rand.uniform(195, 230),
+        ink=rand.uniform(35, 70),
+    )
+    page = lighting(rand, page, rand.uniform(0.05, 0.2))
+    return page + rand.normal(0, 4, page.shape)
+
+
+def make_image(kind: str, rand: np.random.RandomState) -> np.ndarray:
+    """Generate a synthetic greyscale image (float array, unclipped) of the given `kind`"""
+    if kind == "clean_scan":
+        return render_page(rand, 1700, 2200, paper=255., ink=rand.uniform(0, 30))
+    elif kind == "photo":
+        return photo(rand)
+    elif kind == "long_receipt":
+        return render_page(rand, 800, 2600, paper=rand.uniform(228, 245), ink=rand.uniform(60, 100))
+    elif kind == "blurred":
+        img = Image.fromarray(np.clip(photo(rand), 0, 255).astype(np.uint8))
+        return np.asarray(img.filter(ImageFilter.GaussianBlur(rand.uniform(8, 14))), dtype=np.float32)
+    elif kind == "underexposed":
+        return photo(rand) * rand.uniform(0.08, 0.15)
+    elif kind == "overexposed":
+        return photo(rand) * rand.uniform(5., 7.)
+    elif kind == "glare":
+        page = photo(rand)
+        height, width = page.shape
+        ys, xs = np.mgrid[0:height, 0:width]
+        cy, cx = rand.uniform(0.3, 0.7) * height, rand.uniform(0.3, 0.7) * width
+        radius = rand.uniform(0.25, 0.35) * width
+        page[(ys - cy) ** 2 + (xs - cx) ** 2 < radius ** 2] = 255.
+        return page
+    elif kind == "tiny":
+        return photo(rand, width=300, height=400)
+    elif kind == "blank":
+        return np.full((2000, 1500), rand.uniform(180, 240), dtype=np.float32) + rand.normal(0, 3, (2000, 1500))
+    raise ValueError(f"Unknown synthetic image kind '{kind}'")
+
+
+SYNTHETIC_KINDS = {
+    "good": ("clean_scan", "photo", "long_receipt"),
+    "bad": ("blurred", "underexposed", "overexposed", "glare", "tiny", "blank"),
+}
+
+
+def synthetic_images(n_per_kind: int, seed: int=0):
+    """Yield (name, true label, JPEG bytes) for a synthetic labelled set"""
+    rand = np.random.RandomState(seed)
+    for label, kinds in SYNTHETIC_KINDS.items():
+        for kind in kinds:
+            for ix in range(n_per_kind):
+                buffer = io.BytesIO()
+                Image.fromarray(np.clip(make_image(kind, rand), 0, 255).astype(np.uint8)).save(
+                    buffer,
+                    format="JPEG",
+                    quality=90,
+                )
+                yield f"{kind}/{ix}", label, buffer.getvalue()
+
+
+def folder_images(data_dir: str):
+    """Yield (name, true label, image bytes) from `good/` and `bad/` sub-folders of `data_dir`"""
+    for label in ("good", "bad"):
+        label_dir = os.path.join(data_dir, label)
+        for filename in sorted(os.listdir(label_dir)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                with open(os.path.join(label_dir, filename), "rb") as f:
+                    yield f"{label}/{filename}", label, f.read()
+
+
+def model_label(rekognition, model_arn: str, image_bytes: bytes) -> str:
+    """Top label from the Rekognition Custom Labels model (or None if it returned no labels)"""
+    labels = rekognition.detect_custom_labels(ProjectVersionArn=model_arn, Image={ "Bytes": image_bytes })
+    labels = sorted(labels["CustomLabels"], key=lambda l: l["Confidence"], reverse=True)
+    return labels[0]["Name"].lower() if len(labels) else None
+
+
+def run(args) -> dict:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from quality_gate import assess_image
+
+    rekognition = None
+    if args.model_arn:
+        import boto3
+        rekognition = boto3.client("rekognition")
+
+    images = folder_images(args.data) if args.data else synthetic_images(args.synthetic_per_kind, args.seed)
+    n_total = 0
+    decided = Counter()  # (true label, local label) -> count
+    vs_model = Counter()  # (model label, local label) -> count, for locally-decided images only
+    by_group = {}  # Sub-folder or synthetic kind -> Counter of local labels
+    for name, true_label, image_bytes in images:
+        n_total += 1
+        local = assess_image(image_bytes)
+        decided[(true_label, local["Label"])] += 1
+        by_group.setdefault(name.rpartition("/")[0], Counter())[local["Label"] or "model"] += 1
+        if args.verbose:
+            print(name, local["Label"], local["Reasons"], json.dumps(local["Metrics"]))
+        if rekognition and local["Label"]:
+            vs_model[(model_label(rekognition, args.model_arn, image_bytes), local["Label"])] += 1
+
+    n_decided = sum(n for (_, local_label), n in decided.items() if local_label)
+    n_agree = sum(n for (true_label, local_label), n in decided.items() if local_label == true_label)
+    stats = {
+        "Images": n_total,
+        "DecidedLocally": n_decided,
+        "ModelCallsAvoided": round(n_decided / max(1, n_total), 3),
+        "AgreementWithLabels": round(n_agree / max(1, n_decided), 3),
+        "Confusion": { f"{t}->{l or 'model'}": n for (t, l), n in sorted(decided.items(), key=str) },
+        "ByGroup": { group: dict(counts) for group, counts in by_group.items() },
+    }
+    if rekognition:
+        n_model_agree = sum(n for (model, local_label), n in vs_model.items() if model == local_label)
+        stats["AgreementWithModel"] = round(n_model_agree / max(1, n_decided), 3)
+    print(json.dumps(stats, indent=2))
+    return stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure model calls avoided by the local quality gate, and its agreement on labelled images",
+    )
+    parser.add_argument("--data", help="Folder with good/ and bad/ sub-folders of images (default: synthetic set)")
+    parser.add_argument(
+        "--synthetic-per-kind",
+        type=int,
+        default=10,
+        help="Number of images per kind of synthetic image, if not using --data",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic set")
+    parser.add_argument(
+        "--model-arn",
+        help="(Optional) Rekognition Custom Labels model version ARN to also compare against (must be RUNNING)",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Print the metrics and decision for every image")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,172 @@
+"""In-process image enhancement to rescue marginal document photos: denoise, crop, deskew and contrast stretch
+
+All steps operate on a greyscale NumPy array with vectorized operations (no per-pixel Python loops), at a
+working resolution capped by `max_side` so memory use stays bounded for large photos:
+
+1. **Denoise**: 3x3 median filter (removes speckle/sensor noise while keeping text edges sharp)
+2. **Crop**: Trim to the bounding box of the (bright) document against a darker background, found by Otsu
+   thresholding and row/column occupancy
+3. **Deskew**: Estimate text line angle by maximizing the sharpness of the horizontal projection profile of dark
+   (ink) pixels over a range of candidate angles, then rotate to correct it
+4. **Contrast**: Linear stretch of the 1st-99th percentile intensity range to the full 0-255 range
+
+`enhance_image()` returns per-step timings alongside the result, so the cost of each step can be monitored.
+"""
+
+# Python Built-Ins:
+import io
+import time
+
+# External Dependencies:
+import numpy as np
+from PIL import Image
+
+# Local Dependencies:
+from normalisation import apply_orientation, exif_orientation
+
+DEFAULT_MAX_SIDE = 2500  # Working resolution cap (pixels), plenty for OCR of receipts
+MAX_SKEW_DEGREES = 10.
+SKEW_STEP_DEGREES = 0.25
+SKEW_SAMPLE_POINTS = 20000  # Max number of ink pixels used to estimate skew
+MIN_CROP_FRACTION = 0.25  # Don't crop if the detected document would be smaller than this fraction of the image
+
+
+def _median3(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> np.ndarray:
+    return np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c))
+
+
+def median_denoise(grey: np.ndarray) -> np.ndarray:
+    """3x3 median filter of a uint8 2D array (edges padded by replication)
+
+    Uses the min/max sorting network formulation: Sort each vertical triple, then the median of the 3x3 block is
+    the median of (max of the column minimums, median of the column medians, min of the column maximums). This
+    needs only elementwise min/max operations, so is much faster than a generic median over a stack of shifts.
+    """
+    padded = np.pad(grey, 1, mode="edge")
+    top, mid, bottom = padded[:-2], padded[1:-1], padded[2:]
+    col_lo = np.minimum(np.minimum(top, mid), bottom)
+    col_hi = np.maximum(np.maximum(top, mid), bottom)
+    col_mid = _median3(top, mid, bottom)
+    left, centre, right = slice(None, -2), slice(1, -1), slice(2, None)
+    max_lo = np.maximum(np.maximum(col_lo[:, left], col_lo[:, centre]), col_lo[:, right])
+    min_hi = np.minimum(np.minimum(col_hi[:, left], col_hi[:, centre]), col_hi[:, right])
+    mid_mid = _median3(col_mid[:, left], col_mid[:, centre], col_mid[:, right])
+    return _median3(max_lo, mid_mid, min_hi)
+
+
+def otsu_threshold(grey: np.ndarray) -> int:
+    """Intensity threshold best separating a uint8 image into two classes (Otsu's method)
+
+    The threshold belongs to the dark class: Pixels `<=` it are ink/background, and pixels `>` it are paper.
+    """
+    hist = np.bincount(grey.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_low = np.cumsum(hist)
+    weight_high = weight_low[-1] - weight_low
+    cum_intensity = np.cumsum(hist * levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_low = cum_intensity / weight_low
+        mean_high = (cum_intensity[-1] - cum_intensity) / weight_high
+        between_var = weight_low * weight_high * (mean_low - mean_high) ** 2
+    # (Classes with no pixels give NaNs, e.g. for a blank image: Treat as no separation)
+    return int(np.argmax(np.nan_to_num(between_var)))
+
+
+def document_bounds(grey: np.ndarray, min_occupancy: float=0.5) -> tuple:
+    """Estimate (top, bottom, left, right) bounds of a bright document on a darker background"""
+    bright = grey > otsu_threshold(grey)  # (Strictly above, since the threshold level itself is dark)
+    rows = np.flatnonzero(bright.mean(axis=1) >= min_occupancy)
+    cols = np.flatnonzero(bright.mean(axis=0) >= min_occupancy)
+    if not (len(rows) and len(cols)):
+        return 0, grey.shape[0], 0, grey.shape[1]
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+def crop_to_document(grey: np.ndarray, margin: int=10) -> np.ndarray:
+    top, bottom, left, right = document_bounds(grey)
+    if (bottom - top) * (right - left) < MIN_CROP_FRACTION * grey.size:
+        return grey  # Probably not a document-on-background photo: Leave as-is
+    height, width = grey.shape
+    return grey[max(0, top - margin):min(height, bottom + margin), max(0, left - margin):min(width, right + margin)]
+
+
+def estimate_skew(grey: np.ndarray) -> float:
+    """Estimate the clockwise skew angle (degrees) of text in a document image
+
+    For each candidate angle, ink pixel coordinates are projected onto the rotated vertical axis and binned into
+    rows: When the angle matches the text lines, ink concentrates into few rows and the sum of squared row counts
+    peaks. All candidate angles are evaluated at once by broadcasting.
+    """
+    ys, xs = np.nonzero(grey <= otsu_threshold(grey))
+    if len(ys) < 100:
+        return 0.
+    if len(ys) > SKEW_SAMPLE_POINTS:
+        sample = np.random.default_rng(0).choice(len(ys), SKEW_SAMPLE_POINTS, replace=False)
+        ys, xs = ys[sample], xs[sample]
+    angles = np.deg2rad(np.arange(-MAX_SKEW_DEGREES, MAX_SKEW_DEGREES + SKEW_STEP_DEGREES, SKEW_STEP_DEGREES))
+    # (n_angles, n_points) projected row positions:
+    projected = (ys[None, :] * np.cos(angles)[:, None] - xs[None, :] * np.sin(angles)[:, None]).astype(np.int64)
+    projected -= projected.min(axis=1, keepdims=True)
+    n_bins = int(projected.max()) + 1
+    # Offset each angle's bins so one bincount computes every angle's histogram:
+    offsets = (np.arange(len(angles)) * n_bins)[:, None]
+    counts = np.bincount((projected + offsets).ravel(), minlength=len(angles) * n_bins).reshape(len(angles), -1)
+    scores = (counts.astype(np.float64) ** 2).sum(axis=1)
+    return float(np.rad2deg(angles[np.argmax(scores)]))
+
+
+def deskew(grey: np.ndarray) -> tuple:
+    """Rotate a document image to straighten its text lines: Returns (image array, corrected angle degrees)"""
+    angle = estimate_skew(grey)
+    if abs(angle) < SKEW_STEP_DEGREES:
+        return grey, 0.
+    rotated = Image.fromarray(grey).rotate(
+        angle,
+        resample=Image.BILINEAR,
+        expand=True,
+        fillcolor=int(np.percentile(grey, 90)),  # Fill with (approximately) the paper colour
+    )
+    return np.asarray(rotated), angle
+
+
+def stretch_contrast(grey: np.ndarray, low_pct: float=1, high_pct: float=99) -> np.ndarray:
+    low, high = np.percentile(grey, (low_pct, high_pct))
+    if high - low < 1:
+        return grey
+    scaled = (grey.astype(np.float32) - low) * (255. / (high - low))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def enhance_image(img: Image.Image, max_side: int=DEFAULT_MAX_SIDE) -> tuple:
+    """Enhance a document image: Returns (enhanced greyscale PIL image, {step name: milliseconds}, skew angle)"""
+    timings = {}
+    t_start = time.perf_counter()
+
+    def lap(step_name: str):
+        nonlocal t_start
+        now = time.perf_counter()
+        timings[step_name] = (now - t_start) * 1000
+        t_start = now
+
+    orientation = exif_orientation(img)
+    img.draft("L", (max_side, max_side))  # (Decode JPEGs at reduced scale, if they're big)
+    img = img.convert("L")
+    img.thumbnail((max_side, max_side))
+    img = apply_orientation(img, orientation)  # (Output won't carry EXIF tags, so apply it to the pixels)
+    grey = np.asarray(img)
+    lap("DecodeMs")
+    grey = median_denoise(grey)
+    lap("DenoiseMs")
+    grey = crop_to_document(grey)
+    lap("CropMs")
+    grey, angle = deskew(grey)
+    lap("DeskewMs")
+    grey = stretch_contrast(grey)
+    lap("ContrastMs")
+    return Image.fromarray(grey), timings, angle
+
+
+def encode_jpeg(img: Image.Image, quality: int=90) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
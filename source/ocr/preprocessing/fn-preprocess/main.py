@@ -1,20 +1,56 @@
 """Lambda function to apply a 2-class good/bad Rekognition Custom Labels classifier to an S3 image
+
+Also handles scheduled { "Action": "ManageModel" } events, to stop the model when it's been idle for a while (see
+model_manager.py).
 """
 
 # Python Built-Ins:
-import json
 import boto3
 import os
+import time
 
 # External Dependencies:
 from botocore.exceptions import ClientError
+from PIL import Image
+
+# Local Dependencies:
+from enhancement import encode_jpeg, enhance_image
+from model_manager import ModelManager, ModelStarting, ModelUnavailable
+from normalisation import normalise_image, spool_stream
+from quality_gate import assess_image
+from config_cache import get_parameter, refresh_parameter  # (From common layer)
+from metrics import emit_metrics, DEFAULT_NAMESPACE as METRICS_NAMESPACE  # (From common layer)
+from result_cache import cache_from_env, s3_content_fingerprint  # (From common layer)
 
 rekognition = boto3.client("rekognition")
-ssm = boto3.client("ssm")
+s3 = boto3.client("s3")
+
+result_cache = cache_from_env("PreProcess")  # None if caching not configured
 
 default_model_arn_param = os.environ.get("REKOGNITION_MODEL_ARN_PARAM")
 min_inference_units = int(os.environ.get("REKOGNITION_MIN_INFERENCE_UNITS", 1))
+max_inference_units = int(os.environ.get("REKOGNITION_MAX_INFERENCE_UNITS", min_inference_units))
+requests_per_unit_minute = float(os.environ.get("REKOGNITION_REQUESTS_PER_UNIT_MINUTE", 300))
+idle_stop_minutes = int(os.environ.get("REKOGNITION_IDLE_STOP_MINUTES", 0))
+# Judge clear-cut good/bad images locally, only calling the Rekognition model for ambiguous ones:
+use_local_quality_gate = os.environ.get("LOCAL_QUALITY_GATE", "false").lower() in ("1", "true", "yes")
+# Try to rescue images judged 'bad' by enhancing them (saving the result to the processed bucket) and re-checking:
+processed_bucket_name = os.environ.get("PROCESSED_BUCKET_NAME")
+enhance_bad_images = bool(processed_bucket_name) and (
+    os.environ.get("ENHANCE_BAD_IMAGES", "false").lower() in ("1", "true", "yes")
+)
+# Downscale/greyscale/re-encode accepted images (to the processed bucket) to cut OCR payload size and latency:
+normalise_images = bool(processed_bucket_name) and (
+    os.environ.get("NORMALISE_IMAGES", "false").lower() in ("1", "true", "yes")
+)
+normalise_max_pixels = int(os.environ.get("NORMALISE_MAX_PIXELS", 3000000))
+normalise_min_bytes = int(os.environ.get("NORMALISE_MIN_BYTES", 256 * 1024))  # Smaller images are left as-is
+normalise_greyscale = os.environ.get("NORMALISE_GREYSCALE", "false").lower() in ("1", "true", "yes")
 
+MODEL_METRICS_DIMENSIONS = { "Function": "PreProcess" }
+model_managers = {}  # Model ARN -> ModelManager, kept for the life of the container
+
+MIN_CONFIDENCE = 50  # TODO: Parameterize min confidence?
 LABEL_CLASSES = ("bad", "good")  # Other labels outside this set will be ignored
 ACCEPTABLE_CLASSES = ("good",)  # Any other LABEL_CLASSES labels are deemed unacceptable/"bad"
 
@@ -29,76 +65,162 @@ class PoorQualityImage(ValueError):
     pass
 
 
-# TODO: Either integrate this orphaned enhancement logic or remove it
-def enhancedment_image(labels, bucket, photo):
-    """method for enhancement image"""
-    # define lambda client and environment variables
-    lambda_client = boto3.client('lambda')
-    lambda_arn = os.environ['LAMBDA_ENHANCED_IMAGE_ARN']
-    
-    label_name = labels[0]['Name']
-    confidence_score = labels[0]['Confidence']
-    if label_name == 'bad':
-        enhanced_response = lambda_client.invoke(FunctionName=lambda_arn,Payload=json.dumps({'bucket':bucket, 'imageName':photo}))
-        res_dict = json.loads(enhanced_response['Payload'].read().decode())
-        if res_dict['after']['label'] == "good":
-            labels_bak = [{'Name': res_dict['after']['label'], 'Confidence': res_dict['after']['confidence']}]
+class SourceImage:
+    """An S3 image downloaded at most once (on first use) and spooled, for re-use by each local processing stage
 
-def handler(event, context):
-    try:
-        bucket = event["Bucket"]
-        photo = event["Key"]
-    except KeyError as ke:
-        raise MalformedRequest(f"Missing field {ke}, please check your input payload")
+    The local quality gate, enhancement and normalisation may all need the image content: Sharing one spooled copy
+    saves re-downloading a potentially large upload for each of them. Call `close()` when done.
+    """
+    def __init__(self, bucket: str, key: str, s3_client):
+        self.bucket = bucket
+        self.key = key
+        self.s3_client = s3_client
+        self.content_length = None
+        self._file = None
 
+    def open(self):
+        """Return a seekable binary file of the content, rewound to the start"""
+        if self._file is None:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+            self.content_length = response["ContentLength"]
+            self._file = spool_stream(response["Body"])
+        self._file.seek(0)
+        return self._file
+
+    def read(self) -> bytes:
+        return self.open().read()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def is_configured(param_value: str) -> bool:
+    return bool(param_value) and param_value.lower() not in ("undefined", "null")
+
+
+def resolve_model_arn(event) -> tuple:
+    """Find the model ARN for a request: Returns (model_arn, is_from_cached_param)"""
     if "RekognitionModelArn" in event:
-        model_arn = event["RekognitionModelArn"]
+        return event["RekognitionModelArn"], False
     elif default_model_arn_param is not None:
-        model_arn = ssm.get_parameter(Name=default_model_arn_param)["Parameter"]["Value"]
-        if (not model_arn) or model_arn.lower() in ("undefined", "null"):
+        model_arn = get_parameter(default_model_arn_param)
+        if not is_configured(model_arn):
+            # Maybe the parameter has been set up since we cached it:
+            model_arn = refresh_parameter(default_model_arn_param)
+        if not is_configured(model_arn):
             raise MalformedRequest(
                 "Neither request RekognitionModelArn nor expected SSM parameter are set. Got: "
                 f"{default_model_arn_param} = '{model_arn}'"
             )
+        return model_arn, True
     else:
         raise MalformedRequest(
             "Neither request RekognitionModelArn nor env var REKOGNITION_MODEL_ARN_PARAM specified"
         )
 
+
+def get_model_manager(model_arn: str) -> ModelManager:
+    if model_arn not in model_managers:
+        try:
+            model_managers[model_arn] = ModelManager(
+                model_arn,
+                min_inference_units=min_inference_units,
+                max_inference_units=max_inference_units,
+                requests_per_unit_minute=requests_per_unit_minute,
+                idle_stop_minutes=idle_stop_minutes,
+                metrics_namespace=METRICS_NAMESPACE,
+                metrics_dimensions=MODEL_METRICS_DIMENSIONS,
+                rekognition_client=rekognition,
+            )
+        except ValueError as e:
+            raise MalformedRequest(str(e))
+    return model_managers[model_arn]
+
+
+def manage_model(event) -> dict:
+    """Handle a scheduled model management event: Stop the model if it's been idle
+
+    The schedule runs from deployment, possibly before any model is set up - so with no model configured, there's
+    nothing to manage and this is a no-op.
+    """
+    try:
+        model_arn, _ = resolve_model_arn(event)
+    except MalformedRequest as e:
+        print(f"No model to manage: {e}")
+        return { "ModelArn": None, "Status": None, "Stopped": False }
+    manager = get_model_manager(model_arn)
+    stopped = manager.stop_if_idle()
+    return { "ModelArn": model_arn, "Status": manager.status(), "Stopped": stopped }
+
+
+def handler(event, context):
+    if event.get("Action") == "ManageModel":
+        return manage_model(event)
+
+    try:
+        bucket = event["Bucket"]
+        photo = event["Key"]
+    except KeyError as ke:
+        raise MalformedRequest(f"Missing field {ke}, please check your input payload")
+
+    model_arn, is_model_arn_cached = resolve_model_arn(event)
+
     # TODO: logging output instead of prints
     print(f"Analyzing s3://{bucket}/{photo}")
+    source = SourceImage(bucket, photo, s3)
+    try:
+        return analyze_image(source, model_arn, is_model_arn_cached)
+    finally:
+        source.close()
+
+
+def analyze_image(source: SourceImage, model_arn: str, is_model_arn_cached: bool=False) -> dict:
+    """Classify (and optionally rescue and normalise) the `source` image with the given model"""
+    bucket = source.bucket
+    photo = source.key
+
+    # Duplicate uploads of an image already classified by the same model can re-use the previous labels:
+    fingerprint = None
+    if result_cache is not None:
+        fingerprint = s3_content_fingerprint(bucket, photo, s3_client=s3)
+        cached = None if fingerprint is None else result_cache.get(fingerprint, variant=model_arn)
+        if cached is not None:
+            print(f"Re-using cached labels for s3://{bucket}/{photo}")
+            return process_labelled_image(cached["Labels"], source, model_arn)
+
+    if use_local_quality_gate:
+        local_label = get_local_quality_label(source)
+        if local_label is not None:
+            return process_labelled_image([local_label], source, model_arn)
+
+    # If we already know the model isn't ready, there's no point trying it:
+    model_manager = get_model_manager(model_arn)
+    if model_manager.cached_status not in (None, "RUNNING"):
+        check_model_running(model_manager)
 
     # Analyze the image in S3:
-    # TODO: Parameterize min confidence?
-    minimum_confidence = 50
     try:
         labels = rekognition.detect_custom_labels(
             Image={ "S3Object": { "Bucket": bucket, "Name": photo } },
-            MinConfidence=minimum_confidence,
+            MinConfidence=MIN_CONFIDENCE,
             ProjectVersionArn=model_arn,
         )["CustomLabels"]
     except rekognition.exceptions.ResourceNotFoundException:
+        if is_model_arn_cached:
+            # The parameter may have been updated to a new model since we cached it:
+            refreshed_model_arn = refresh_parameter(default_model_arn_param)
+            if refreshed_model_arn != model_arn and is_configured(refreshed_model_arn):
+                print(f"Model {model_arn} not found: Retrying with updated model {refreshed_model_arn}")
+                return analyze_image(source, refreshed_model_arn)
         raise ModelError(f"Resource not found: Check your Rekognition Custom Labels model ARN {model_arn}")
     except rekognition.exceptions.ResourceNotReadyException:
-        print(f"Trying to start Rekognition model {model_arn}")
-        try:
-            start_version_response = rekognition.start_project_version(
-                ProjectVersionArn=model_arn,
-                MinInferenceUnits=min_inference_units,
-            )
-            print(start_version_response)
-        except Exception as e:
-            raise ModelError(f"Model not ready and couldn't be started: {e}")
-
-        # There is a get_waiter("project_version_running") available in the Rekognition Boto3 SDK, but it
-        # requires the project ARN which at the time of writing can't be easily derived from the version ARN
-        # (because it contains a different, project-related timestamp).
-        #
-        # Anyway we only provide this convenience to auto-start the version on first invokation to simplify
-        # setup because Rek CL console doesn't currently have a UI option to start versions... So to keep our
-        # Lambda config DRY and this code simple, we'll just return an error here telling the user to try
-        # again when the model is ready.
-        raise ModelError(f"Rekognition model now deploying... Please try again shortly")
+        # Start the model if needed. Raising ModelStarting lets the Step Functions Retry policy hold this
+        # request until the model is up, rather than failing it:
+        model_manager.mark_not_ready()
+        check_model_running(model_manager)
+        raise ModelStarting(f"Rekognition model {model_arn} not ready yet: Please retry shortly")
     except rekognition.exceptions.InvalidS3ObjectException:
         raise MalformedRequest(
             f"Invalid S3 object location 's3://{bucket}/{photo}', please check your request'"
@@ -113,7 +235,175 @@ def handler(event, context):
     except Exception as e:
         raise ModelError(f"Unknown exception querying Rekognition: {e}")
 
-    # Judge the image from the returned labels:
+    # Only count requests the (running) model actually served, since retries while it starts would inflate the
+    # request rate used to size and idle-stop the model:
+    emit_metrics({ "ModelRequests": 1 }, dimensions=MODEL_METRICS_DIMENSIONS)
+    if fingerprint is not None:
+        result_cache.put(fingerprint, { "Labels": labels }, variant=model_arn)
+    return process_labelled_image(labels, source, model_arn)
+
+
+def get_local_quality_label(source: SourceImage):
+    """Run the local quality gate: Returns a Rekognition-like label if decided locally, or None to escalate"""
+    try:
+        assessment = assess_image(source.read())
+    except Exception as e:
+        # e.g. PDFs or other formats we can't decode - leave it to the model:
+        print(f"Local quality gate couldn't assess image: {e}")
+        return None
+    print(f"Local quality assessment: {assessment}")
+    emit_metrics(
+        { "LocalQualityGateDecided": int(assessment["Label"] is not None) },
+        dimensions=MODEL_METRICS_DIMENSIONS,
+    )
+    if assessment["Label"] is None:
+        return None
+    return { "Name": assessment["Label"], "Confidence": assessment["Confidence"] }
+
+
+def check_model_running(model_manager: ModelManager):
+    """Return if the model is running, else raise ModelStarting (after starting it if needed) or ModelError"""
+    try:
+        model_manager.ensure_running()
+    except ModelUnavailable as e:
+        raise ModelError(str(e))
+    except ClientError as ce:
+        raise ModelError(f"ClientError while checking Rekognition model status: {ce}")
+
+
+def process_labelled_image(labels: list, source: SourceImage, model_arn: str) -> dict:
+    """Judge the image from its labels (trying to rescue 'bad' images by enhancement if enabled) then normalise"""
+    try:
+        result = judge_labels(labels, source.bucket, source.key)
+    except PoorQualityImage:
+        if not enhance_bad_images:
+            raise
+        result = rescue_image(source, model_arn)
+        if result is None:
+            raise
+    if not normalise_images:
+        return result
+    if (result["Bucket"], result["Key"]) == (source.bucket, source.key):
+        return normalise_output(result, source)
+    # Rescued results point to the enhanced image instead:
+    enhanced = SourceImage(result["Bucket"], result["Key"], s3)
+    try:
+        return normalise_output(result, enhanced)
+    finally:
+        enhanced.close()
+
+
+def normalise_output(result: dict, image: SourceImage) -> dict:
+    """Replace the result `image` with a downscaled/re-encoded copy in the processed bucket, if that's smaller"""
+    t_start = time.perf_counter()
+    try:
+        fileobj = image.open()
+        original_bytes = image.content_length
+        if original_bytes <= normalise_min_bytes:
+            return result
+        normalised_bytes, info = normalise_image(
+            fileobj,
+            max_pixels=normalise_max_pixels,
+            greyscale=normalise_greyscale,
+        )
+    except Exception as e:
+        # e.g. PDFs or other formats we can't decode - Textract can still take the original:
+        print(f"Couldn't normalise image, using original: {e}")
+        return result
+    print("Normalised image from {} ({} bytes) to {} ({} bytes) in {:.0f}ms".format(
+        info["OriginalSize"],
+        original_bytes,
+        info["Size"],
+        len(normalised_bytes),
+        (time.perf_counter() - t_start) * 1000,
+    ))
+    emit_metrics(
+        { "NormaliseInputBytes": original_bytes, "NormaliseOutputBytes": len(normalised_bytes) },
+        dimensions=MODEL_METRICS_DIMENSIONS,
+        unit="Bytes",
+    )
+    if len(normalised_bytes) >= original_bytes:
+        return result
+
+    # (Enhanced images are already in the processed bucket, so don't need prefixing with their bucket name)
+    normalised_key = "{}.normalised.jpg".format(
+        result["Key"] if result["Bucket"] == processed_bucket_name else f"{result['Bucket']}/{result['Key']}"
+    )
+    s3.put_object(
+        Bucket=processed_bucket_name,
+        Key=normalised_key,
+        Body=normalised_bytes,
+        ContentType="image/jpeg",
+    )
+    return {
+        **result,
+        "Bucket": processed_bucket_name,
+        "Key": normalised_key,
+        "S3Uri": f"s3://{processed_bucket_name}/{normalised_key}",
+    }
+
+
+def rescue_image(source: SourceImage, model_arn: str):
+    """Enhance a 'bad' image, save it to the processed bucket and re-check it: Returns the result if now good"""
+    bucket = source.bucket
+    photo = source.key
+    print(f"Attempting to enhance s3://{bucket}/{photo}")
+    try:
+        with Image.open(source.open()) as img:
+            enhanced, timings, angle = enhance_image(img)
+    except Exception as e:
+        print(f"Couldn't enhance image: {e}")
+        return None
+    print(f"Enhanced image (deskewed {angle:.2f} degrees): Step timings {timings}")
+    emit_metrics(
+        { f"Enhance{step}": ms for step, ms in timings.items() },
+        dimensions=MODEL_METRICS_DIMENSIONS,
+        unit="Milliseconds",
+    )
+
+    enhanced_bytes = encode_jpeg(enhanced)
+    enhanced_key = f"{bucket}/{photo}.enhanced.jpg"
+    s3.put_object(
+        Bucket=processed_bucket_name,
+        Key=enhanced_key,
+        Body=enhanced_bytes,
+        ContentType="image/jpeg",
+    )
+
+    # Re-check the enhanced image - locally if possible, or else with the model:
+    labels = None
+    if use_local_quality_gate:
+        assessment = assess_image(enhanced_bytes)
+        if assessment["Label"] is not None:
+            labels = [{ "Name": assessment["Label"], "Confidence": assessment["Confidence"] }]
+    if labels is None:
+        try:
+            labels = rekognition.detect_custom_labels(
+                Image={ "S3Object": { "Bucket": processed_bucket_name, "Name": enhanced_key } },
+                MinConfidence=MIN_CONFIDENCE,
+                ProjectVersionArn=model_arn,
+            )["CustomLabels"]
+        except Exception as e:
+            print(f"Couldn't classify enhanced image: {e}")
+            return None
+        emit_metrics({ "ModelRequests": 1 }, dimensions=MODEL_METRICS_DIMENSIONS)
+
+    try:
+        result = judge_labels(labels, processed_bucket_name, enhanced_key)
+    except PoorQualityImage:
+        print("Enhanced image still not acceptable")
+        return None
+    # Downstream stages should use the enhanced image, but the execution's original Input is still the upload:
+    result["Input"] = {
+        "Bucket": bucket,
+        "Key": photo,
+        "S3Uri": f"s3://{bucket}/{photo}",
+    }
+    return result
+
+
+def judge_labels(labels: list, bucket: str, photo: str) -> dict:
+    """Judge the image from the returned Rekognition labels, raising PoorQualityImage if unacceptable"""
     print(labels)
     if not len(labels):
         raise PoorQualityImage(f"Model returned no labels")
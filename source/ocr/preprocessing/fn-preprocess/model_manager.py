@@ -0,0 +1,227 @@
+"""Lifecycle management for Rekognition Custom Labels model versions: Readiness, start-up, scaling and idle stop
+
+Custom Labels models take several minutes to start, and are charged for every minute they're running - whether
+or not any requests arrive. This module:
+
+- Tracks model version status (via DescribeProjectVersions, cached briefly) so handlers can tell straight away
+  whether the model is ready, without a failed inference call per request.
+- Starts stopped models on demand, raising a retryable `ModelStarting` error meanwhile: The Step Functions
+  state's Retry policy holds each request and re-tries it once the model is up, so documents arriving during
+  start-up are delayed rather than lost.
+- Sizes `MinInferenceUnits` at start-up from the recently observed request rate (published by the handler as a
+  `ModelRequests` CloudWatch metric), letting Rekognition auto-scale up to `MaxInferenceUnits` while running.
+- Stops the model after a configurable period with no requests (checked by a scheduled invocation).
+
+All AWS clients can be passed in, so the manager can be exercised offline against stand-in client objects.
+"""
+
+# Python Built-Ins:
+from datetime import datetime, timedelta
+import math
+import time
+
+# External Dependencies:
+import boto3
+
+
+# Statuses from which a model version can be started:
+STARTABLE_STATUSES = ("STOPPED", "TRAINING_COMPLETED")
+# Statuses in which the model will be (or may soon be made) available without intervention:
+TRANSITIONAL_STATUSES = ("STARTING", "STOPPING")
+
+
+class ModelStarting(RuntimeError):
+    """Raised while the model is not yet running: Configure a Step Functions Retry on this to hold requests"""
+    pass
+
+class ModelUnavailable(RuntimeError):
+    """Raised if the model is in a state from which it can't be started (e.g. training failed)"""
+    pass
+
+
+def parse_project_version_arn(model_arn: str) -> tuple:
+    """Extract (project name, version name) from a Rekognition Custom Labels project version ARN
+
+    Version ARNs look like:
+    arn:aws:rekognition:{region}:{account}:project/{project}/version/{version}/{timestamp}
+    """
+    try:
+        resource = model_arn.split(":", 5)[5]
+        resource_type, project_name, version_marker, version_name, _ = resource.split("/")
+        if resource_type != "project" or version_marker != "version":
+            raise ValueError()
+    except (IndexError, ValueError):
+        raise ValueError(f"Not a Rekognition Custom Labels project version ARN: '{model_arn}'")
+    return project_name, version_name
+
+
+class ModelManager:
+    """Manage the lifecycle of one Rekognition Custom Labels model version
+
+    Parameters
+    ----------
+    model_arn :
+        Project version ARN of the model
+    min_inference_units :
+        Lower bound for the number of inference units to start the model with
+    max_inference_units :
+        Upper bound for inference units (at start-up, and for Rekognition auto-scaling while running)
+    requests_per_unit_minute :
+        Approximate request throughput of one inference unit, per minute, used to size the model from the
+        observed request rate. This varies by model, so measure yours!
+    idle_stop_minutes :
+        Stop the running model after this many minutes without requests (0 = never stop automatically)
+    status_ttl_seconds :
+        How long to trust a previously-fetched model status before describing the model again
+    """
+    def __init__(
+        self,
+        model_arn: str,
+        min_inference_units: int=1,
+        max_inference_units: int=1,
+        requests_per_unit_minute: float=300,
+        idle_stop_minutes: int=0,
+        status_ttl_seconds: float=15,
+        metrics_namespace: str="SmartOCR",
+        metrics_dimensions: dict=None,
+        rekognition_client=None,
+        cloudwatch_client=None,
+    ):
+        self.model_arn = model_arn
+        self.project_name, self.version_name = parse_project_version_arn(model_arn)
+        self.min_inference_units = min_inference_units
+        self.max_inference_units = max(min_inference_units, max_inference_units)
+        self.requests_per_unit_minute = requests_per_unit_minute
+        self.idle_stop_minutes = idle_stop_minutes
+        self.status_ttl_seconds = status_ttl_seconds
+        self.metrics_namespace = metrics_namespace
+        self.metrics_dimensions = metrics_dimensions or {}
+        self.rekognition = rekognition_client or boto3.client("rekognition")
+        self._cloudwatch = cloudwatch_client
+        self._project_arn = None
+        self._status = None
+        self._status_time = 0
+
+    @property
+    def cloudwatch(self):
+        if self._cloudwatch is None:
+            self._cloudwatch = boto3.client("cloudwatch")
+        return self._cloudwatch
+
+    @property
+    def project_arn(self) -> str:
+        """Project ARN for the model (which has a different timestamp, so can't be derived from the version ARN)"""
+        if self._project_arn is None:
+            projects = self.rekognition.describe_projects(ProjectNames=[self.project_name])["ProjectDescriptions"]
+            if not len(projects):
+                raise ModelUnavailable(f"Rekognition project '{self.project_name}' not found")
+            self._project_arn = projects[0]["ProjectArn"]
+        return self._project_arn
+
+    def describe(self) -> dict:
+        """Fetch the model version's description (ignoring the status cache) and refresh the cached status"""
+        versions = self.rekognition.describe_project_versions(
+            ProjectArn=self.project_arn,
+            VersionNames=[self.version_name],
+        )["ProjectVersionDescriptions"]
+        if not len(versions):
+            raise ModelUnavailable(f"Rekognition model version {self.model_arn} not found")
+        self._status = versions[0]["Status"]
+        self._status_time = time.time()
+        return versions[0]
+
+    def status(self, max_age_seconds: float=None) -> str:
+        """Model version status e.g. 'RUNNING', 'STARTING', 'STOPPED' (cached for up to `status_ttl_seconds`)"""
+        max_age_seconds = self.status_ttl_seconds if max_age_seconds is None else max_age_seconds
+        if self._status is None or time.time() - self._status_time > max_age_seconds:
+            self.describe()
+        return self._status
+
+    @property
+    def cached_status(self) -> str:
+        """Model status if known from within the last `status_ttl_seconds`, else None (no API calls)"""
+        if self._status is None or time.time() - self._status_time > self.status_ttl_seconds:
+            return None
+        return self._status
+
+    def mark_not_ready(self):
+        """Record that an inference call reported the model not ready, so the next check re-describes it"""
+        self._status = None
+
+    def ensure_running(self):
+        """Return if the model is running, otherwise start it if possible and raise ModelStarting
+
+        Raises ModelUnavailable if the model is in a failed or otherwise unstartable state.
+        """
+        status = self.status()
+        if status == "RUNNING":
+            return
+        elif status in STARTABLE_STATUSES:
+            self.start()
+            raise ModelStarting(f"Rekognition model {self.model_arn} was {status}: Now starting")
+        elif status in TRANSITIONAL_STATUSES:
+            # (A STOPPING model will be found STOPPED and restarted by a later retry)
+            raise ModelStarting(f"Rekognition model {self.model_arn} is {status}: Please retry shortly")
+        else:
+            raise ModelUnavailable(f"Rekognition model {self.model_arn} is {status} and can't be started")
+
+    def start(self):
+        """Start the model version, sized from the recently observed request rate"""
+        inference_units = self.desired_inference_units()
+        print(f"Starting Rekognition model {self.model_arn} with {inference_units} inference units")
+        request = { "ProjectVersionArn": self.model_arn, "MinInferenceUnits": inference_units }
+        if self.max_inference_units > inference_units:
+            # Let Rekognition auto-scale the running model in case traffic grows:
+            request["MaxInferenceUnits"] = self.max_inference_units
+        try:
+            self.rekognition.start_project_version(**request)
+        except self.rekognition.exceptions.ResourceInUseException:
+            pass  # Another invocation got there first
+        self._status = "STARTING"
+        self._status_time = time.time()
+        return inference_units
+
+    def stop(self):
+        print(f"Stopping Rekognition model {self.model_arn}")
+        self.rekognition.stop_project_version(ProjectVersionArn=self.model_arn)
+        self._status = "STOPPING"
+        self._status_time = time.time()
+
+    def observed_requests(self, minutes: int) -> float:
+        """Total ModelRequests metric published over the last `minutes` minutes"""
+        end = datetime.utcnow()
+        datapoints = self.cloudwatch.get_metric_statistics(
+            Namespace=self.metrics_namespace,
+            MetricName="ModelRequests",
+            Dimensions=[{ "Name": k, "Value": v } for k, v in self.metrics_dimensions.items()],
+            StartTime=end - timedelta(minutes=minutes),
+            EndTime=end,
+            Period=60 * minutes,
+            Statistics=["Sum"],
+        )["Datapoints"]
+        return sum(d["Sum"] for d in datapoints)
+
+    def desired_inference_units(self, window_minutes: int=15) -> int:
+        """Inference units needed for the request rate observed over the last `window_minutes`"""
+        if self.max_inference_units <= self.min_inference_units:
+            return self.min_inference_units  # Nothing to decide
+        try:
+            rate_per_minute = self.observed_requests(window_minutes) / window_minutes
+        except Exception as e:
+            print(f"Couldn't fetch observed request rate, using minimum inference units: {e}")
+            return self.min_inference_units
+        units = math.ceil(rate_per_minute / self.requests_per_unit_minute)
+        return min(self.max_inference_units, max(self.min_inference_units, units))
+
+    def stop_if_idle(self) -> bool:
+        """Stop the model if running with no requests in the last `idle_stop_minutes`: Returns True if stopped"""
+        if not self.idle_stop_minutes:
+            return False
+        if self.status(max_age_seconds=0) != "RUNNING":
+            return False
+        n_requests = self.observed_requests(self.idle_stop_minutes)
+        if n_requests > 0:
+            print(f"Model {self.model_arn} had {n_requests} requests in last {self.idle_stop_minutes} mins")
+            return False
+        self.stop()
+        return True
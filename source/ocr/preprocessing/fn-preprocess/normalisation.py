@@ -0,0 +1,97 @@
+"""Image normalisation for OCR: Downscale to a pixel budget, convert to greyscale, and re-encode as JPEG
+
+Phone photos of receipts are often 8-12 megapixel colour images - far more detail than OCR needs, which costs
+upload/download time, Textract processing latency, and sometimes `ImageTooLargeException` errors. Text stays
+very legible at around 2-4 megapixels for receipt-sized documents, so normalised images are typically several
+times smaller with no loss of OCR accuracy. (Validate this on your own documents before tuning `max_pixels` down!)
+
+To keep memory use bounded for very large inputs:
+
+- Source objects are spooled to local disk (not memory) beyond `SPOOL_MEMORY_BYTES`, and
+- JPEGs use Pillow's `draft()` mode to decode directly at a reduced scale (1/2, 1/4 or 1/8) close to the target
+  size, so the full-resolution image is never decoded.
+
+Other formats (e.g. PNG) are decoded in full before resizing.
+"""
+
+# Python Built-Ins:
+import io
+import math
+import shutil
+import tempfile
+
+# External Dependencies:
+from PIL import Image
+
+SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+DEFAULT_MAX_PIXELS = 3000000
+DEFAULT_JPEG_QUALITY = 85
+
+# Transpose operations to apply for each EXIF Orientation tag value (as in PIL.ImageOps.exif_transpose):
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_TRANSPOSES = {
+    2: (Image.FLIP_LEFT_RIGHT,),
+    3: (Image.ROTATE_180,),
+    4: (Image.FLIP_TOP_BOTTOM,),
+    5: (Image.TRANSPOSE,),
+    6: (Image.ROTATE_270,),
+    7: (Image.TRANSVERSE,),
+    8: (Image.ROTATE_90,),
+}
+
+
+def exif_orientation(img: Image.Image) -> int:
+    """EXIF orientation of an opened image (1 = upright), read before any conversion discards the metadata"""
+    try:
+        return img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    except Exception:
+        return 1
+
+
+def apply_orientation(img: Image.Image, orientation: int) -> Image.Image:
+    """Rotate/flip decoded pixels to match an EXIF `orientation`, since re-encoded outputs won't carry the tag"""
+    for method in EXIF_TRANSPOSES.get(orientation, ()):
+        img = img.transpose(method)
+    return img
+
+
+def spool_stream(stream, max_memory_bytes: int=SPOOL_MEMORY_BYTES):
+    """Copy a (non-seekable) stream e.g. an S3 body to a seekable file, spilling to disk if large"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=max_memory_bytes)
+    shutil.copyfileobj(stream, spooled, length=1024 * 1024)
+    spooled.seek(0)
+    return spooled
+
+
+def target_size(size: tuple, max_pixels: int) -> tuple:
+    """Scale (width, height) `size` down (preserving aspect) to at most `max_pixels`, or return it unchanged"""
+    width, height = size
+    if width * height <= max_pixels:
+        return size
+    scale = math.sqrt(max_pixels / (width * height))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def normalise_image(
+    fileobj,
+    max_pixels: int=DEFAULT_MAX_PIXELS,
+    greyscale: bool=True,
+    quality: int=DEFAULT_JPEG_QUALITY,
+) -> tuple:
+    """Downscale, (optionally) greyscale and JPEG re-encode an image from a seekable binary file object
+
+    Returns (encoded bytes, info dict) where info includes the `OriginalSize` and `Size` (width, height).
+    """
+    mode = "L" if greyscale else "RGB"
+    with Image.open(fileobj) as img:
+        original_size = img.size
+        orientation = exif_orientation(img)
+        size = target_size(original_size, max_pixels)
+        img.draft(mode, size)  # Only affects JPEGs: Decode at the smallest scale still >= target size
+        img = img.convert(mode)
+        if img.size != size:
+            img = img.resize(size, Image.LANCZOS, reducing_gap=2.)
+        img = apply_orientation(img, orientation)
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue(), { "OriginalSize": original_size, "Size": img.size }
@@ -0,0 +1,145 @@
+"""Fast local image quality checks, to skip the Rekognition model for clear-cut good or bad images
+
+Many uploads are either obviously fine (sharp, well exposed, decent resolution) or obviously unusable (tiny,
+blank, badly blurred or over/under exposed) - and don't need an ML model to tell. These checks run in a few tens
+of milliseconds with NumPy on a downscaled greyscale copy of the image:
+
+- **Resolution**: Short side of the original image in pixels
+- **Aspect ratio**: Long side / short side (receipts are tall, but not *that* tall)
+- **Blur**: Variance of the Laplacian - low values mean few sharp edges
+- **Exposure**: Mean brightness, 1st-99th percentile dynamic range (text is only a small fraction of a document's
+  pixels, so the range must be measured near the extremes), and fractions of clipped pixels: Shadows crushed to
+  black, and glare saturated *above* the paper level. A clean scan's paper is often pure white already, so pixels at
+  the paper level itself never count as clipped.
+
+`assess_image()` returns "good" or "bad" only when all checks agree with a comfortable margin, and otherwise
+`None` to escalate the image to the Rekognition model. Thresholds are starting points, which you should tune on
+a sample of your own images (e.g. the training set of your Rekognition model).
+"""
+
+# Python Built-Ins:
+import io
+
+# External Dependencies:
+import numpy as np
+from PIL import Image
+
+ANALYSIS_MAX_SIDE = 512  # Images are downscaled to fit this size (pixels) before analysis
+
+# Each check has a (bad_below, good_above) or (good_below, bad_above) pair, with an ambiguous zone between:
+DEFAULT_THRESHOLDS = {
+    "MinSidePx": (500, 1000),  # bad below, good above
+    "AspectRatio": (4., 8.),  # good below, bad above
+    "LaplacianVariance": (30., 150.),  # bad below, good above
+    "DynamicRange": (25., 60.),  # bad below, good above
+    "ShadowClippedFraction": (0.3, 0.6),  # good below, bad above (dark text alone can be ~10-20% of a page)
+    "GlareFraction": (0.02, 0.1),  # good below, bad above
+    "MeanBrightness": ((30., 250.), (60., 240.)),  # bad outside the first range, good inside the second
+}
+
+SHADOW_CLIP_LEVEL = 2  # Pixels at or below this level are crushed to black
+GLARE_CLIP_LEVEL = 253  # Pixels at or above this level are saturated...
+GLARE_PAPER_MARGIN = 8  # ...but only count as glare if also this far above the paper (brightest histogram peak)
+
+LOCAL_LABEL_CONFIDENCE = 90.  # Reported confidence (0-100 like Rekognition) for clear-cut local decisions
+
+
+def load_analysis_image(image_bytes: bytes, max_side: int=ANALYSIS_MAX_SIDE) -> tuple:
+    """Decode an image to a downscaled greyscale float array: Returns (array, (original_width, original_height))
+
+    JPEG `draft()` mode lets the decoder downscale during decoding, so large photos are never decoded in full.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        original_size = img.size
+        img.draft("L", (max_side, max_side))
+        img = img.convert("L")
+        img.thumbnail((max_side, max_side))
+        return np.asarray(img, dtype=np.float32), original_size
+
+
+def laplacian_variance(grey: np.ndarray) -> float:
+    """Variance of the 4-neighbour Laplacian of a 2D image array (a standard sharpness measure)"""
+    laplacian = (
+        grey[:-2, 1:-1] + grey[2:, 1:-1] + grey[1:-1, :-2] + grey[1:-1, 2:] - 4 * grey[1:-1, 1:-1]
+    )
+    return float(laplacian.var())
+
+
+def clipped_fractions(grey: np.ndarray) -> tuple:
+    """Fractions of pixels (crushed to black, saturated as glare above the paper level) in a 0-255 grey image
+
+    The paper level is taken as the median brightness of the upper half of the histogram: If the paper itself is
+    saturated (as in a clean white scan), nothing is counted as glare.
+    """
+    hist = np.bincount(grey.astype(np.uint8).ravel(), minlength=256)
+    bright_cumulative = np.cumsum(hist[128:])
+    if bright_cumulative[-1]:
+        paper_level = 128 + int(np.searchsorted(bright_cumulative, bright_cumulative[-1] / 2))
+    else:
+        paper_level = 255
+    shadow = hist[:SHADOW_CLIP_LEVEL + 1].sum()
+    glare = hist[max(GLARE_CLIP_LEVEL, paper_level + GLARE_PAPER_MARGIN):].sum()
+    return float(shadow / grey.size), float(glare / grey.size)
+
+
+def image_metrics(grey: np.ndarray, original_size: tuple) -> dict:
+    width, height = original_size
+    p_low, p_high = np.percentile(grey, (1, 99))
+    shadow_fraction, glare_fraction = clipped_fractions(grey)
+    return {
+        "MinSidePx": min(width, height),
+        "AspectRatio": max(width, height) / max(1, min(width, height)),
+        "LaplacianVariance": laplacian_variance(grey),
+        "DynamicRange": float(p_high - p_low),
+        "ShadowClippedFraction": shadow_fraction,
+        "GlareFraction": glare_fraction,
+        "MeanBrightness": float(grey.mean()),
+    }
+
+
+def judge_metrics(metrics: dict, thresholds: dict=DEFAULT_THRESHOLDS) -> tuple:
+    """Classify image `metrics`: Returns ("good"|"bad"|None, [reasons for any 'bad' or ambiguous checks])"""
+    bad = []
+    ambiguous = []
+    for name in ("MinSidePx", "LaplacianVariance", "DynamicRange"):
+        bad_below, good_above = thresholds[name]
+        if metrics[name] < bad_below:
+            bad.append(f"{name} {metrics[name]:.4g} < {bad_below}")
+        elif metrics[name] <= good_above:
+            ambiguous.append(f"{name} {metrics[name]:.4g}")
+    for name in ("AspectRatio", "ShadowClippedFraction", "GlareFraction"):
+        good_below, bad_above = thresholds[name]
+        if metrics[name] > bad_above:
+            bad.append(f"{name} {metrics[name]:.4g} > {bad_above}")
+        elif metrics[name] >= good_below:
+            ambiguous.append(f"{name} {metrics[name]:.4g}")
+    (bad_min, bad_max), (good_min, good_max) = thresholds["MeanBrightness"]
+    brightness = metrics["MeanBrightness"]
+    if not bad_min <= brightness <= bad_max:
+        bad.append(f"MeanBrightness {brightness:.4g} outside {bad_min}-{bad_max}")
+    elif not good_min <= brightness <= good_max:
+        ambiguous.append(f"MeanBrightness {brightness:.4g}")
+
+    if len(bad):
+        return "bad", bad
+    elif len(ambiguous):
+        return None, ambiguous
+    else:
+        return "good", []
+
+
+def assess_image(image_bytes: bytes, thresholds: dict=DEFAULT_THRESHOLDS) -> dict:
+    """Run local quality checks on an encoded image
+
+    Returns a dict with `Label` ("good", "bad", or None if the model should decide), `Confidence` (0-100),
+    `Metrics`, and `Reasons` (list of failed/ambiguous check descriptions).
+    """
+    grey, original_size = load_analysis_image(image_bytes)
+    metrics = image_metrics(grey, original_size)
+    label, reasons = judge_metrics(metrics, thresholds)
+    return {
+        "Label": label,
+        "Confidence": LOCAL_LABEL_CONFIDENCE if label else 0,
+        "Metrics": metrics,
+        "Reasons": reasons,
+    }
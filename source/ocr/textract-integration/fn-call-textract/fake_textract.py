@@ -0,0 +1,233 @@
+"""Local fake Textract (and S3) for exercising the async paging and streaming paths offline
+
+`FakeTextract` implements just the Textract API calls this function makes, over a synthetic document of as many
+pages as you like: StartDocumentAnalysis (idempotent per ClientRequestToken), GetDocumentAnalysis (reporting
+IN_PROGRESS for the first few polls, then paging results by NextToken/MaxResults) and AnalyzeDocument. `FakeS3`
+keeps objects in memory, and tracks the largest part sent to multipart uploads.
+
+Run as a script to push a large document through the handler exactly as Step Functions would - starting the job,
+then polling with its JobId and retrying on `WaitingForJob` - and check the saved result against the pages Textract
+returned:
+
+    python fake_textract.py --pages 500 --format JSON
+"""
+
+# Python Built-Ins:
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+DEFAULT_BLOCKS_PER_PAGE = 400
+
+
+class FakeTextract:
+    """In-memory stand-in for a boto3 Textract client, over a synthetic `n_pages` document
+
+    Parameters
+    ----------
+    n_pages :
+        Number of pages in the (every) analyzed document
+    blocks_per_page :
+        Number of blocks Textract returns per page (one PAGE block, then LINEs)
+    polls_until_done :
+        Number of GetDocumentAnalysis calls per job that report IN_PROGRESS before results are available
+    status :
+        Final job status, e.g. "FAILED" to exercise the error path
+    """
+    def __init__(
+        self,
+        n_pages: int=3,
+        blocks_per_page: int=DEFAULT_BLOCKS_PER_PAGE,
+        polls_until_done: int=2,
+        status: str="SUCCEEDED",
+    ):
+        self.n_pages = n_pages
+        self.blocks_per_page = blocks_per_page
+        self.polls_until_done = polls_until_done
+        self.status = status
+        self.jobs = {}  # JobId -> number of polls so far
+        self.jobs_by_token = {}
+        self.calls = { "StartDocumentAnalysis": 0, "GetDocumentAnalysis": 0, "AnalyzeDocument": 0 }
+
+    def page_blocks(self, page: int) -> list:
+        blocks = [{ "BlockType": "PAGE", "Id": f"p{page}", "Page": page, "Confidence": 99.9 }]
+        for ix in range(1, self.blocks_per_page):
+            blocks.append({
+                "BlockType": "LINE",
+                "Id": f"p{page}-l{ix}",
+                "Page": page,
+                "Confidence": 95.,
+                "Text": f"Page {page} line {ix}: Item {ix * 7 % 100} 12.50",
+            })
+        return blocks
+
+    def start_document_analysis(self, DocumentLocation, FeatureTypes, ClientRequestToken=None, **kwargs):
+        self.calls["StartDocumentAnalysis"] += 1
+        if ClientRequestToken in self.jobs_by_token:
+            return { "JobId": self.jobs_by_token[ClientRequestToken] }
+        job_id = uuid.uuid4().hex
+        self.jobs[job_id] = 0
+        if ClientRequestToken:
+            self.jobs_by_token[ClientRequestToken] = job_id
+        return { "JobId": job_id }
+
+    def get_document_analysis(self, JobId, MaxResults=1000, NextToken=None):
+        """Return results a page (of up to `MaxResults` blocks) at a time, as the real API does"""
+        self.calls["GetDocumentAnalysis"] += 1
+        self.jobs[JobId] += 1
+        if self.jobs[JobId] <= self.polls_until_done:
+            return { "JobStatus": "IN_PROGRESS" }
+        if self.status not in ("SUCCEEDED", "PARTIAL_SUCCESS"):
+            return { "JobStatus": self.status, "StatusMessage": "Fake failure" }
+
+        # Tokens here are just the index of the next block (counting across all pages):
+        start = int(NextToken or 0)
+        end = min(start + MaxResults, self.n_pages * self.blocks_per_page)
+        blocks = []
+        for page in range(start // self.blocks_per_page + 1, (end - 1) // self.blocks_per_page + 2):
+            page_start = (page - 1) * self.blocks_per_page
+            blocks.extend(self.page_blocks(page)[max(0, start - page_start):end - page_start])
+        response = {
+            "JobStatus": self.status,
+            "DocumentMetadata": { "Pages": self.n_pages },
+            "Blocks": blocks,
+            "Warnings": [],
+            "AnalyzeDocumentModelVersion": "1.0",
+        }
+        if end < self.n_pages * self.blocks_per_page:
+            response["NextToken"] = str(end)
+        return response
+
+    def analyze_document(self, Document, FeatureTypes, **kwargs):
+        self.calls["AnalyzeDocument"] += 1
+        return {
+            "DocumentMetadata": { "Pages": 1 },
+            "Blocks": self.page_blocks(1),
+            "AnalyzeDocumentModelVersion": "1.0",
+        }
+
+
+class FakeS3:
+    """In-memory stand-in for the boto3 S3 client calls used by this function"""
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.max_part_bytes = 0
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = bytes(Body)
+        return { "ETag": f'"{uuid.uuid4().hex}"' }
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {}
+        return { "UploadId": upload_id }
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = Body
+        self.max_part_bytes = max(self.max_part_bytes, len(Body))
+        return { "ETag": f'"part{PartNumber}"' }
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(parts[p["PartNumber"]] for p in MultipartUpload["Parts"])
+        return { "ETag": f'"{uuid.uuid4().hex}-{len(parts)}"' }
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+
+def load_function():
+    """Import this function's main module, with the common layer importable as in Lambda"""
+    function_dir = os.path.dirname(os.path.abspath(__file__))
+    common_dir = os.path.join(os.path.dirname(os.path.dirname(function_dir)), "common")
+    sys.path[:0] = [function_dir, common_dir]
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")  # (Clients are created on import, but never called)
+    os.environ.pop("RESULT_CACHE_TABLE_NAME", None)
+    import main
+    return main
+
+
+def run(args) -> dict:
+    main = load_function()
+    fake_textract = FakeTextract(args.pages, blocks_per_page=args.blocks_per_page, polls_until_done=args.polls)
+    fake_s3 = FakeS3()
+    main.textract = fake_textract
+    main.s3 = fake_s3
+    main.is_textract_sync = False
+    event = {
+        "Input": { "Bucket": "fake-input", "Key": "document.pdf", "RequestToken": "fake-execution" },
+        "Output": { "Bucket": "fake-output", "Format": args.format },
+    }
+
+    # Start the job, then poll the way the state machine's Retry policy does (minus the waiting):
+    tracemalloc.start()
+    t_start = time.perf_counter()
+    event["JobId"] = main.handler(event, None)["JobId"]
+    for attempt in range(1, args.polls + 2):
+        try:
+            output = main.handler(event, None)
+            break
+        except main.WaitingForJob as e:
+            print(f"Attempt {attempt}: {e}")
+    else:
+        raise RuntimeError("Job never completed")
+    seconds = time.perf_counter() - t_start
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # Check the saved result contains every block of every page, in order:
+    body = io.BytesIO(fake_s3.objects[(output["Bucket"], output["Key"])])
+    if args.format.lower() == "compact":
+        from textract_compact import load_compact_result
+        saved = load_compact_result(body)
+    else:
+        saved = json.load(body)
+    expected_ids = [
+        block["Id"] for page in range(1, args.pages + 1) for block in fake_textract.page_blocks(page)
+    ]
+    assert [block["Id"] for block in saved["Blocks"]] == expected_ids, "Saved blocks don't match Textract's"
+    assert saved["DocumentMetadata"] == { "Pages": args.pages }, "Saved DocumentMetadata doesn't match"
+
+    stats = {
+        "Output": output["S3Uri"],
+        "Pages": args.pages,
+        "Blocks": len(expected_ids),
+        "TextractCalls": fake_textract.calls,
+        "SavedBytes": len(body.getvalue()),
+        "MaxPartBytes": fake_s3.max_part_bytes,
+        "PeakTracedMB": round(peak_bytes / 1024 / 1024, 1),
+        "Seconds": round(seconds, 2),
+    }
+    print(json.dumps(stats, indent=2))
+    return stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the async Textract paging and S3 streaming path offline against a fake Textract",
+    )
+    parser.add_argument("--pages", type=int, default=50, help="Number of pages in the fake document")
+    parser.add_argument(
+        "--blocks-per-page",
+        type=int,
+        default=DEFAULT_BLOCKS_PER_PAGE,
+        help="Number of blocks per page of the fake document",
+    )
+    parser.add_argument(
+        "--polls",
+        type=int,
+        default=2,
+        help="Number of polls that find the job still IN_PROGRESS before results are ready",
+    )
+    parser.add_argument("--format", choices=("JSON", "Compact"), default="JSON", help="Output format to save")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -1,55 +1,109 @@
 """Lambda to start Textract OCR (from Step Function)
 
-TODO: Support async Textract job integration for multi-page document
+In ASYNC mode (the default), multi-page documents are supported via Textract's StartDocumentAnalysis API. Since
+a Lambda function shouldn't sit idle waiting for a long-running job, it's a two-step integration:
+
+1. Called without a `JobId`, the function starts the job (idempotently, via ClientRequestToken) and just returns
+   `{ "JobId" }` - which the state machine keeps in its state.
+2. Called with the `JobId`, the function only polls GetDocumentAnalysis: Raising `WaitingForJob` while the job is
+   still in progress (for the Step Functions state Retry policy to re-invoke us), or else saving the results.
+
 TODO: Support alternative results delivery mechanisms e.g. DynamoDB?
 """
 
 # Python Built-Ins:
-import io
+import hashlib
 import json
 import os
 
 # External Dependencies:
 import boto3
+from botocore.exceptions import ClientError
+
+# Local Dependencies:
+from s3stream import S3MultipartWriter
+from result_cache import cache_from_env, s3_content_fingerprint  # (From common layer)
+from textract_compact import CompactResultWriter, FILE_SUFFIX as COMPACT_FILE_SUFFIX  # (From common layer)
 
-s3 = boto3.resource("s3")
+s3 = boto3.client("s3")
 textract = boto3.client("textract")
 
 is_textract_sync = os.environ.get("TEXTRACT_INTEGRATION_TYPE", "ASYNC") in ("SYNC", "SYNCHRONOUS")
+default_output_format = os.environ.get("TEXTRACT_OUTPUT_FORMAT", "JSON")
+result_cache = cache_from_env("Textract")  # None if caching not configured
+
+FEATURE_TYPES = ["FORMS", "TABLES"]
+GET_RESULTS_PAGE_SIZE = 1000  # Max permitted per the API doc
+BLOCK_ENCODE_CHUNK_SIZE = 500  # Number of blocks to JSON-encode per write when streaming output
+
+# Fields of GetDocumentAnalysis responses which relate to the job/request rather than the document itself, so
+# shouldn't be copied into our saved result:
+JOB_RESPONSE_FIELDS = ("JobStatus", "NextToken", "ResponseMetadata", "StatusMessage")
 
 
 class MalformedRequest(ValueError):
     pass
 
-# See commented-out draft snippet below
-# class WaitingForJob(RuntimeError):
-#     pass
+class WaitingForJob(RuntimeError):
+    """Raised while the Textract job is still running: Configure a Step Functions Retry on this to poll"""
+    pass
+
+class TextractJobFailed(RuntimeError):
+    pass
+
 
 def handler(event, context):
     try:
+        job_id = event.get("JobId")
         srcbucket = event["Input"]["Bucket"]
         srckey = event["Input"]["Key"]
+        request_token = event["Input"].get("RequestToken")
         output_type = event["Output"].get("Type", "s3")
         output_type_lower = output_type.lower()
         if output_type_lower == "inline":
             pass  # No other config to collect
         elif output_type_lower == "s3":
             destbucket = event["Output"].get("Bucket", srcbucket)
+            output_format = event["Output"].get("Format", default_output_format)
+            is_compact = output_format.lower() == "compact"
+            if not (is_compact or output_format.lower() == "json"):
+                raise MalformedRequest(f"Unknown output format '{output_format}': Expected 'JSON' or 'Compact'")
             if event["Output"].get("Key"):
                 destkey = event["Output"]["Key"]
             else:
                 prefix = event["Output"].get("Prefix", "")
+                # Callers analyzing a pre-processed copy can name the output after the original document instead:
+                name_key = event["Output"].get("SourceKey") or srckey
                 destkey = "".join([
                     (prefix + "/" if prefix else ""),
-                    srckey,
-                    ".textract.json",
+                    name_key,
+                    COMPACT_FILE_SUFFIX if is_compact else ".textract.json",
                 ])
         else:
             raise MalformedRequest(f"Unknown output integration type '{output_type}': Expected 'Inline' or 'S3'")
     except KeyError as ke:
         raise MalformedRequest(f"Missing field {ke}, please check your input payload")
 
-    if is_textract_sync:
+    # Re-uploads of a document we've already analyzed can re-use the saved result (S3 output only, since inline
+    # results aren't stored anywhere):
+    fingerprint = None
+    if result_cache is not None and output_type_lower == "s3":
+        fingerprint = s3_content_fingerprint(srcbucket, srckey, s3_client=s3)
+        cache_variant = "-".join(FEATURE_TYPES + ["Compact" if is_compact else "JSON"])
+        cached = None if fingerprint is None or job_id else get_cached_result(fingerprint, cache_variant)
+        if cached is not None:
+            print(f"Re-using cached Textract result {cached['S3Uri']} for s3://{srcbucket}/{srckey}")
+            return cached
+
+    if job_id:
+        # Polling a job we started earlier: Only GetDocumentAnalysis calls needed
+        result_pages = iter_document_analysis_pages(job_id)
+        # Check the job status from the first page before committing to any output:
+        first_page = next(result_pages)
+        check_job_status(job_id, first_page)
+        result_pages = chain_first(first_page, result_pages)
+        result = None
+    elif is_textract_sync:
         result = textract.analyze_document(
             Document={
                 'S3Object': {
@@ -57,54 +111,191 @@ def handler(event, context):
                     'Name': srckey,
                 },
             },
-            FeatureTypes=["FORMS", "TABLES"],
+            FeatureTypes=FEATURE_TYPES,
         )
+        result_pages = None
     else:
-        # TODO Implement async textract calls
-        raise NotImplementedError("Async Textract integration not ready yet")
-        # job = textract.start_document_analysis(
-        #     DocumentLocation={
-        #         'S3Object': {
-        #             'Bucket': srcbucket,
-        #             'Name': srckey,
-        #         }
-        #     },
-        #     FeatureTypes=["FORMS", "TABLES"],
-        #     # ClientRequestToken allows idempotency from token to job, which will let us use retries of this state to poll for success!
-        #     # An alternative would be to use SNS and async Lambda integration
-        #     ClientRequestToken=f"s3://{bucket}/{key}",
-        #     #JobTag='string',
-        #     # NotificationChannel={
-        #     #     'SNSTopicArn': 'string',
-        #     #     'RoleArn': 'string'
-        #     # }
-        # )
-        # result = textract.get_document_analysis(
-        #     JobId=job["JobId"],
-        #     #NextToken= TODO: Paginate responses
-        # )
-        # if result["JobStatus"] == "IN_PROGRESS":
-        #     raise WaitingForJob(job["JobId"])
-        # elif result["JobStatus"] in ("SUCCEEDED", "PARTIAL_SUCCESS"):
-        #     # TODO: These are the results DocumentMetadata, NextToken, Blocks, Warnings, AnalyzeDocumentModelVersion... Paginate!
-        #     pass
-        # else:
-        #     raise ValueError("Textract job {} entered failure state '{}'{}".format(
-        #         job["JobId"],
-        #         job["JobStatus"],
-        #         f" ({job.get('StatusMessage')})" if job.get("StatusMessage") else ""
-        #     ))
+        # Results won't be ready for a while, so hand the job back to the caller to poll with:
+        job_id = start_document_analysis(srcbucket, srckey, request_token=request_token)
+        print(f"Started Textract job {job_id} for s3://{srcbucket}/{srckey}")
+        return { "JobId": job_id }
 
     if output_type_lower == "inline":
-        return result
+        # Inline results must fit in the Step Functions payload anyway, so there's no harm gathering pages:
+        return result if result_pages is None else merge_result_pages(result_pages)
     elif output_type_lower == "s3":
-        resio = io.BytesIO(json.dumps(result).encode("utf-8"))
-        s3.Bucket(destbucket).upload_fileobj(resio, destkey)
-        return {
+        # Results could be very large, so rather than serializing the whole document to one string we encode
+        # blocks in chunks straight into a multipart upload with a bounded buffer:
+        with S3MultipartWriter(
+            destbucket,
+            destkey,
+            s3_client=s3,
+            ContentType="application/gzip" if is_compact else "application/json",
+        ) as writer:
+            write_fn = write_compact_result_pages if is_compact else write_result_pages
+            write_fn([result] if result_pages is None else result_pages, writer)
+        output = {
             "Bucket": destbucket,
             "Key": destkey,
             "S3Uri": f"s3://{destbucket}/{destkey}",
         }
+        if fingerprint is not None and writer.etag:
+            # Result keys are derived from the source key, which the UI re-uses for different uploads - so record
+            # which version of the result this entry refers to, for lookups to check it hasn't been overwritten:
+            result_cache.put(fingerprint, { **output, "ETag": writer.etag }, variant=cache_variant)
+        return output
     else:
         # Should have been caught by the initial event processing!
         raise MalformedRequest(f"Unknown output integration type '{output_type}': Expected 'Inline' or 'S3'")
+
+
+def get_cached_result(fingerprint: str, cache_variant: str):
+    """Look up a cached result location, checking the result object itself is still the one we wrote
+
+    Result objects can be deleted, or overwritten by the result for a different document uploaded to the same
+    source key: Either way, the entry is invalidated and treated as a miss.
+    """
+    cached = result_cache.get(fingerprint, variant=cache_variant)
+    if cached is None:
+        return None
+    try:
+        head = s3.head_object(Bucket=cached["Bucket"], Key=cached["Key"])
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            print(f"Skipping result cache: Couldn't check cached Textract result {cached['S3Uri']}: {ce}")
+            return None
+        print(f"Cached Textract result {cached['S3Uri']} no longer exists: Invalidating")
+        result_cache.invalidate(fingerprint, variant=cache_variant)
+        return None
+    if head["ETag"] != cached.get("ETag"):
+        print(f"Cached Textract result {cached['S3Uri']} has since been overwritten: Invalidating")
+        result_cache.invalidate(fingerprint, variant=cache_variant)
+        return None
+    return { k: v for k, v in cached.items() if k != "ETag" }
+
+
+def start_document_analysis(bucket: str, key: str, request_token: str=None, textract_client=None) -> str:
+    """Start (or re-join, if already started) an async Textract analysis job for an S3 object
+
+    ClientRequestToken makes the start request idempotent: Repeated calls with the same token return the same
+    JobId instead of starting a new job - which lets us use retries of the calling state to poll for success.
+    Tokens are derived from the object location plus an optional `request_token` (e.g. the Step Functions
+    execution name), so that re-uploads of the same key under a new execution get a fresh job.
+    """
+    textract_client = textract_client or textract
+    token_source = f"s3://{bucket}/{key}" + (f"#{request_token}" if request_token else "")
+    job = textract_client.start_document_analysis(
+        DocumentLocation={
+            'S3Object': {
+                'Bucket': bucket,
+                'Name': key,
+            }
+        },
+        FeatureTypes=FEATURE_TYPES,
+        # Token must be <=64 chars of [a-zA-Z0-9-_], so we hash rather than using the S3 URI directly:
+        ClientRequestToken=hashlib.sha256(token_source.encode("utf-8")).hexdigest(),
+    )
+    return job["JobId"]
+
+
+def iter_document_analysis_pages(job_id: str, textract_client=None):
+    """Generate raw GetDocumentAnalysis responses for a job, following NextToken pagination
+
+    Pages are requested lazily, so consumers can process (and discard) each page's blocks before the next is
+    fetched.
+    """
+    textract_client = textract_client or textract
+    next_token = None
+    while True:
+        request = { "JobId": job_id, "MaxResults": GET_RESULTS_PAGE_SIZE }
+        if next_token:
+            request["NextToken"] = next_token
+        page = textract_client.get_document_analysis(**request)
+        yield page
+        next_token = page.get("NextToken")
+        if not next_token:
+            break
+
+
+def check_job_status(job_id: str, response: dict):
+    """Raise WaitingForJob or TextractJobFailed unless the job `response` indicates results are ready"""
+    status = response["JobStatus"]
+    if status == "IN_PROGRESS":
+        raise WaitingForJob(f"Textract job {job_id} still in progress")
+    elif status not in ("SUCCEEDED", "PARTIAL_SUCCESS"):
+        raise TextractJobFailed("Textract job {} entered failure state '{}'{}".format(
+            job_id,
+            status,
+            f" ({response.get('StatusMessage')})" if response.get("StatusMessage") else ""
+        ))
+
+
+def chain_first(first, rest):
+    """Re-attach an already-consumed `first` item to the front of iterator `rest`"""
+    yield first
+    yield from rest
+
+
+def document_fields(response: dict) -> dict:
+    """Extract the document-level fields (e.g. DocumentMetadata) from a Textract response, excluding blocks"""
+    return {
+        k: v for k, v in response.items()
+        if k not in JOB_RESPONSE_FIELDS and k not in ("Blocks", "Warnings")
+    }
+
+
+def merge_result_pages(pages) -> dict:
+    """Combine paginated GetDocumentAnalysis responses into one AnalyzeDocument-like result in memory"""
+    result = { "Blocks": [], "Warnings": [] }
+    for ix, page in enumerate(pages):
+        if ix == 0:
+            result.update(document_fields(page))
+        result["Blocks"].extend(page.get("Blocks", []))
+        result["Warnings"].extend(page.get("Warnings", []))
+    return result
+
+
+def write_result_pages(pages, fileobj):
+    """Incrementally write paginated GetDocumentAnalysis responses as one AnalyzeDocument-like JSON doc
+
+    Output has the same structure as `merge_result_pages()`, but only one page of blocks is held in memory at a
+    time and blocks are encoded in chunks of BLOCK_ENCODE_CHUNK_SIZE - so the full document is never serialized
+    to a single string. `fileobj` should be opened in binary mode. Also accepts a single AnalyzeDocument response
+    as a one-element list of pages.
+    """
+    warnings = []
+    n_blocks = 0
+    for ix, page in enumerate(pages):
+        if ix == 0:
+            header = document_fields(page)
+            # Write the header fields as an unterminated JSON object, then open the blocks list:
+            header_str = json.dumps(header)[:-1]
+            fileobj.write(header_str.encode("utf-8"))
+            fileobj.write(b', "Blocks": [' if header else b'"Blocks": [')
+        blocks = page.get("Blocks", [])
+        for ix_chunk in range(0, len(blocks), BLOCK_ENCODE_CHUNK_SIZE):
+            chunk = blocks[ix_chunk:ix_chunk + BLOCK_ENCODE_CHUNK_SIZE]
+            if n_blocks:
+                fileobj.write(b", ")
+            fileobj.write(", ".join(map(json.dumps, chunk)).encode("utf-8"))
+            n_blocks += len(chunk)
+        warnings.extend(page.get("Warnings", []))
+    fileobj.write(b'], "Warnings": ')
+    fileobj.write(json.dumps(warnings).encode("utf-8"))
+    fileobj.write(b"}")
+    return n_blocks
+
+
+def write_compact_result_pages(pages, fileobj):
+    """Incrementally write paginated Textract responses in compact columnar format (see textract_compact)
+
+    Each page of results is stored as one row group, so as with `write_result_pages()` only one page of blocks
+    is held in memory at a time.
+    """
+    with CompactResultWriter(fileobj) as writer:
+        for ix, page in enumerate(pages):
+            if ix == 0:
+                writer.write_header(document_fields(page))
+            writer.write_blocks(page.get("Blocks", []))
+            writer.add_warnings(page.get("Warnings", []))
+        return writer.n_blocks
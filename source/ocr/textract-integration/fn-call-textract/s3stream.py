@@ -0,0 +1,117 @@
+"""Utility for streaming writes to Amazon S3 with bounded memory usage
+
+S3 objects can't be appended to, so the usual way to save a generated document is to build the whole thing in
+memory and then upload it. `S3MultipartWriter` instead buffers written bytes only up to `part_size`, uploading
+each full buffer as one part of an S3 multipart upload - so peak memory stays roughly constant regardless of the
+total object size.
+"""
+
+# External Dependencies:
+import boto3
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 minimum for all but the last part of a multipart upload
+
+
+class S3MultipartWriter:
+    """Binary file-like writer that streams to an S3 object via multipart upload
+
+    Use as a context manager: The upload is completed on clean exit, or aborted if an exception is raised (so
+    no partial object or orphaned parts are left behind). Objects smaller than one part are sent with a simple
+    PutObject instead, to avoid the multipart overhead for small documents.
+    """
+    def __init__(
+        self,
+        bucket: str,
+        key: str,
+        part_size: int=DEFAULT_PART_SIZE,
+        s3_client=None,
+        **extra_args,
+    ):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes (got {part_size})")
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.extra_args = extra_args  # e.g. ContentType, passed through to create/put requests
+        self.s3_client = s3_client or boto3.client("s3")
+        self.bytes_written = 0
+        self.closed = False
+        self.etag = None  # ETag of the created object, once closed
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data: bytes) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed S3MultipartWriter")
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def close(self):
+        """Flush any remaining buffered data and complete the upload"""
+        if self.closed:
+            return
+        if self._upload_id is None:
+            # Never filled a whole part, so just send a simple PutObject:
+            response = self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self._buffer),
+                **self.extra_args,
+            )
+        else:
+            if len(self._buffer):
+                self._upload_part(bytes(self._buffer))
+            response = self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={ "Parts": self._parts },
+            )
+        self.etag = response.get("ETag")
+        self._buffer = bytearray()
+        self.closed = True
+
+    def abort(self):
+        """Discard the upload (and any parts already sent) without creating the object"""
+        if self.closed:
+            return
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+            )
+        self._buffer = bytearray()
+        self.closed = True
+
+    def _upload_part(self, data: bytes):
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                **self.extra_args,
+            )["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        self._parts.append({ "ETag": response["ETag"], "PartNumber": part_number })
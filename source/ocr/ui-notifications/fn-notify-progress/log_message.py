@@ -0,0 +1,89 @@
+"""Lazily-parsed Step Functions execution log messages
+
+Step Functions log events (with `IncludeExecutionData`) carry the full state input/output - which for this
+pipeline can be large - but most notifications only need the event `type`, `execution_arn` and state `name`.
+`LogMessage` extracts just those fields from the raw message text by string search, and only parses the
+full message JSON (or, separately, the execution input nested in it as a JSON string) when something asks for it.
+
+The extraction is safe because state data is nested in the message as JSON *strings*, in which every quote is
+escaped: So a quoted `"type"` can only be an actual key of the message or its `details` - and Step Functions'
+event `details` don't use the `type` or `execution_arn` keys, or nest other objects with a `name`. Step Functions
+writes `type` before the `details` and `execution_arn` after them (with a state's `name` after its `input`), so
+each key is searched for from the nearer end of the message. If a key isn't found (or its value isn't a string),
+we fall back to the fully-parsed message.
+"""
+
+# Python Built-Ins:
+from functools import cached_property
+import json
+import re
+
+
+# Matches the `: "value"` after a key in raw JSON text, capturing the (still escaped) string value:
+VALUE_PATTERN = re.compile(r'\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def find_string_field(raw: str, key: str, from_end: bool=False):
+    """Find the (still escaped) string value of `key` in raw JSON text, or None if not found
+
+    The key is located with `str.find()`/`str.rfind()`, which is much faster than parsing (or regex-scanning) a
+    large message - especially when searching from the end nearest to the key.
+    """
+    quoted_key = f'"{key}"'
+    start = raw.rfind(quoted_key) if from_end else raw.find(quoted_key)
+    if start < 0:
+        return None
+    match = VALUE_PATTERN.match(raw, start + len(quoted_key))
+    return match.group(1) if match else None
+
+
+class LogMessage:
+    """A Step Functions log event message, parsed only as far as needed
+
+    Parameters
+    ----------
+    raw :
+        The log event's `message` string (a JSON object)
+    """
+    def __init__(self, raw: str):
+        self.raw = raw
+
+    def _field(self, key: str, parsed_getter, from_end: bool=False):
+        value = find_string_field(self.raw, key, from_end=from_end)
+        if value is None:
+            return parsed_getter()
+        return json.loads(f'"{value}"')  # (Un-escape the JSON string value)
+
+    @cached_property
+    def parsed(self) -> dict:
+        """The fully-parsed message (state data such as `details.input` stays as JSON strings)"""
+        return json.loads(self.raw)
+
+    @property
+    def details(self) -> dict:
+        return self.parsed.get("details") or {}
+
+    @cached_property
+    def type(self) -> str:
+        return self._field("type", lambda: self.parsed["type"])
+
+    @cached_property
+    def execution_arn(self) -> str:
+        return self._field("execution_arn", lambda: self.parsed["execution_arn"], from_end=True)
+
+    @cached_property
+    def state_name(self) -> str:
+        """Name of the state, for state-level events (None for execution-level events)"""
+        if "State" not in self.type:
+            return None
+        return self._field("name", lambda: self.details.get("name"), from_end=True)
+
+    @property
+    def has_input(self) -> bool:
+        """Whether the message (probably) carries an execution/state input, without parsing it"""
+        return '"input"' in self.raw
+
+    @cached_property
+    def input(self) -> dict:
+        """The parsed `details.input` data (raises KeyError if absent, ValueError if not valid JSON)"""
+        return json.loads(self.details["input"])
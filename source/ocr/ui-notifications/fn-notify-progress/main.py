@@ -15,16 +15,28 @@ TODO: Uncomment the final IoT publishing step!
 import base64
 import gzip
 import json
+import logging
 import os
-import time
-import traceback
 
 # External Dependencies:
 import boto3
-from expiringdict import ExpiringDict
+from botocore.config import Config as BotoConfig
+
+# Local Dependencies:
+from log_message import LogMessage
+from notification_profile import NotificationProfile, parse_event_types
+from ownership import OwnershipResolver, UntraceableExecution
+from publisher import BatchPublisher
+
+logger = logging.getLogger()
+# Set LOG_LEVEL=DEBUG to log full event payloads and prepared notifications (which can be large):
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
+publish_max_workers = int(os.environ.get("IOT_PUBLISH_MAX_WORKERS", 8))
 
 ddb = boto3.resource("dynamodb")
-iot = boto3.client("iot-data")
+# (Connection pool big enough that concurrent publishing threads don't wait for each other)
+iot = boto3.client("iot-data", config=BotoConfig(max_pool_connections=max(10, publish_max_workers)))
 
 topic_prefix = "private"
 
@@ -34,105 +46,103 @@ topic_prefix = "private"
 # addition, our IoT topic permissions are partitioned by *Cognito Identity ID*, so we'll need that to push
 # execution progress notifications.
 #
-# Here we use a simple in-memory cache (because we're likely to get many events in quick succession if the
-# Lambda is warm) in front of a DynamoDB table (in case the Lambda goes cold).
-ownership_cache = ExpiringDict(max_len=200, max_age_seconds=60*60*24*7)
-ownership_table = ddb.Table(os.environ["EXECUTION_OWNERSHIP_TABLE_NAME"])
+# Here we use an in-memory cache (because we're likely to get many events in quick succession if the Lambda is
+# warm) in front of a DynamoDB table (in case the Lambda goes cold) - see ownership.py.
+ownership_resolver = OwnershipResolver(ddb.Table(os.environ["EXECUTION_OWNERSHIP_TABLE_NAME"]))
+
+# Notifications for a whole batch of log events are coalesced to one message per user topic - see publisher.py.
+publisher = BatchPublisher(iot, max_workers=publish_max_workers)
+
+# What to notify, and how much detail to send - see notification_profile.py:
+notification_profile = NotificationProfile(
+    event_types=parse_event_types(os.environ.get("NOTIFY_EVENT_TYPES")),
+    debounce_ms=int(os.environ.get("NOTIFY_DEBOUNCE_MS", 0)),
+    compact=os.environ.get("NOTIFY_COMPACT", "true").lower() in ("1", "true", "yes"),
+)
 
 
 def handler(event, context):
-    print("EXTRACTING PAYLOADS")
-    print(event)
+    logger.debug("Received event: %s", event)
 
     # CloudWatch delivers base64-encoded zipped data:
     zipdata = base64.b64decode(event["awslogs"]["data"])
-    payload_bytes = gzip.decompress(zipdata)
-    payload = json.loads(payload_bytes)
+    payload = json.loads(gzip.decompress(zipdata))
+    # (Each log message stays an unparsed string until process_event() needs something from it)
 
-    print("PROCESSING LOGS")
+    topic_notifications = {}
     for log in payload["logEvents"]:
-        print(f"Processing log: {log}")
         try:
-            process_event(log)
-        except Exception as e:
-            traceback.print_exc()
-            print("ERROR: Uncaught error in log event processing, moving to next event")
-        
+            prepared = process_event(log)
+        except Exception:
+            logger.exception("Uncaught error in log event processing, moving to next event: %s", log.get("id"))
+            continue
+        if prepared is not None:
+            topic_name, notification = prepared
+            topic_notifications.setdefault(topic_name, []).append(notification)
+
+    n_prepared = sum(len(notifications) for notifications in topic_notifications.values())
+    for topic_name, notifications in topic_notifications.items():
+        notifications.sort(key=lambda n: n["timestamp"])
+        notifications = notification_profile.debounce(notifications)
+        for notification in notification_profile.compact_deltas(notifications):
+            publisher.add(topic_name, notification)
+    logger.info("Prepared %s notifications from %s log events", n_prepared, len(payload["logEvents"]))
+    publish_counters = publisher.flush()
+    logger.info("Publish counters: %s", publish_counters)
+    logger.info("Ownership resolver counters: %s", ownership_resolver.counters)
+
+
+def trace_ownership(message: LogMessage) -> dict:
+    """Trace execution ownership from a log message's execution input, or raise UntraceableExecution"""
+    try:
+        # TODO: Maybe more permissive scraping logic?
+        sfn_input = message.input
+        identity_id = sfn_input \
+            ["detail"]["userIdentity"]["sessionContext"] \
+            ["webIdFederationData"]["attributes"]["cognito-identity.amazonaws.com:sub"]
+        reqparams = sfn_input.get("detail", {}).get("requestParameters", {})
+        preserved_input = sfn_input.get("Input", {})
+        if "bucketName" in reqparams and "key" in reqparams:
+            s3_uri = f"s3://{reqparams['bucketName']}/{reqparams['key']}"
+        elif "Bucket" in preserved_input and "Key" in preserved_input:
+            s3_uri = f"s3://{preserved_input['Bucket']}/{preserved_input['Key']}"
+        else:
+            raise ValueError("Object S3 URI not available on event")
+    except (KeyError, TypeError, ValueError) as e:
+        raise UntraceableExecution(f"Couldn't trace ownership from event: {e}")
+    return { "IdentityId": identity_id, "S3Uri": s3_uri }
+
 
 def process_event(log):
+    """Prepare the notification for a log event: Returns (topic name, notification), or None to notify nothing"""
     timestamp = log["timestamp"]
-    message = json.loads(log["message"])
-    print(f"Log message: {message}")
-    message_type = message["type"]  # e.g. TaskStateEntered
-    execution_arn = message["execution_arn"]
-
-    notification = {
-        "executionArn": execution_arn,
-        "timestamp": timestamp,
-        "type": message_type,
-        # Pass through raw details too - IoT message quota bigger than SFn data size quota.
-        "details": message["details"],
-    }
-
-    state_name = message["details"].get("name") if "State" in message_type else None
-    if state_name:
-        notification["stateName"] = state_name
-
-    # Establish the ownership of the Execution:
-    cached_ownership = ownership_cache.get("execution_arn")
-    if cached_ownership is None:
-        # Does the event have sufficient details to interpret ownership?
-        try:
-            # TODO: Maybe more permissive scraping logic?
-            sfn_input = json.loads(message["details"]["input"])
-            identity_id = sfn_input \
-                ["detail"]["userIdentity"]["sessionContext"] \
-                ["webIdFederationData"]["attributes"]["cognito-identity.amazonaws.com:sub"]
-            reqparams = sfn_input.get("detail", {}).get("requestParameters", {})
-            preserved_input = sfn_input.get("Input", {})
-            if "bucketName" in reqparams and "key" in reqparams:
-                s3_uri = f"s3://{reqparams['bucketName']}/{reqparams['key']}"
-            elif "Bucket" in preserved_input and "Key" in preserved_input:
-                s3_uri = f"s3://{preserved_input['Bucket']}/{preserved_input['Key']}"
-            else:
-                raise ValueError("Object S3 URI not available on event")
-            publish_to_ddb = True
-        except (KeyError, ValueError) as e:
-            # Nope - not in cache and event doesn't have enough information to trace.
-            # Try a DDB lookup to add to cache, otherwise we're stuffed:
-            ddb_fetch_response = ownership_table.get_item(Key={ "ExecutionId": execution_arn })
-            if "Item" in ddb_fetch_response:
-                identity_id = ddb_fetch_response["Item"]["IdentityId"]
-                s3_uri = ddb_fetch_response["Item"]["S3Uri"]
-                publish_to_ddb = False
-            else:
-                # FAIL - print error and move on to next message in queue
-                print("".join([
-                    "ERROR: Couldn't trace IdentityID and S3Uri from event payload or cache. ",
-                    f"Unable to notify {notification}",
-                ]))
-                return
-
-        ownership_cache[execution_arn] = {
-            "IdentityId": identity_id,
-            "S3Uri": s3_uri,
-        }
-        if publish_to_ddb:
-            ownership_table.put_item(
-                Item={
-                    "ExecutionId": execution_arn,
-                    "ExpiresAt": int(time.time() + 60*60*24*7),  # time.time is UTC epoch seconds
-                    "IdentityId": identity_id, 
-                    "S3Uri": s3_uri,
-                }
-            )
-    else:
-        identity_id = cached_ownership["IdentityId"]
-        s3_uri = cached_ownership["S3Uri"]
+    message = LogMessage(log["message"])
+    logger.debug("Log message: %s", message.raw)
+    message_type = message.type  # e.g. TaskStateEntered
+    execution_arn = message.execution_arn
+
+    if not notification_profile.allows(message_type):
+        # Events we don't notify may still carry the execution input, so are worth tracing ownership from:
+        if message.has_input:
+            ownership_resolver.resolve(execution_arn, lambda: trace_ownership(message))
+        logger.debug("Skipping notification for event type %s", message_type)
+        return None
+
+    notification = notification_profile.build(message, timestamp)
+
+    # Establish the ownership of the Execution (only parsing the execution input if it's not already known):
+    ownership = ownership_resolver.resolve(execution_arn, lambda: trace_ownership(message))
+    if ownership is None:
+        # FAIL - log error and move on to next message in queue
+        logger.error(
+            "Couldn't trace IdentityID and S3Uri from event payload or cache. Unable to notify %s",
+            notification,
+        )
+        return None
 
     # Now that ownership is known, we can send our notification
-    notification["s3Uri"] = s3_uri
+    notification["s3Uri"] = ownership["S3Uri"]
 
-    topic_name = f"{topic_prefix}/{identity_id}"
-    print(f"Prepared notification for topic {topic_name}: {notification}")
-    iot.publish(topic=topic_name, qos=1, payload=json.dumps(notification))
+    topic_name = f"{topic_prefix}/{ownership['IdentityId']}"
+    logger.debug("Prepared notification for topic %s: %s", topic_name, notification)
+    return topic_name, notification
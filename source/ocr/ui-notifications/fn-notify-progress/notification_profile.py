@@ -0,0 +1,138 @@
+"""Configurable filtering and compaction of Step Functions events into UI progress notifications
+
+With `Level: ALL` logging, a state machine emits several events per state, each carrying full state input and
+output. The web UI only needs to know which state an execution is in, and the result (or error) at the end. A
+`NotificationProfile` controls what gets pushed to it:
+
+- **Event type allowlist**: Event `type`s not listed are dropped (e.g. `PassStateEntered` noise).
+- **Per-execution debounce**: When an execution moves through several states within `debounce_ms` of each other,
+  only the latest is sent - the UI would only ever display it momentarily. Execution start/end events are
+  always sent.
+- **Compact payloads**: Instead of the raw event `details`, notifications carry the `stateName`, an overall
+  `status`, and (for completed executions) just the `result` or `error`/`cause`. Fields that don't change over
+  an execution (like `s3Uri`) are only sent with the execution's first notification in each batch.
+
+Set `compact=False` to pass through the raw `details` for each event, as previous versions did.
+"""
+
+# Python Built-Ins:
+import json
+
+# Overall execution status implied by each execution-level event type (state-level events imply RUNNING):
+EXECUTION_STATUSES = {
+    "ExecutionStarted": "RUNNING",
+    "ExecutionSucceeded": "SUCCEEDED",
+    "ExecutionFailed": "FAILED",
+    "ExecutionAborted": "ABORTED",
+    "ExecutionTimedOut": "TIMED_OUT",
+}
+
+# Keys of the state machine output which hold the final result for the UI:
+RESULT_KEYS = ("HumanReview", "ModelResult")
+
+
+def parse_event_types(value: str) -> set:
+    """Parse a comma-separated event type allowlist (e.g. from an environment variable): Empty means allow all"""
+    event_types = set(t.strip() for t in (value or "").split(",") if t.strip())
+    return event_types or None
+
+
+def cause_message(cause: str):
+    """Extract a readable message from an error `cause`, which may be plain text or a Lambda error JSON string"""
+    try:
+        parsed = json.loads(cause)
+    except (TypeError, ValueError):
+        return cause
+    if isinstance(parsed, dict):
+        message_key = next((k for k in parsed if "message" in k.lower()), None)
+        return parsed[message_key] if message_key else cause
+    return parsed
+
+
+class NotificationProfile:
+    """Decide which Step Functions events to notify, and what to send for each
+
+    Parameters
+    ----------
+    event_types :
+        Set of event `type`s to notify, or None to notify all types received
+    debounce_ms :
+        Drop an execution's state-level notification if the same execution has another within this many
+        milliseconds after it (0 = no debouncing)
+    compact :
+        Send compact notifications (True) or pass through raw event `details` (False)
+    """
+    def __init__(self, event_types: set=None, debounce_ms: int=0, compact: bool=True):
+        self.event_types = event_types
+        self.debounce_ms = debounce_ms
+        self.compact = compact
+
+    def allows(self, event_type: str) -> bool:
+        return self.event_types is None or event_type in self.event_types
+
+    def build(self, message, timestamp: int) -> dict:
+        """Create the notification for a Step Functions `message` (a log_message.LogMessage)
+
+        In compact mode, the message is only fully parsed for execution completion events.
+        """
+        event_type = message.type
+        notification = {
+            "executionArn": message.execution_arn,
+            "timestamp": timestamp,
+            "type": event_type,
+        }
+        if message.state_name:
+            notification["stateName"] = message.state_name
+        if not self.compact:
+            # Pass through raw details too - IoT message quota bigger than SFn data size quota.
+            notification["details"] = message.details
+            return notification
+
+        notification["status"] = EXECUTION_STATUSES.get(event_type, "RUNNING")
+        if event_type not in EXECUTION_STATUSES or event_type == "ExecutionStarted":
+            return notification
+        details = message.details
+        if event_type == "ExecutionSucceeded":
+            try:
+                output = json.loads(details["output"])
+                notification["result"] = { k: output[k] for k in RESULT_KEYS if k in output } or None
+            except (KeyError, TypeError, ValueError):
+                notification["result"] = None
+        else:
+            if details.get("error"):
+                notification["error"] = details["error"]
+            if details.get("cause"):
+                notification["cause"] = cause_message(details["cause"])
+        return notification
+
+    def debounce(self, notifications: list) -> list:
+        """Drop superseded state-level notifications from a (timestamp-ordered) list, per execution"""
+        if not self.debounce_ms:
+            return notifications
+        kept = []
+        next_timestamps = {}  # Timestamp of each execution's next notification, scanning backwards
+        for notification in reversed(notifications):
+            execution_arn = notification["executionArn"]
+            next_timestamp = next_timestamps.get(execution_arn)
+            next_timestamps[execution_arn] = notification["timestamp"]
+            if (
+                notification["type"] not in EXECUTION_STATUSES
+                and next_timestamp is not None
+                and next_timestamp - notification["timestamp"] < self.debounce_ms
+            ):
+                continue
+            kept.append(notification)
+        kept.reverse()
+        return kept
+
+    def compact_deltas(self, notifications: list) -> list:
+        """Omit `s3Uri` from all but the first of each execution's notifications (in compact mode)"""
+        if not self.compact:
+            return notifications
+        seen = set()
+        for notification in notifications:
+            if notification["executionArn"] in seen:
+                notification.pop("s3Uri", None)
+            else:
+                seen.add(notification["executionArn"])
+        return notifications
@@ -0,0 +1,102 @@
+"""Two-tier resolver of Step Functions execution ownership (Cognito Identity ID and source S3 URI)
+
+Ownership can only be traced from an execution's original input (present on some of its events), so it's
+persisted to DynamoDB the first time it's seen - and cached in memory, because we're likely to get many events
+for the same execution in quick succession while the Lambda is warm:
+
+1. **In-memory tier**: Size-limited, expiring cache of known owners, and a separate short-lived *negative*
+   cache of executions we couldn't trace - so a burst of untraceable events doesn't cost a DynamoDB read each.
+2. **Event payload**: If the event carries the execution input, trace ownership from that and persist it with a
+   conditional write - so each execution is written to DynamoDB once, however many events we see.
+3. **DynamoDB tier**: Otherwise look up the persisted ownership record.
+"""
+
+# Python Built-Ins:
+import time
+
+# External Dependencies:
+from expiringdict import ExpiringDict
+
+OWNERSHIP_TTL_SECONDS = 60 * 60 * 24 * 7
+
+
+class UntraceableExecution(ValueError):
+    """Raised by tracing functions when an event doesn't carry enough information to establish ownership"""
+    pass
+
+
+class OwnershipResolver:
+    """Resolve execution ARN -> { "IdentityId", "S3Uri" } via memory, event payload, then DynamoDB
+
+    Parameters
+    ----------
+    table :
+        boto3 DynamoDB Table resource with hash key `ExecutionId` (and TTL on `ExpiresAt`)
+    max_len :
+        Maximum number of executions to remember in memory (oldest evicted first)
+    negative_ttl_seconds :
+        How long to remember that an execution couldn't be traced, before trying DynamoDB again
+    """
+    def __init__(self, table, max_len: int=1000, negative_ttl_seconds: int=60):
+        self.table = table
+        self.cache = ExpiringDict(max_len=max_len, max_age_seconds=OWNERSHIP_TTL_SECONDS)
+        self.negative_cache = ExpiringDict(max_len=max_len, max_age_seconds=negative_ttl_seconds)
+        self.counters = {
+            "MemoryHits": 0,
+            "NegativeHits": 0,
+            "PayloadResolutions": 0,
+            "DynamoDBHits": 0,
+            "DynamoDBWrites": 0,
+            "Misses": 0,
+        }
+
+    def resolve(self, execution_arn: str, trace_fn):
+        """Find the owner of `execution_arn`, or return None if it can't be traced
+
+        `trace_fn()` is only called on a memory cache miss, and should return an ownership dict from the event
+        payload or else raise UntraceableExecution - so callers can defer any expensive event parsing to it.
+        """
+        ownership = self.cache.get(execution_arn)
+        if ownership is not None:
+            self.counters["MemoryHits"] += 1
+            return ownership
+
+        try:
+            ownership = trace_fn()
+        except UntraceableExecution:
+            ownership = None
+        if ownership is not None:
+            self.counters["PayloadResolutions"] += 1
+            self.negative_cache.pop(execution_arn, None)
+            self.persist(execution_arn, ownership)
+            self.cache[execution_arn] = ownership
+            return ownership
+
+        if self.negative_cache.get(execution_arn):
+            self.counters["NegativeHits"] += 1
+            return None
+        item = self.table.get_item(Key={ "ExecutionId": execution_arn }).get("Item")
+        if item is None:
+            self.counters["Misses"] += 1
+            self.negative_cache[execution_arn] = True
+            return None
+        self.counters["DynamoDBHits"] += 1
+        ownership = { "IdentityId": item["IdentityId"], "S3Uri": item["S3Uri"] }
+        self.cache[execution_arn] = ownership
+        return ownership
+
+    def persist(self, execution_arn: str, ownership: dict):
+        """Write an ownership record to DynamoDB, unless one already exists for the execution"""
+        try:
+            self.table.put_item(
+                Item={
+                    "ExecutionId": execution_arn,
+                    "ExpiresAt": int(time.time() + OWNERSHIP_TTL_SECONDS),  # time.time is UTC epoch seconds
+                    "IdentityId": ownership["IdentityId"],
+                    "S3Uri": ownership["S3Uri"],
+                },
+                ConditionExpression="attribute_not_exists(ExecutionId)",
+            )
+            self.counters["DynamoDBWrites"] += 1
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass  # Already persisted (e.g. by another concurrent invocation)
@@ -0,0 +1,111 @@
+"""Coalesced, concurrent publishing of notifications to IoT Core topics
+
+A CloudWatch Logs batch often carries many Step Functions events, usually for only a handful of executions (and
+therefore users). Rather than one serial `iot.publish()` round trip per event, `BatchPublisher` groups queued
+notifications by topic and sends one message per topic:
+
+    { "notifications": [ notification, ... ] }
+
+...split into multiple messages only where needed to stay within the IoT Core message size limit. Topics are
+published concurrently over a bounded thread pool (boto3 clients are thread-safe, and share their HTTPS connection
+pool between threads), while the messages for any one topic are sent in order by a single worker - so clients see
+events in the order they were logged.
+
+Failure to publish to one topic doesn't prevent publishing to the others.
+"""
+
+# Python Built-Ins:
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+IOT_MAX_PAYLOAD_BYTES = 128 * 1024
+# Leave some headroom for the message wrapper and any protocol overhead:
+DEFAULT_MAX_MESSAGE_BYTES = IOT_MAX_PAYLOAD_BYTES - 4 * 1024
+
+
+def chunk_notifications(notifications: list, max_message_bytes: int=DEFAULT_MAX_MESSAGE_BYTES) -> list:
+    """Split `notifications` into a list of JSON message payloads each within `max_message_bytes` (if possible)
+
+    A single notification too large for the limit is still sent alone, for IoT Core to accept or reject.
+    """
+    wrapper_bytes = len(json.dumps({ "notifications": [] }))
+    messages = []
+    current = []
+    current_bytes = wrapper_bytes
+    for notification in notifications:
+        serialized = json.dumps(notification)
+        item_bytes = len(serialized.encode("utf-8")) + 2  # (Allowing for ", " separator)
+        if len(current) and current_bytes + item_bytes > max_message_bytes:
+            messages.append('{"notifications": [' + ", ".join(current) + "]}")
+            current = []
+            current_bytes = wrapper_bytes
+        current.append(serialized)
+        current_bytes += item_bytes
+    if len(current):
+        messages.append('{"notifications": [' + ", ".join(current) + "]}")
+    return messages
+
+
+class BatchPublisher:
+    """Queue notifications by IoT topic, then flush() them as one (or few) messages per topic in parallel
+
+    Parameters
+    ----------
+    iot_client :
+        boto3 "iot-data" client. Configure its `max_pool_connections` to at least `max_workers`, or threads will
+        queue for connections.
+    max_workers :
+        Maximum number of topics to publish to concurrently
+    max_message_bytes :
+        Target maximum size of each published message
+    qos :
+        MQTT Quality of Service level to publish with
+    """
+    def __init__(
+        self,
+        iot_client,
+        max_workers: int=8,
+        max_message_bytes: int=DEFAULT_MAX_MESSAGE_BYTES,
+        qos: int=1,
+    ):
+        self.iot = iot_client
+        self.max_message_bytes = max_message_bytes
+        self.qos = qos
+        # The executor is kept (and its threads re-used) between invocations while the Lambda is warm:
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="publish")
+        self.queues = OrderedDict()
+
+    def add(self, topic: str, notification: dict):
+        self.queues.setdefault(topic, []).append(notification)
+
+    def publish_topic(self, topic: str, notifications: list) -> int:
+        """Publish `notifications` to one `topic` in order: Returns the number of messages sent"""
+        messages = chunk_notifications(notifications, self.max_message_bytes)
+        for message in messages:
+            self.iot.publish(topic=topic, qos=self.qos, payload=message)
+        return len(messages)
+
+    def flush(self) -> dict:
+        """Publish all queued notifications and clear the queue
+
+        Returns counters of `Notifications` and `Messages` successfully published, and `FailedTopics`.
+        """
+        queues = self.queues
+        self.queues = OrderedDict()
+        futures = {
+            topic: self.executor.submit(self.publish_topic, topic, notifications)
+            for topic, notifications in queues.items()
+        }
+        counters = { "Notifications": 0, "Messages": 0, "FailedTopics": 0 }
+        for topic, future in futures.items():
+            try:
+                counters["Messages"] += future.result()
+                counters["Notifications"] += len(queues[topic])
+            except Exception:
+                logger.exception("Failed to publish %s notifications to topic %s", len(queues[topic]), topic)
+                counters["FailedTopics"] += 1
+        return counters
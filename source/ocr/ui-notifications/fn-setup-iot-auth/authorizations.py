@@ -0,0 +1,150 @@
+"""DynamoDB store of IoT-authorized identities, and a lock to coalesce whole-pool reconciliations
+
+Three kinds of item share the table (hash key `IdentityId`):
+
+- **Authorization records**: One per Cognito identity known to be attached to the IoT policy (with the
+  `PolicyName`), so authorizing an identity that's already set up costs one DynamoDB read instead of IoT calls.
+  Records are a cache, not the source of truth: A missing record just means an (idempotent) attach_policy call.
+- **User records**: One per user pool user (keyed `User#{sub}`) whose login was followed by a completed whole-pool
+  reconciliation, so their identity is already attached and later logins needn't request another. These expire
+  (`ExpiresAt`) after `user_record_seconds`, so a user whose identity was somehow missed is eventually re-checked.
+- **The reconcile lock**: A single item under the reserved key `RECONCILE_LOCK_ID` (which can't clash with an
+  identity ID, as those are formatted `{region}:{uuid}`). A whole-pool reconciliation must hold the lock, so only
+  one runs at a time. Requests that arrive while it's held set a `Rerun` flag instead of starting another scan, and
+  the holder runs once more before releasing - so any number of concurrent requests cost at most two scans, but
+  none are lost. The lock is a lease that expires (`ExpiresAt`), in case its holder crashes.
+"""
+
+# Python Built-Ins:
+import time
+
+RECONCILE_LOCK_ID = "#ReconcileLock"
+USER_KEY_PREFIX = "User#"
+DEFAULT_LEASE_SECONDS = 15 * 60
+DEFAULT_USER_RECORD_SECONDS = 30 * 24 * 60 * 60
+
+
+class AuthorizationStore:
+    """Record identities attached to the IoT policy, and coordinate whole-pool reconciliations
+
+    Parameters
+    ----------
+    table :
+        boto3 DynamoDB Table resource with hash key `IdentityId` (and TTL on `ExpiresAt`)
+    lease_seconds :
+        How long the reconcile lock is held for without being renewed, before others may take it over
+    user_record_seconds :
+        How long a user's login stays recorded as covered by a reconciliation
+    """
+    def __init__(
+        self,
+        table,
+        lease_seconds: int=DEFAULT_LEASE_SECONDS,
+        user_record_seconds: int=DEFAULT_USER_RECORD_SECONDS,
+    ):
+        self.table = table
+        self.lease_seconds = lease_seconds
+        self.user_record_seconds = user_record_seconds
+        self.exceptions = table.meta.client.exceptions
+
+    def is_attached(self, identity_id: str, policy_name: str) -> bool:
+        item = self.table.get_item(Key={ "IdentityId": identity_id }).get("Item")
+        return item is not None and item.get("PolicyName") == policy_name
+
+    def record_attached(self, identity_ids: list, policy_name: str):
+        now = int(time.time())
+        with self.table.batch_writer(overwrite_by_pkeys=["IdentityId"]) as batch:
+            for identity_id in identity_ids:
+                batch.put_item(Item={ "IdentityId": identity_id, "PolicyName": policy_name, "AttachedAt": now })
+
+    def record_detached(self, identity_ids: list):
+        with self.table.batch_writer(overwrite_by_pkeys=["IdentityId"]) as batch:
+            for identity_id in identity_ids:
+                batch.delete_item(Key={ "IdentityId": identity_id })
+
+    def is_user_covered(self, user_sub: str, policy_name: str) -> bool:
+        """Check whether user pool user `user_sub`'s identity is known to be attached (see `record_user_covered`)"""
+        item = self.table.get_item(Key={ "IdentityId": USER_KEY_PREFIX + user_sub }).get("Item")
+        return (
+            item is not None
+            and item.get("PolicyName") == policy_name
+            and item.get("ExpiresAt", 0) > time.time()  # (TTL deletion can lag expiry)
+        )
+
+    def record_user_covered(self, user_sub: str, policy_name: str):
+        """Record that a whole-pool reconciliation completed after user pool user `user_sub` logged in"""
+        now = int(time.time())
+        self.table.put_item(Item={
+            "IdentityId": USER_KEY_PREFIX + user_sub,
+            "PolicyName": policy_name,
+            "CoveredAt": now,
+            "ExpiresAt": now + self.user_record_seconds,
+        })
+
+    def acquire_reconcile_lock(self, owner: str) -> bool:
+        """Take (or renew, if `owner` already holds it) the reconcile lock: Returns False if held by another
+
+        When the lock is held by another owner, a re-run is requested from them instead.
+        """
+        now = int(time.time())
+        try:
+            self.table.update_item(
+                Key={ "IdentityId": RECONCILE_LOCK_ID },
+                UpdateExpression="SET #owner = :owner, ExpiresAt = :expires",
+                ConditionExpression=(
+                    "attribute_not_exists(IdentityId) OR ExpiresAt < :now OR #owner = :owner"
+                ),
+                ExpressionAttributeNames={ "#owner": "Owner" },
+                ExpressionAttributeValues={
+                    ":owner": owner,
+                    ":expires": now + self.lease_seconds,
+                    ":now": now,
+                },
+            )
+            return True
+        except self.exceptions.ConditionalCheckFailedException:
+            pass
+        try:
+            self.table.update_item(
+                Key={ "IdentityId": RECONCILE_LOCK_ID },
+                UpdateExpression="SET Rerun = :true",
+                ConditionExpression="attribute_exists(IdentityId)",
+                ExpressionAttributeValues={ ":true": True },
+            )
+            return False
+        except self.exceptions.ConditionalCheckFailedException:
+            # The lock was released in the meantime: Try again to take it
+            return self.acquire_reconcile_lock(owner)
+
+    def release_reconcile_lock(self, owner: str, force: bool=False) -> bool:
+        """Release the reconcile lock held by `owner`: Returns True (keeping the lock) if a re-run was requested
+
+        With `force`, the lock is released regardless of any re-run requests (e.g. after an error).
+        """
+        condition = "#owner = :owner" if force else "#owner = :owner AND attribute_not_exists(Rerun)"
+        try:
+            self.table.delete_item(
+                Key={ "IdentityId": RECONCILE_LOCK_ID },
+                ConditionExpression=condition,
+                ExpressionAttributeNames={ "#owner": "Owner" },
+                ExpressionAttributeValues={ ":owner": owner },
+            )
+            return False
+        except self.exceptions.ConditionalCheckFailedException:
+            if force:
+                return False  # (Lock already lost to someone else)
+        try:
+            # Consume the re-run request, keeping (and renewing) the lock:
+            self.table.update_item(
+                Key={ "IdentityId": RECONCILE_LOCK_ID },
+                UpdateExpression="REMOVE Rerun SET ExpiresAt = :expires",
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={ "#owner": "Owner" },
+                ExpressionAttributeValues={
+                    ":owner": owner,
+                    ":expires": int(time.time()) + self.lease_seconds,
+                },
+            )
+            return True
+        except self.exceptions.ConditionalCheckFailedException:
+            return False  # Lock expired and was taken over by another owner, who'll do the re-run
@@ -1,8 +1,10 @@
 """Lambda to manage IoT PubSub permissions for OCR progress push notifications
 
 Invokable as both a CloudFormation custom resource (to configure initial access) and a Cognito
-PostAuthentication trigger - to reconcile all identity pool permissions on *every* user login, because of:
-https://forums.aws.amazon.com/thread.jspa?messageID=924345
+PostAuthentication trigger - to reconcile all identity pool permissions on user logins not yet covered by a
+reconciliation, because of: https://forums.aws.amazon.com/thread.jspa?messageID=924345
+
+The web UI authorizes its own identity directly after sign-in, through `authorize_identity_handler()`.
 
 TODO: PostAuthentication trigger not yet tested able to add new user access
 
@@ -18,24 +20,68 @@ import traceback
 
 # External Dependencies:
 import boto3
+from botocore.config import Config as BotoConfig
 
 # Local Dependencies:
+from authorizations import AuthorizationStore
 import cfnresponse  # AWS CloudFormation response util
+from reconcile import ATTACH, DETACH, PolicyReconciler
+
+reconcile_max_workers = int(os.environ.get("IOT_RECONCILE_MAX_WORKERS", 8))
+reconcile_rate_per_second = float(os.environ.get("IOT_RECONCILE_TPS", 10))
+# Stop reconciling and continue in a new invocation when less than this much time is left:
+reconcile_time_margin_seconds = float(os.environ.get("IOT_RECONCILE_TIME_MARGIN_SECONDS", 60))
+MAX_RECONCILE_CONTINUATIONS = 100  # Safety limit on re-invocations for one request
 
 cognito_identity = boto3.client("cognito-identity")
 cognito_idp = boto3.client("cognito-idp")
 iam = boto3.client("iam")
-iot = boto3.client("iot")
+# (Retries with back-off on throttling, and a connection per reconciliation worker thread)
+iot = boto3.client(
+    "iot",
+    config=BotoConfig(
+        max_pool_connections=max(10, reconcile_max_workers),
+        retries={ "mode": "standard", "max_attempts": 8 },
+    ),
+)
 lambdaclient = boto3.client("lambda")
 
+# Record of identities known to be authorized, and lock to coalesce whole-pool reconciliations (optional):
+authorizations_table_name = os.environ.get("IOT_AUTHORIZATIONS_TABLE_NAME")
+authorization_store = (
+    AuthorizationStore(boto3.resource("dynamodb").Table(authorizations_table_name))
+    if authorizations_table_name else None
+)
+
+reconciler = PolicyReconciler(
+    iot,
+    cognito_identity,
+    max_workers=reconcile_max_workers,
+    rate_per_second=reconcile_rate_per_second,
+)
+
 # We pass this in as *both* a CF resource param and a Lambda env var because the Lambda function may need the
 # information for other invokations besides CF, but for edge-case CF calls (e.g. update stack) the resource
 # prop should be authoritative:
 env_iot_policy_name = os.environ["IOT_ACCESS_POLICY_NAME"]
 env_identity_pool_id = os.environ["COGNITO_IDENTITY_POOL_ID"]
 
-IOT_TARGET_BATCH_SIZE = 250  # Max permitted per the API doc
-IDENTITY_BATCH_SIZE = 60  # Max permitted per the API doc
+# Event key under which reconciliation progress is passed to continuation invocations:
+CHECKPOINT_KEY = "IotReconcileCheckpoint"
+# Event key identifying the holder of the reconcile lock, so continuations keep it:
+LOCK_OWNER_KEY = "IotReconcileLockOwner"
+# Event key for the user pool user (sub) whose login requested a reconciliation:
+USER_SUB_KEY = "UserSub"
+
+
+class ReconcileContinued(Exception):
+    """Raised when reconciliation ran out of time and will be continued by a new invocation of the function
+
+    The continuation re-processes the same request (with a checkpoint), so whatever was meant to happen after the
+    reconciliation (such as responding to CloudFormation) should not happen in the current invocation.
+    """
+    pass
+
 
 def handler(event, context):
     # Determine if it's a CloudFormation resource request (set up or tear-down) or a Cognito request
@@ -69,6 +115,9 @@ def handler(event, context):
                         "Error": f"Got unexpected RequestType '{event['RequestType']}' from CloudFormation",
                     },
                 )
+        except ReconcileContinued as e:
+            print(f"Deferring CloudFormation response to continuation: {e}")
+            return
         except Exception as e:
             traceback.print_exc()
             return cfnresponse.send(
@@ -81,12 +130,38 @@ def handler(event, context):
         # (These params are common across Cognito trigger types)
         # It's a Cognito Lambda trigger request
         return post_login_handler(event, context)
+    elif event and "IdentityId" in event:
+        # Fast path for callers that know which identity to authorize:
+        authorize_identity(event["IdentityId"], env_iot_policy_name)
+        return {
+            "statusCode": 200,
+            "headers": {
+                "Access-Control-Allow-Credentials": True,
+                "Access-Control-Allow-Origin": "*",
+            },
+            "body": json.dumps({
+                "Message": f"Authorized identity {event['IdentityId']} for IoT notifications"
+            }),
+        }
     else:
         if event and "Delay" in event:
             print(f"Delaying invokation by {event['Delay']}s")
             time.sleep(event["Delay"])
         # Just interpret it as an instruction to refresh everybody's perms:
-        attach_iot_policy_to_all_identities(env_identity_pool_id, env_iot_policy_name)
+        try:
+            if not reconcile_pool_coalesced(env_identity_pool_id, env_iot_policy_name, event, context):
+                return {
+                    "statusCode": 202,
+                    "body": json.dumps({ "Message": "Reconciliation already in progress: Re-run requested" }),
+                }
+        except ReconcileContinued as e:
+            return {
+                "statusCode": 202,
+                "body": json.dumps({ "Message": str(e) }),
+            }
+        if authorization_store and event.get(USER_SUB_KEY):
+            # (If the request was coalesced into another run instead, the user just isn't recorded this time)
+            authorization_store.record_user_covered(event[USER_SUB_KEY], env_iot_policy_name)
         return {
             "statusCode": 200,
             "headers": {
@@ -107,8 +182,12 @@ def setup_stack_handler(event, context):
     try:
         attach_iot_policy_to_all_identities(
             identity_pool_id,
-            event["ResourceProperties"].get("IotAccessPolicyName", env_iot_policy_name)
+            event["ResourceProperties"].get("IotAccessPolicyName", env_iot_policy_name),
+            event,
+            context,
         )
+    except ReconcileContinued:
+        raise
     except Exception as e:
         traceback.print_exc()
         return cfnresponse.send(
@@ -169,7 +248,9 @@ def update_stack_handler(event, context):
     # Refresh IoT policy attachments on the new pool even if there's been 'no change'
     if (identity_pool_id):
         try:
-            attach_iot_policy_to_all_identities(identity_pool_id, iot_policy_name)
+            attach_iot_policy_to_all_identities(identity_pool_id, iot_policy_name, event, context)
+        except ReconcileContinued:
+            raise
         except Exception as e:
             traceback.print_exc()
             # This is a failing error iff the update includes a change to the relevant components:
@@ -206,7 +287,9 @@ def update_stack_handler(event, context):
         and (old_identity_pool_id != identity_pool_id or old_iot_policy_name != iot_policy_name)
     ):
         try:
-            detach_iot_policy_from_all_identities(old_identity_pool_id, old_iot_policy_name)
+            detach_iot_policy_from_all_identities(old_identity_pool_id, old_iot_policy_name, event, context)
+        except ReconcileContinued:
+            raise
         except Exception as e:
             traceback.print_exc()
             return cfnresponse.send(
@@ -263,8 +346,12 @@ def delete_stack_handler(event, context):
     try:
         detach_iot_policy_from_all_identities(
             identity_pool_id,
-            event["ResourceProperties"].get("IotAccessPolicyName", env_iot_policy_name)
+            event["ResourceProperties"].get("IotAccessPolicyName", env_iot_policy_name),
+            event,
+            context,
         )
+    except ReconcileContinued:
+        raise
     except Exception as e:
         traceback.print_exc()
         return cfnresponse.send(
@@ -314,92 +401,179 @@ def delete_stack_handler(event, context):
 
 
 def post_login_handler(event, context):
-    """On every user login, check the whole identity pool's setup
+    """On user login, check the whole identity pool's setup - unless already done since this user last logged in
 
     Cognito User Pool triggers listen to the user pool, not the identity pool, so they don't see the
-    IdentityId associated with the current UserId.
-
-    Since our demo app will have a small pool of identities, it's more practical/easy to do this than set up
-    a custom API for logged-in users to request their permissions be set up.
+    IdentityId associated with the current UserId - so unlike callers who can invoke the function with an
+    `IdentityId` (like the web UI, via `authorize_identity_handler()`), we can't just authorize the one user.
 
-    Asynchronously invokes this same Lambda without a payload, to do the updates in the background
+    If the authorizations table records that a reconciliation already completed after this user logged in
+    before, there's nothing to do. Otherwise asynchronously invokes this same Lambda to do the updates in the
+    background: Concurrent logins are coalesced by the reconcile lock, so at most one whole-pool scan runs at a
+    time.
     """
+    user_sub = (event.get("request", {}).get("userAttributes") or {}).get("sub")
+    if (
+        authorization_store
+        and user_sub
+        and authorization_store.is_user_covered(user_sub, env_iot_policy_name)
+    ):
+        print(f"User {user_sub} already covered by a previous reconciliation: Skipping")
+        return event
+
     # Because PostLogin is called and must return in the authentication flow before a new user's Cognito
     # Identity ID is created - so we'll trigger the reconciliation with a small delay to ensure ID exists:
+    payload = { "Delay": 1.2 }
+    if user_sub:
+        payload[USER_SUB_KEY] = user_sub
     lambdaclient.invoke(
         FunctionName=context.invoked_function_arn,
         InvocationType="Event",
-        Payload=json.dumps({ "Delay": 1.2 }),
+        Payload=json.dumps(payload),
     )
     return event
 
 
-def attach_iot_policy_to_all_identities(identity_pool_id: str, iot_policy_name: str):
-    """Lists all targets attached to the policy, and all identities in the pool, then reconciles"""
-
-    print(f"Querying which identities are already attached to IoT policy {iot_policy_name}")
-    already_attached_identities = set()
-    iot_target_list = iot.list_targets_for_policy(
-        policyName=iot_policy_name,
-        pageSize=IOT_TARGET_BATCH_SIZE,
-    )
-    while len(iot_target_list["targets"]):
-        already_attached_identities.update(iot_target_list["targets"])
-        next_token = iot_target_list.get("nextMarker")
-        if next_token:
-            if len(iot_target_list["targets"]) < IOT_TARGET_BATCH_SIZE:
-                print("WARNING: Got a continuation token but fewer than requested IoT targets???")
-            iot_target_list = iot.list_targets_for_policy(
-                policyName=iot_policy_name,
-                pageSize=IOT_TARGET_BATCH_SIZE,
-                marker=next_token,
-            )
-        else:
-            break
+def authorize_identity_handler(event, context):
+    """Authorize the calling Cognito identity for IoT notifications (invoked by the web UI after sign-in)
 
+    Deployed as a separate function, which the identity pool's authenticated role may invoke: Unlike the main
+    `handler()`, it never does anything but attach the policy to one identity. That's the caller's own identity if
+    Lambda received it (as for requests signed with Cognito identity pool credentials), or else the event's
+    `IdentityId` - which is safe to trust, since the policy only grants each identity access to its own topic.
+    """
+    caller_identity = getattr(getattr(context, "identity", None), "cognito_identity_id", None)
+    identity_id = caller_identity or event.get("IdentityId")
+    if not identity_id:
+        raise ValueError("Couldn't determine the Cognito IdentityId to authorize")
+    authorize_identity(identity_id, env_iot_policy_name)
+    return { "IdentityId": identity_id, "Authorized": True }
+
+
+def authorize_identity(identity_id: str, iot_policy_name: str):
+    """Attach the IoT policy to a single identity, unless already known to be attached"""
+    if authorization_store and authorization_store.is_attached(identity_id, iot_policy_name):
+        print(f"Identity {identity_id} already authorized")
+        return
+    print(f"Attaching IoT policy {iot_policy_name} to identity {identity_id}")
+    iot.attach_policy(policyName=iot_policy_name, target=identity_id)
+    if authorization_store:
+        authorization_store.record_attached([identity_id], iot_policy_name)
+
+
+def reconcile_pool_coalesced(identity_pool_id: str, iot_policy_name: str, event: dict, context) -> bool:
+    """Attach the IoT policy to all identities, unless another invocation is already doing so
+
+    Returns False if another invocation holds the reconcile lock (in which case it's been asked to re-run when
+    done), or True once reconciliation is complete. Raises ReconcileContinued as for reconcile_identities().
+    """
+    if not authorization_store:
+        attach_iot_policy_to_all_identities(identity_pool_id, iot_policy_name, event, context)
+        return True
+    owner = event.get(LOCK_OWNER_KEY) or context.aws_request_id
+    if not authorization_store.acquire_reconcile_lock(owner):
+        print("Reconciliation already in progress: Requested a re-run")
+        return False
+    event[LOCK_OWNER_KEY] = owner  # (Continuation invocations keep the lock)
+    try:
+        while True:
+            attach_iot_policy_to_all_identities(identity_pool_id, iot_policy_name, event, context)
+            if not authorization_store.release_reconcile_lock(owner):
+                return True
+            print("Re-running reconciliation requested while in progress")
+            event.pop(CHECKPOINT_KEY, None)
+    except ReconcileContinued:
+        raise
+    except Exception:
+        authorization_store.release_reconcile_lock(owner, force=True)
+        raise
+
+
+def attach_iot_policy_to_all_identities(identity_pool_id: str, iot_policy_name: str, event: dict, context):
+    """Attach the IoT policy to every identity in the pool that doesn't already have it - see reconcile.py"""
     print(f"Ensuring all identities in {identity_pool_id} attached to IoT policy {iot_policy_name}")
-    identity_list = cognito_identity.list_identities(
-        IdentityPoolId=identity_pool_id,
-        MaxResults=IDENTITY_BATCH_SIZE,
-    )
-    while len(identity_list["Identities"]):
-        for identity in identity_list["Identities"]:
-            if identity["IdentityId"] not in already_attached_identities:
-                iot.attach_policy(policyName=iot_policy_name, target=identity["IdentityId"])
-        next_token = identity_list.get("NextToken")
-        if next_token:
-            if len(identity_list["Identities"]) < IDENTITY_BATCH_SIZE:
-                print("WARNING: Got a continuation token but fewer than requested identities???")
-            identity_list = cognito_identity.list_identities(
-                IdentityPoolId=identity_pool_id,
-                MaxResults=IDENTITY_BATCH_SIZE,
-                NextToken=next_token,
-            )
-        else:
-            break
+    reconcile_identities(ATTACH, identity_pool_id, iot_policy_name, event, context)
 
 
-def detach_iot_policy_from_all_identities(identity_pool_id: str, iot_policy_name: str):
+def detach_iot_policy_from_all_identities(identity_pool_id: str, iot_policy_name: str, event: dict, context):
+    """Detach the IoT policy from every identity in the pool that has it - see reconcile.py"""
     print(f"Revoking IoT access for existing Cognito identities")
-    identity_list = cognito_identity.list_identities(
-        IdentityPoolId=identity_pool_id,
-        MaxResults=IDENTITY_BATCH_SIZE,
-    )
-    while len(identity_list["Identities"]):
-        for identity in identity_list["Identities"]:
-            # This doesn't seem to raise an exception if already detached:
-            iot.detach_policy(policyName=iot_policy_name, target=identity["IdentityId"])
-        next_token = identity_list.get("NextToken")
-        if next_token:
-            if len(identity_list["Identities"]) < IDENTITY_BATCH_SIZE:
-                print("WARNING: Got a continuation token but fewer than requested identities???")
-            identity_list = cognito_identity.list_identities(
-                IdentityPoolId=identity_pool_id,
-                MaxResults=IDENTITY_BATCH_SIZE,
-                NextToken=next_token,
-            )
+    reconcile_identities(DETACH, identity_pool_id, iot_policy_name, event, context)
+
+
+def reconcile_identities(mode: str, identity_pool_id: str, iot_policy_name: str, event: dict, context):
+    """Run (or resume) one reconciliation step of the current request, within the invocation's time budget
+
+    A request may need several reconciliation steps (e.g. attach to a new pool then detach from an old one), so
+    each is identified by its parameters. Completed steps are recorded on `event`, so that if a later step runs
+    out of time, the continuation invocation can skip them.
+
+    Raises ReconcileContinued if the step couldn't complete in this invocation: A continuation has been started.
+    Raises RuntimeError if the step completed, but failed to update some identities.
+    """
+    step = f"{mode}:{identity_pool_id}:{iot_policy_name}"
+    progress = event.get(CHECKPOINT_KEY, {})
+    completed_steps = progress.get("Completed", [])
+    if step in completed_steps:
+        print(f"Skipping reconciliation step {step} already completed by a previous invocation")
+        return
+    checkpoint = progress.get("Current") if progress.get("Step") == step else None
+
+    def out_of_time():
+        return context.get_remaining_time_in_millis() < reconcile_time_margin_seconds * 1000
+
+    def record_changes(identity_ids: list):
+        if not authorization_store:
+            return
+        if mode == ATTACH:
+            authorization_store.record_attached(identity_ids, iot_policy_name)
         else:
-            break
+            authorization_store.record_detached(identity_ids)
+
+    result = reconciler.reconcile(
+        mode,
+        identity_pool_id,
+        iot_policy_name,
+        checkpoint=checkpoint,
+        should_stop=out_of_time,
+        on_changes=record_changes,
+    )
+    if not result["Complete"]:
+        continue_in_new_invocation(
+            event,
+            context,
+            {
+                "Completed": completed_steps,
+                "Step": step,
+                "Current": result,
+                "Continuations": progress.get("Continuations", 0) + 1,
+            },
+        )
+        raise ReconcileContinued(f"Reconciliation step {step} continuing in new invocation: {result}")
+
+    event[CHECKPOINT_KEY] = {
+        "Completed": completed_steps + [step],
+        "Continuations": progress.get("Continuations", 0),
+    }
+    if result["Failed"]:
+        raise RuntimeError(
+            f"Failed to {mode} IoT policy {iot_policy_name} for {result['Failed']} identities in {identity_pool_id}"
+        )
+
+
+def continue_in_new_invocation(event: dict, context, progress: dict):
+    """Asynchronously re-invoke this function to continue processing `event` from `progress`"""
+    if progress["Continuations"] > MAX_RECONCILE_CONTINUATIONS:
+        raise RuntimeError(f"Reconciliation still incomplete after {MAX_RECONCILE_CONTINUATIONS} continuations")
+    # (No need to delay continuations of delayed post-login reconciliations)
+    payload = { k: v for k, v in event.items() if k != "Delay" }
+    payload[CHECKPOINT_KEY] = progress
+    print(f"Continuing in new invocation with progress {progress}")
+    lambdaclient.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps(payload),
+    )
 
 
 def update_lambda_triggers(
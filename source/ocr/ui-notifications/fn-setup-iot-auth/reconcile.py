@@ -0,0 +1,172 @@
+"""Diffed, parallel reconciliation of IoT policy attachments for a Cognito identity pool
+
+Attaching (or detaching) an IoT policy to every identity in a pool one API call at a time takes minutes for
+large pools, and can outlast the Lambda timeout. A `PolicyReconciler` instead:
+
+- **Diffs**: Lists the policy's current targets once, then pages through the pool's identities and only calls
+  `attach_policy` for identities not yet attached (or `detach_policy` for those that are).
+- **Parallelizes**: Applies each page's changes through a bounded thread pool, throttled by a shared
+  `RateLimiter` to stay within the IoT control plane's transactions-per-second quota. Throttling and transient
+  errors are retried (with back-off) by the botocore client.
+- **Checkpoints**: Completes whole pages of identities at a time, and before each page checks the time remaining
+  in the invocation. If it's running out, it stops with a checkpoint (the identity listing token to resume from),
+  for the caller to continue in a fresh invocation. Because each run re-lists the current policy targets,
+  resuming never repeats work already done.
+"""
+
+# Python Built-Ins:
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+IOT_TARGET_BATCH_SIZE = 250  # Max permitted per the API doc
+IDENTITY_BATCH_SIZE = 60  # Max permitted per the API doc
+
+ATTACH = "attach"
+DETACH = "detach"
+
+
+class RateLimiter:
+    """Thread-safe limiter allowing at most `rate_per_second` acquisitions per second (0 = unlimited)"""
+    def __init__(self, rate_per_second: float):
+        self.interval = 1. / rate_per_second if rate_per_second else 0.
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class PolicyReconciler:
+    """Attach or detach an IoT policy for all identities in a Cognito identity pool
+
+    Parameters
+    ----------
+    iot_client :
+        boto3 IoT client (ideally configured with retries, and `max_pool_connections` >= `max_workers`)
+    cognito_identity_client :
+        boto3 Cognito Identity client
+    max_workers :
+        Number of attach/detach requests to run concurrently
+    rate_per_second :
+        Maximum attach/detach requests per second (0 = unlimited)
+    """
+    def __init__(
+        self,
+        iot_client,
+        cognito_identity_client,
+        max_workers: int=8,
+        rate_per_second: float=10,
+    ):
+        self.iot = iot_client
+        self.cognito_identity = cognito_identity_client
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(rate_per_second)
+
+    def list_policy_targets(self, policy_name: str) -> set:
+        """Fetch the set of all targets (e.g. identity IDs) the IoT policy is currently attached to"""
+        targets = set()
+        request = { "policyName": policy_name, "pageSize": IOT_TARGET_BATCH_SIZE }
+        while True:
+            response = self.iot.list_targets_for_policy(**request)
+            targets.update(response["targets"])
+            if not (response.get("nextMarker") and len(response["targets"])):
+                return targets
+            request["marker"] = response["nextMarker"]
+
+    def list_identity_page(self, identity_pool_id: str, next_token: str=None) -> tuple:
+        """Fetch one page of identity IDs from the pool: Returns (list of IDs, next token or None)"""
+        request = { "IdentityPoolId": identity_pool_id, "MaxResults": IDENTITY_BATCH_SIZE }
+        if next_token:
+            request["NextToken"] = next_token
+        response = self.cognito_identity.list_identities(**request)
+        identity_ids = [identity["IdentityId"] for identity in response["Identities"]]
+        return identity_ids, (response.get("NextToken") if len(identity_ids) else None)
+
+    def apply(self, mode: str, policy_name: str, target: str):
+        self.rate_limiter.acquire()
+        if mode == ATTACH:
+            self.iot.attach_policy(policyName=policy_name, target=target)
+        else:
+            try:
+                self.iot.detach_policy(policyName=policy_name, target=target)
+            except self.iot.exceptions.ResourceNotFoundException:
+                pass  # Already detached, or identity deleted
+
+    def reconcile(
+        self,
+        mode: str,
+        identity_pool_id: str,
+        policy_name: str,
+        checkpoint: dict=None,
+        should_stop=None,
+        on_changes=None,
+    ) -> dict:
+        """Attach (`mode`="attach") or detach ("detach") the policy for every identity in the pool
+
+        Parameters
+        ----------
+        checkpoint :
+            A checkpoint returned by a previous incomplete run, to resume from
+        should_stop :
+            Optional callable checked before each page of identities: If it returns True, stop and return the
+            checkpoint to resume from.
+        on_changes :
+            Optional callable, given the list of identity IDs successfully changed after each page
+
+        Returns
+        -------
+        checkpoint :
+            Dict with `Complete` (bool), `NextToken` (to resume from, if incomplete), and cumulative counts of
+            `Identities` checked, `Changed` and `Failed`. Operations that fail (after the client's retries)
+            are logged and counted but don't stop the run.
+        """
+        checkpoint = {
+            "Complete": False,
+            "NextToken": None,
+            "Identities": 0,
+            "Changed": 0,
+            "Failed": 0,
+            **(checkpoint or {}),
+        }
+        print(f"Querying which identities are currently attached to IoT policy {policy_name}")
+        attached = self.list_policy_targets(policy_name)
+        print(f"Found {len(attached)} targets attached to IoT policy {policy_name}")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            next_token = checkpoint["NextToken"]
+            while True:
+                if should_stop and should_stop():
+                    print(f"Stopping {mode} reconciliation early with checkpoint {checkpoint}")
+                    return checkpoint
+                identity_ids, next_token = self.list_identity_page(identity_pool_id, next_token)
+                if mode == ATTACH:
+                    changes = [i for i in identity_ids if i not in attached]
+                else:
+                    changes = [i for i in identity_ids if i in attached]
+                futures = [executor.submit(self.apply, mode, policy_name, target) for target in changes]
+                changed = []
+                for target, future in zip(changes, futures):
+                    try:
+                        future.result()
+                        changed.append(target)
+                    except Exception as e:
+                        print(f"ERROR: Failed to {mode} IoT policy {policy_name} for {target}: {e}")
+                        checkpoint["Failed"] += 1
+                checkpoint["Changed"] += len(changed)
+                if on_changes and len(changed):
+                    on_changes(changed)
+                checkpoint["Identities"] += len(identity_ids)
+                # Only advance the checkpoint once the whole page is done:
+                checkpoint["NextToken"] = next_token
+                if not next_token:
+                    checkpoint["Complete"] = True
+                    print(f"Completed {mode} reconciliation of IoT policy {policy_name}: {checkpoint}")
+                    return checkpoint
@@ -2,41 +2,71 @@ import json
 import boto3
 import os
 
+# Cognito User Pool triggers don't tell us the user's Cognito *Identity* ID, so by default we have to check the
+# whole identity pool on each login. To avoid every login re-scanning the pool:
+# - If the event carries an `IdentityId` (e.g. when invoked directly by a trusted caller), only that identity is
+#   authorized.
+# - If `RECONCILE_FUNCTION_NAME` is set (to the stack's FunctionSetUpIotAuth), the scan is delegated to it: It
+#   coalesces concurrent requests so at most one scan of the pool runs at a time.
+# - Otherwise we scan here, remembering identities known to be attached while the Lambda is warm.
+
+cognito = boto3.client('cognito-identity')
+iot = boto3.client('iot')
+lambdaclient = boto3.client('lambda')
+
+known_attached = set()
+
+def list_attached(policy_name):
+  attached = set()
+  request = { 'policyName': policy_name, 'pageSize': 250 }
+  while True:
+    targets = iot.list_targets_for_policy(**request)
+    attached.update(targets['targets'])
+    if not (targets.get('nextMarker') and len(targets['targets'])):
+      return attached
+    request['marker'] = targets['nextMarker']
+
+def attach(identity_id, policy_name):
+  print('attaching: ', identity_id)
+  iot.attach_policy(policyName=policy_name, target=identity_id)
+  known_attached.add(identity_id)
+
 def lambda_handler(event, context):
+  policy_name = os.environ['IOT_POLICY']
+
+  if event.get('IdentityId'):
+    if event['IdentityId'] not in known_attached:
+      attach(event['IdentityId'], policy_name)
+    return event
+
+  if os.environ.get('RECONCILE_FUNCTION_NAME'):
+    lambdaclient.invoke(
+      FunctionName=os.environ['RECONCILE_FUNCTION_NAME'],
+      InvocationType='Event',
+      Payload=json.dumps({ 'Delay': 1.2 }),
+    )
+    print('Delegated IoT policy reconciliation')
+    return event
+
+  attached = None  # Only fetched if we find an identity not known to be attached
+  request = { 'IdentityPoolId': os.environ['IDENTITY_POOLID'], 'MaxResults': 60, 'HideDisabled': True }
+  while True:
+    identitylist = cognito.list_identities(**request)
+    for i in identitylist['Identities']:
+      id = i['IdentityId']
+      if id in known_attached:
+        continue
+      if attached is None:
+        attached = list_attached(policy_name)
+        known_attached.update(attached)
+      if id not in attached:
+        attach(id, policy_name)
+    if not (identitylist.get('NextToken') and len(identitylist['Identities'])):
+      break
+    request['NextToken'] = identitylist['NextToken']
 
-  cognito= boto3.client('cognito-identity')
-  identitylist = cognito.list_identities(
-    IdentityPoolId=os.environ['IDENTITY_POOLID'],
-    MaxResults=10,
-    HideDisabled=True
-  )
-  
-  iot = boto3.client('iot')
-  targets = iot.list_targets_for_policy(
-      policyName=os.environ['IOT_POLICY']
-  )
-  
-  #print('Targets:', targets)
-  attached = []
-  
-  for i in targets["targets"]:
-    attached.append(i.split(':',1)[1])
-    
-  #print('Attached: ', attached)
-  
-  for i in identitylist["Identities"]:
-    id = i["IdentityId"]
-    cnt = attached.count(id)
-    if(cnt==0):
-      print('attaching: ', id)
-      out = iot.attach_policy(
-        policyName='myIoTPolicy',
-        target=i["IdentityId"]
-      )
   # Send post authentication data to Cloudwatch logs
   print ("Authentication successful")
-  
+
   # Return to Amazon Cognito
   return event
-
-